@@ -68,6 +68,9 @@ def get_options():
                                             '[default = 0]', default=0, type=int)
     oGroup.add_argument('--overwrite', help='Overwrite any existing database files', default=False, action='store_true')
     oGroup.add_argument('--graph-weights', help='Save within-strain Euclidean distances into the graph', default=False, action='store_true')
+    oGroup.add_argument('--dist-format', help='Format to save distances in: npy, or a compressed hdf5 file '
+                                              'with optional 16-bit distances [default = npy]',
+                                         default='npy', choices=['npy', 'hdf5', 'hdf5-16bit'])
 
     # comparison metrics
     kmerGroup = parser.add_argument_group('Create DB options')
@@ -118,6 +121,11 @@ def get_options():
                             help='Number of pairwise distances used to fit model [default = 100000]',
                             type=int,
                             default=100000)
+    modelGroup.add_argument('--model-coreset',
+                            help='Subsample distances for BGMM fitting with a weighted coreset '
+                                 'from a 2D histogram, rather than at random',
+                            default=False,
+                            action='store_true')
     modelGroup.add_argument('--assign-subsample',
                             help='Number of pairwise distances in each assignment batch [default = 5000]',
                             type=int,
@@ -162,6 +170,11 @@ def get_options():
     refinementGroup.add_argument('--betweenness-sample',
             help='Number of sequences used to estimate betweeness with a GPU [default = 100]',
             type = int, default = betweenness_sample_default)
+    refinementGroup.add_argument('--refine-tolerance',
+            help='Search for the boundary with an adaptive grid, refining around the best '
+                 'positions until the spacing is below this fraction of the maximum distances '
+                 '[default = fixed grid]',
+            type = float, default = None)
     refineMode = refinementGroup.add_mutually_exclusive_group()
     refineMode.add_argument('--unconstrained',
             help='Optimise both boundary gradient and intercept',
@@ -260,6 +273,7 @@ def main():
 
     from .network import construct_network_from_edge_list
     from .network import construct_network_from_assignments
+    from .network import process_weights
     from .network import extractReferences
     from .network import printClusters
     from .network import save_network
@@ -290,6 +304,16 @@ def main():
         sys.exit(1)
     kmers = np.arange(args.min_k, args.max_k + 1, args.k_step)
 
+    if args.refine_tolerance is not None and args.refine_tolerance <= 0:
+        sys.stderr.write("Refine tolerance must be positive\n")
+        sys.exit(1)
+
+    # HDBSCAN cannot use the coreset weights, and the capped cells change the
+    # density it clusters on
+    if args.model_coreset and args.fit_model == "dbscan":
+        sys.stderr.write("--model-coreset can only be used with --fit-model bgmm\n")
+        sys.exit(1)
+
     # Dict of DB access functions
     dbFuncs = setupDBFuncs(args)
     createDatabaseDir = dbFuncs['createDatabaseDir']
@@ -386,7 +410,8 @@ def main():
                                 self = True,
                                 number_plot_fits = args.plot_fit,
                                 threads = args.threads)
-        storePickle(seq_names, seq_names, True, distMat, f"{args.output}/{os.path.basename(args.output)}.dists")
+        storePickle(seq_names, seq_names, True, distMat, f"{args.output}/{os.path.basename(args.output)}.dists",
+                    dist_format = args.dist_format)
 
         # Plot results
         if not args.no_plot:
@@ -423,7 +448,7 @@ def main():
             'type_isolate': args.type_isolate
         }
 
-        refList, queryList, self, distMat = readPickle(distances, enforce_self=True)
+        refList, queryList, self, distMat = readPickle(distances, enforce_self=True, mmap=True)
 
         fail_unconditionally = {}
         # Unconditional removal
@@ -474,6 +499,7 @@ def main():
                          output + " distances")
             genome_lengths, ambiguous_bases = get_database_statistics(output)
             plot_database_evaluations(output, genome_lengths, ambiguous_bases)
+        distMat.close()
 
     #******************************#
     #*                            *#
@@ -519,7 +545,7 @@ def main():
                 sys.exit(1)
 
         # Load the distances
-        refList, queryList, self, distMat = readPickle(distances, enforce_self=True)
+        refList, queryList, self, distMat = readPickle(distances, enforce_self=True, mmap=True)
 
         #******************************#
         #*                            *#
@@ -527,6 +553,7 @@ def main():
         #*                            *#
         #******************************#
         # Run selected model here, or if easy run DBSCAN followed by refinement
+        within_rows = None
         if args.fit_model:
             # Run DBSCAN model
             if args.fit_model == "dbscan":
@@ -544,7 +571,8 @@ def main():
                 model = BGMMFit(output,
                                 max_samples = args.model_subsample,
                                 max_batch_size = args.assign_subsample,
-                                assign_points = not args.for_refine)
+                                assign_points = not args.for_refine,
+                                coreset = args.model_coreset)
                 model.set_threads(args.threads)
                 assignments = model.fit(distMat,
                                         args.K)
@@ -561,7 +589,8 @@ def main():
                                             args.no_local,
                                             args.betweenness_sample,
                                             args.summary_sample,
-                                            args.gpu_graph)
+                                            args.gpu_graph,
+                                            args.refine_tolerance)
                 model = new_model
             elif args.fit_model == "threshold":
                 new_model = RefineFit(output)
@@ -604,6 +633,15 @@ def main():
                 model.plot(distMat, assignments)
 
         # use model
+        elif model.type == "refine":
+            # Edges are found directly from the distances in the network
+            # construction below
+            assignments = None
+        elif model.type != "lineage":
+            # Distances are assigned in chunks, keeping only the
+            # within-strain indices rather than every assignment
+            assignments = None
+            _, within_rows = model.assign_stream(distMat, within_label = model.within_label)
         else:
             assignments = model.assign(distMat)
 
@@ -617,7 +655,21 @@ def main():
         #* network construction       *#
         #*                            *#
         #******************************#
-        if model.type != "lineage":
+        if model.type == "refine":
+            source, target, edge_rows = model.edges(distMat, len(refList))
+            if args.graph_weights:
+                weights = process_weights(distMat[edge_rows, :], 'euclidean')
+            else:
+                weights = None
+            genomeNetwork = \
+                construct_network_from_edge_list(refList,
+                                                 queryList,
+                                                 np.column_stack((source, target)),
+                                                 weights = weights,
+                                                 sample_size = args.summary_sample,
+                                                 betweenness_sample = args.betweenness_sample,
+                                                 use_gpu = args.gpu_graph)
+        elif model.type != "lineage":
             if args.graph_weights:
                 weights_type = 'euclidean'
             else:
@@ -631,7 +683,8 @@ def main():
                                                      weights_type = weights_type,
                                                      sample_size = args.summary_sample,
                                                      betweenness_sample = args.betweenness_sample,
-                                                     use_gpu = args.gpu_graph)
+                                                     use_gpu = args.gpu_graph,
+                                                     within_rows = within_rows)
         else:
             # Lineage fit requires some iteration
             indivNetworks = {}
@@ -697,15 +750,14 @@ def main():
             indivNetworks = {}
             for dist_type, slope in zip(['core', 'accessory'], [0, 1]):
                 if args.indiv_refine == 'both' or args.indiv_refine == dist_type:
-                    indivAssignments = model.assign(distMat, slope = slope)
+                    source, target, _ = model.edges(distMat, len(refList), slope = slope)
                     indivNetworks[dist_type] = \
-                        construct_network_from_assignments(refList,
-                                                             queryList,
-                                                             indivAssignments,
-                                                             model.within_label,
-                                                             sample_size = args.summary_sample,
-                                                             betweenness_sample = args.betweenness_sample,
-                                                             use_gpu = args.gpu_graph)
+                        construct_network_from_edge_list(refList,
+                                                         queryList,
+                                                         np.column_stack((source, target)),
+                                                         sample_size = args.summary_sample,
+                                                         betweenness_sample = args.betweenness_sample,
+                                                         use_gpu = args.gpu_graph)
                     isolateClustering[dist_type] = \
                         printClusters(indivNetworks[dist_type],
                                       refList,
@@ -768,6 +820,7 @@ def main():
                     removeFromDB(args.ref_db, output, names_to_remove)
                     os.rename(output + "/" + os.path.basename(output) + '.tmp.h5',
                               output + "/" + os.path.basename(output) + db_suffix)
+        distMat.close()
 
     sys.stderr.write("\nDone\n")
 
@@ -378,6 +378,7 @@ def assign_query_hdf5(dbFuncs,
     from .sketchlib import addRandom
 
     from .utils import storePickle
+    from .utils import appendDistanceSegments
     from .utils import readPickle
     from .utils import update_distance_matrices
     from .utils import createOverallLineage
@@ -758,8 +759,11 @@ def assign_query_hdf5(dbFuncs,
             if output != model.outPrefix and fit_type == 'default':
                 model.copy(output)
 
+            # Append the new query distances to the reference distances
             combined_seq = rNames + qNames
-            storePickle(combined_seq, combined_seq, True, None, dists_out)
+            if fit_type == 'default':
+                appendDistanceSegments(distances, dists_out, rNames, qNames,
+                                       qrDistMat, qqDistMat)
 
             # Clique pruning
             if model.type != 'lineage' and os.path.isfile(ref_file_name):
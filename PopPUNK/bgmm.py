@@ -45,6 +45,63 @@ def fit2dMultiGaussian(X, dpgmm_max_K = 2):
     return dpgmm
 
 
+def weightedRefit2dGaussians(X, sample_weight, weights, means, covars, n_iter = 10, min_covar = 1.e-6):
+    """Re-estimate a fitted 2D mixture with weighted samples
+
+    :func:`~fit2dMultiGaussian` cannot use sample weights, so when it is fitted to
+    a weighted coreset (from :func:`~PopPUNK.utils.coresetRows`) the mixture
+    is then refined with EM steps in which each sample counts by its weight
+
+    Args:
+        X (numpy.array)
+            n x 2 array of scaled core and accessory distances
+        sample_weight (numpy.array)
+            Number of distances represented by each row of X
+        weights (numpy.array)
+            Component weights from :func:`~fit2dMultiGaussian`
+        means (numpy.array)
+            Component means from :func:`~fit2dMultiGaussian`
+        covars (numpy.array)
+            Component covariances from :func:`~fit2dMultiGaussian`
+        n_iter (int)
+            Number of EM iterations
+            (default = 10)
+        min_covar (float)
+            Regularisation added to the diagonal of each covariance
+            (default = 1.e-6)
+
+    Returns:
+        weights (numpy.array)
+            Re-estimated component weights
+        means (numpy.array)
+            Re-estimated component means
+        covars (numpy.array)
+            Re-estimated component covariances
+    """
+    X = np.asarray(X, dtype = np.float64)
+    sample_weight = np.asarray(sample_weight, dtype = np.float64)
+    weights = np.array(weights, dtype = np.float64)
+    means = np.array(means, dtype = np.float64)
+    covars = np.array(covars, dtype = np.float64)
+    eps = 10 * np.finfo(np.float64).eps
+    for iteration in range(n_iter):
+        precisions, log_dets = precompute2dGaussians(covars)
+        log_prob = log2dGaussianDensity(X, means, precisions, log_dets) + \
+            np.log(np.maximum(weights, eps))
+        resp = np.exp(log_prob - sp_logsumexp(log_prob, axis = 1)[:, np.newaxis])
+        resp *= sample_weight[:, np.newaxis]
+
+        nk = resp.sum(axis = 0) + eps
+        weights = nk / nk.sum()
+        means = np.dot(resp.T, X) / nk[:, np.newaxis]
+        for k in range(len(weights)):
+            diff = X - means[k]
+            covars[k] = np.dot(resp[:, k] * diff.T, diff) / nk[k]
+            covars[k].flat[::3] += min_covar
+
+    return weights, means, covars
+
+
 def findBetweenLabel_bgmm(means, assignments):
     """Identify between-strain links
 
@@ -121,7 +178,8 @@ def log_likelihood(X, weights, means, covars, scale):
             The components of the log probability from each mixture component
     """
 
-    lpr = (log_multivariate_normal_density(X/scale, means, covars) +
+    precisions, log_dets = precompute2dGaussians(covars)
+    lpr = (log2dGaussianDensity(X/scale, means, precisions, log_dets) +
                 np.log(weights))
     logprob = sp_logsumexp(lpr, axis=1)
 
@@ -174,3 +232,165 @@ def log_multivariate_normal_density(X, means, covars, min_covar=1.e-7):
     return log_prob
 
 
+
+
+def precompute2dGaussians(covars, min_covar=1.e-7):
+    """Inverses and log-determinants of 2D mixture component covariances
+
+    These are in closed form for 2x2 matrices, so are calculated once when
+    the model is fitted or loaded, rather than factorising each
+    covariance for every block of distances assigned
+
+    Args:
+        covars (numpy.array)
+            K x 2 x 2 component covariances from :func:`~fit2dMultiGaussian`
+        min_covar (float)
+            Minimum covariance, added when a covariance is not positive-definite
+            due to too few observations (default = 1.e-7)
+
+    Returns:
+        precisions (numpy.array)
+            K x 2 x 2 inverse covariances
+        log_dets (numpy.array)
+            K-vector of the log-determinants of the covariances
+    """
+    covars = np.array(covars, dtype=np.float64)
+    # As with the Cholesky factorisation, only the lower triangle is used
+    var_x = covars[:, 0, 0]
+    var_y = covars[:, 1, 1]
+    cov_xy = covars[:, 1, 0]
+    det = var_x * var_y - cov_xy ** 2
+    not_pd = (var_x <= 0) | (det <= 0)
+    if np.any(not_pd):
+        var_x = np.where(not_pd, var_x + min_covar, var_x)
+        var_y = np.where(not_pd, var_y + min_covar, var_y)
+        det = var_x * var_y - cov_xy ** 2
+        if np.any((var_x <= 0) | (det <= 0)):
+            raise ValueError("'covars' must be symmetric, "
+                             "positive-definite")
+
+    precisions = np.empty_like(covars)
+    precisions[:, 0, 0] = var_y / det
+    precisions[:, 1, 1] = var_x / det
+    precisions[:, 0, 1] = -cov_xy / det
+    precisions[:, 1, 0] = -cov_xy / det
+
+    return(precisions, np.log(det))
+
+
+def log2dGaussianDensity(X, means, precisions, log_dets):
+    """Log likelihood of each 2D mixture component, in closed form
+
+    Equivalent to :func:`~log_multivariate_normal_density`, using
+    the output of :func:`~precompute2dGaussians`
+
+    Args:
+        X (numpy.array)
+            n x 2 array of scaled core and accessory distances for n samples
+        means (numpy.array)
+            Component means from :func:`~fit2dMultiGaussian`
+        precisions (numpy.array)
+            Inverse covariances from :func:`~precompute2dGaussians`
+        log_dets (numpy.array)
+            Log-determinants from :func:`~precompute2dGaussians`
+
+    Returns:
+        log_prob (numpy.array)
+            An n x K array with the log-likelihoods for each sample being in
+            each component
+    """
+    log_prob = np.empty((X.shape[0], len(means)))
+    for c in range(len(means)):
+        log_prob[:, c] = component2dLogDensity(X[:, 0], X[:, 1], means[c],
+                                               precisions[c], log_dets[c])
+    return log_prob
+
+
+def component2dLogDensity(x, y, mean, precision, log_det):
+    """Log likelihood of a single 2D Gaussian component
+
+    Args:
+        x (numpy.array)
+            Scaled core distances
+        y (numpy.array)
+            Scaled accessory distances
+        mean (numpy.array)
+            Component mean
+        precision (numpy.array)
+            2 x 2 inverse covariance of the component
+        log_det (float)
+            Log-determinant of the component covariance
+
+    Returns:
+        log_prob (numpy.array)
+            Log-likelihood of each point
+    """
+    dx = x - mean[0]
+    dy = y - mean[1]
+    mahalanobis = precision[0, 0] * dx * dx
+    mahalanobis += 2 * precision[0, 1] * dx * dy
+    mahalanobis += precision[1, 1] * dy * dy
+    return -.5 * (mahalanobis + 2 * np.log(2 * np.pi) + log_det)
+
+
+def assign2dGaussians(X, weights, means, precisions, log_dets, scale, values=False):
+    """Assign distances to the most likely 2D mixture component
+
+    All components are evaluated on the whole block of distances at once,
+    keeping only the best component so far unless the
+    responsibilities are needed. Used by :func:`~PopPUNK.models.assign_samples`
+
+    Args:
+        X (numpy.array)
+            n x 2 array of core and accessory distances for n samples
+        weights (numpy.array)
+            Component weights from :func:`~fit2dMultiGaussian`
+        means (numpy.array)
+            Component means from :func:`~fit2dMultiGaussian`
+        precisions (numpy.array)
+            Inverse covariances from :func:`~precompute2dGaussians`
+        log_dets (numpy.array)
+            Log-determinants from :func:`~precompute2dGaussians`
+        scale (numpy.array)
+            Scaling of core and accessory distances
+        values (bool)
+            Whether to return the responsibilities, rather than the most
+            likely assignment
+
+    Returns:
+        y (numpy.array)
+            n-vector of most likely components (int8, if there are few enough
+            components), or an n x K array of responsibilities in the type of X
+    """
+    X = X / scale
+    if values:
+        lpr = log2dGaussianDensity(X, means, precisions, log_dets) + np.log(weights)
+        logprob = sp_logsumexp(lpr, axis=1)
+        return np.exp(lpr - logprob[:, np.newaxis]).astype(X.dtype, copy=False)
+
+    log_weights = np.log(weights)
+    labels = np.zeros(X.shape[0], dtype=componentLabelType(len(weights)))
+    best = np.full(X.shape[0], -np.inf)
+    for c in range(len(means)):
+        lpr = component2dLogDensity(X[:, 0], X[:, 1], means[c],
+                                    precisions[c], log_dets[c]) + log_weights[c]
+        better = lpr > best
+        labels[better] = c
+        np.maximum(best, lpr, out=best)
+    return labels
+
+
+def componentLabelType(n_components):
+    """Smallest integer type to hold mixture component labels
+
+    Args:
+        n_components (int)
+            Number of mixture components
+
+    Returns:
+        dtype (numpy.dtype)
+            int8 if possible, otherwise int64
+    """
+    if n_components <= np.iinfo(np.int8).max:
+        return np.dtype(np.int8)
+    return np.dtype(np.int64)
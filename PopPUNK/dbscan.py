@@ -6,6 +6,9 @@
 # universal
 import os
 import sys
+# additional
+import numpy as np
+from sklearn.neighbors import KDTree
 # hdbscan
 import hdbscan
 
@@ -23,8 +26,8 @@ def fitDbScan(X, min_samples, min_cluster_size, cache_out, use_gpu = False):
             Parameter for DBSCAN clustering 'conservativeness'
         min_cluster_size (int)
             Minimum number of points in a cluster for HDBSCAN
-        cache_out (str)
-            Prefix for DBSCAN cache used for refitting
+        cache_out (str or None)
+            Prefix for DBSCAN cache used for refitting, or None to not cache
         use_gpu (bool)
             Whether GPU algorithms should be used in DBSCAN fitting
 
@@ -51,12 +54,14 @@ def fitDbScan(X, min_samples, min_cluster_size, cache_out, use_gpu = False):
       n_clusters = len(cp.unique(labels[labels>-1]))
     else:
       sys.stderr.write('Fitting HDBSCAN model using a CPU\n')
+      # Refits of saved models are not cached
+      cache_args = {} if cache_out is None else {'memory': cache_out}
       hdb = hdbscan.HDBSCAN(algorithm='boruvka_balltree',
                        min_samples = min_samples,
                        #core_dist_n_jobs = threads, # may cause error, see #19
-                       memory = cache_out,
                        prediction_data = True,
-                       min_cluster_size = min_cluster_size
+                       min_cluster_size = min_cluster_size,
+                       **cache_args
                        ).fit(X)
       # Number of clusters in labels, ignoring noise if present.
       labels = hdb.labels_
@@ -66,6 +71,130 @@ def fitDbScan(X, min_samples, min_cluster_size, cache_out, use_gpu = False):
     return hdb, labels, n_clusters
 
 
+def predictionArrays(hdb, fit_X, min_samples):
+    """Extract the arrays :func:`hdbscan.approximate_predict` uses from a fitted model
+
+    Stores the condensed tree, the core distances of the fitted points and the
+    selected clusters (in label order) as plain arrays, so assignment with
+    :func:`~approximatePredict` does not need the HDBSCAN object.
+
+    Args:
+        hdb (hdbscan.HDBSCAN or cuml.cluster.HDBSCAN)
+            Fitted HDBSCAN with a condensed tree
+        fit_X (numpy.array)
+            The points the model was fitted to
+        min_samples (int)
+            The min_samples parameter of the fit
+
+    Returns:
+        prediction (dict)
+            Arrays used by :func:`~approximatePredict`
+    """
+    raw_tree = hdb.condensed_tree_._raw_tree
+    prediction_data = getattr(hdb, 'prediction_data_', None)
+    if prediction_data is not None and hasattr(prediction_data, 'reverse_cluster_map'):
+        selected = [prediction_data.reverse_cluster_map[label]
+                    for label in sorted(prediction_data.reverse_cluster_map)]
+        core_distances = prediction_data.core_distances
+    else:
+        selected = sorted(hdb.condensed_tree_._select_clusters())
+        core_distances = KDTree(np.asarray(fit_X, dtype = np.float64)).query(
+            fit_X, k = min_samples)[0][:, -1]
+
+    prediction = {'tree_parent': np.asarray(raw_tree['parent'], dtype = np.int64),
+                  'tree_child': np.asarray(raw_tree['child'], dtype = np.int64),
+                  'tree_lambda': np.asarray(raw_tree['lambda_val'], dtype = np.float64),
+                  'tree_child_size': np.asarray(raw_tree['child_size'], dtype = np.int64),
+                  'core_distances': np.asarray(core_distances, dtype = np.float64),
+                  'selected_clusters': np.asarray(selected, dtype = np.int64)}
+    return prediction
+
+def approximatePredict(X, fit_X, prediction, min_samples, tree = None):
+    """Assign new points to the clusters of a fitted HDBSCAN model
+
+    Gives the same labels as :func:`hdbscan.approximate_predict`, using the
+    arrays saved by :func:`~predictionArrays` rather than the HDBSCAN object.
+    Each point joins the cluster of its nearest fitted point under the mutual
+    reachability distance, or an ancestor of it if the point would only
+    join that cluster at a lower density.
+
+    Args:
+        X (numpy.array)
+            n x 2 array of scaled core and accessory distances to assign
+        fit_X (numpy.array)
+            The points the model was fitted to
+        prediction (dict)
+            Arrays from :func:`~predictionArrays`
+        min_samples (int)
+            The min_samples parameter of the fit
+        tree (sklearn.neighbors.KDTree)
+            Nearest neighbour tree of fit_X, built if not given
+
+    Returns:
+        labels (numpy.array)
+            Cluster assignments of each point, -1 for noise
+    """
+    X = np.asarray(X, dtype = np.float64)
+    labels = np.full(X.shape[0], -1, dtype = np.intp)
+    tree_parent = prediction['tree_parent']
+    tree_child = prediction['tree_child']
+    tree_lambda = prediction['tree_lambda']
+    cluster_rows = prediction['tree_child_size'] > 1
+    if X.shape[0] == 0 or not np.any(cluster_rows):
+        return labels
+
+    # Nearest fitted point by mutual reachability distance
+    if tree is None:
+        tree = KDTree(np.asarray(fit_X, dtype = np.float64))
+    neighbor_distances, neighbor_indices = tree.query(X, k = 2 * min_samples)
+    core_distances = prediction['core_distances'][neighbor_indices]
+    point_core_distances = neighbor_distances[:, [min_samples]]
+    mr_distances = np.maximum(np.maximum(core_distances, point_core_distances),
+                              neighbor_distances)
+    nearest_col = np.argmin(mr_distances, axis = 1)
+    rows = np.arange(X.shape[0])
+    nearest = neighbor_indices[rows, nearest_col]
+    min_mr = mr_distances[rows, nearest_col]
+    lambdas = np.full(X.shape[0], np.finfo(np.float64).max)
+    np.divide(1.0, min_mr, out = lambdas, where = min_mr > 0)
+
+    # Where each fitted point and cluster leaves its parent in the condensed tree
+    n_points = fit_X.shape[0]
+    root = tree_parent.min()
+    point_rows = tree_child < n_points
+    point_parent = np.zeros(n_points, dtype = np.int64)
+    point_parent[tree_child[point_rows]] = tree_parent[point_rows]
+    point_lambda = np.zeros(n_points, dtype = np.float64)
+    point_lambda[tree_child[point_rows]] = tree_lambda[point_rows]
+    n_nodes = max(tree_parent.max(), tree_child[cluster_rows].max()) - root + 1
+    cluster_parent = np.full(n_nodes, root, dtype = np.int64)
+    cluster_parent[tree_child[cluster_rows] - root] = tree_parent[cluster_rows]
+    cluster_lambda = np.zeros(n_nodes, dtype = np.float64)
+    cluster_lambda[tree_child[cluster_rows] - root] = tree_lambda[cluster_rows]
+
+    # Move up the tree until the new point is dense enough to be in the cluster
+    clusters = point_parent[nearest]
+    climbing = point_lambda[nearest] > lambdas
+    while True:
+        climbing &= clusters > root
+        climbing[climbing] = cluster_lambda[clusters[climbing] - root] >= lambdas[climbing]
+        if not np.any(climbing):
+            break
+        clusters[climbing] = cluster_parent[clusters[climbing] - root]
+
+    # Clusters below a selected cluster take its label
+    cluster_labels = np.full(n_nodes, -1, dtype = np.intp)
+    cluster_labels[prediction['selected_clusters'] - root] = np.arange(prediction['selected_clusters'].shape[0])
+    subclusters = tree_child[cluster_rows] - root
+    subcluster_parents = tree_parent[cluster_rows] - root
+    while True:
+        inherit = (cluster_labels[subclusters] == -1) & (cluster_labels[subcluster_parents] != -1)
+        if not np.any(inherit):
+            break
+        cluster_labels[subclusters[inherit]] = cluster_labels[subcluster_parents[inherit]]
+    labels[:] = cluster_labels[clusters - root]
+    return labels
+
 def evaluate_dbscan_clusters(model):
     """Evaluate whether fitted dbscan model contains non-overlapping clusters
 
@@ -61,6 +61,7 @@ def main():
     from .network import print_network_summary
     from .utils import check_and_set_gpu
     from .utils import setGtThreads
+    from .sketchlib import readSketchMetadata
 
     # Check input ok
     args = get_options()
@@ -135,15 +136,11 @@ def main():
 
     # Print sample information
     if not args.simple:
-        sample_names = list(ref_db['sketches'].keys())
-        sample_sequence_length = {}
-        sample_missing_bases = {}
-        sample_base_frequencies = {name: [] for name in sample_names}
-
-        for sample_name in sample_names:
-            sample_base_frequencies[sample_name] = ref_db['sketches/' + sample_name].attrs['base_freq']
-            sample_sequence_length[sample_name] = ref_db['sketches/' + sample_name].attrs['length']
-            sample_missing_bases[sample_name] = ref_db['sketches/' + sample_name].attrs['missing_bases']
+        metadata = readSketchMetadata(h5_fn)
+        sample_names = metadata['names']
+        sample_sequence_length = dict(zip(sample_names, metadata['length'].tolist()))
+        sample_missing_bases = dict(zip(sample_names, metadata['missing_bases'].tolist()))
+        sample_base_frequencies = dict(zip(sample_names, metadata['base_freq'].tolist()))
 
         # Analyse network
         if use_gpu:
@@ -173,7 +173,7 @@ def create_db(args):
     else:
         distances = args.distances
     # Get distances
-    rlist, qlist, self, X = readPickle(distances, enforce_self=False, distances=True)
+    rlist, qlist, self, X = readPickle(distances, enforce_self=False, distances=True, mmap=True)
     # Get parameters
     kmers, sketch_sizes, codon_phased = readDBParams(args.create_db)
     # Ranks to use
@@ -281,6 +281,8 @@ def create_db(args):
             # Save model
             model.save()
 
+    X.close()
+
     # Print combined strain and lineage clustering
     print_overall_clustering(overall_lineage,args.output + '.csv',rlist)
 
@@ -19,6 +19,49 @@ except ImportError:
 
 from .utils import readPickle
 
+def get_kNN_distances_tiled(distMat, kNN, tile_size = 4096):
+    """Find the k nearest neighbours of each sample from a square distance
+    matrix, reading a block of rows at a time
+
+    Equivalent to ``poppunk_refine.get_kNN_distances``, but
+    without copying the whole matrix into memory.
+
+    Args:
+        distMat (numpy.array)
+            n x n distance matrix, typically memory-mapped
+        kNN (int)
+            Number of neighbours for each sample (at most n - 1 are returned)
+        tile_size (int)
+            Number of rows to read at once
+            (default = 4096)
+
+    Returns:
+        I (numpy.array)
+            Index of each sample
+        J (numpy.array)
+            Index of each neighbour, in increasing order of distance
+        dists (numpy.array)
+            Distance between each pair
+    """
+    n = distMat.shape[0]
+    kNN = min(kNN, n - 1)
+    I = np.repeat(np.arange(n, dtype = np.int64), kNN)
+    J = np.zeros(n * kNN, dtype = np.int64)
+    dists = np.zeros(n * kNN, dtype = np.float32)
+    for start in range(0, n, tile_size):
+        end = min(start + tile_size, n)
+        tile = np.array(distMat[start:end, :], dtype = np.float32)
+        # exclude self-matches
+        rows = np.arange(end - start)
+        tile[rows, start + rows] = np.inf
+        nearest = np.argpartition(tile, kNN - 1, axis = 1)[:, :kNN]
+        nearest_dists = np.take_along_axis(tile, nearest, axis = 1)
+        order = np.argsort(nearest_dists, axis = 1, kind = 'stable')
+        J[(start * kNN):(end * kNN)] = np.take_along_axis(nearest, order, axis = 1).ravel()
+        dists[(start * kNN):(end * kNN)] = np.take_along_axis(nearest_dists, order, axis = 1).ravel()
+
+    return I, J, dists
+
 def generate_embedding(seqLabels, accMat, perplexity, outPrefix, overwrite, kNN = 50,
                        maxIter = 10000000, n_threads = 1, use_gpu = False, device_id = 0):
     """Generate t-SNE projection using accessory distances
@@ -30,6 +73,8 @@ def generate_embedding(seqLabels, accMat, perplexity, outPrefix, overwrite, kNN
             Processed names of sequences being analysed.
         accMat (numpy.array)
             n x n array of accessory distances for n samples.
+            May be memory-mapped, in which case nearest neighbours are
+            found a block of rows at a time.
         perplexity (int)
             Perplexity parameter passed to t-SNE
         outPrefix (str)
@@ -64,7 +109,10 @@ def generate_embedding(seqLabels, accMat, perplexity, outPrefix, overwrite, kNN
     else:
         sys.stderr.write("Running mandrake\n")
         kNN = max(kNN, len(seqLabels) - 1)
-        I, J, dists = poppunk_refine.get_kNN_distances(accMat, kNN, 1, n_threads)
+        if isinstance(accMat, np.memmap):
+            I, J, dists = get_kNN_distances_tiled(accMat, kNN)
+        else:
+            I, J, dists = poppunk_refine.get_kNN_distances(accMat, kNN, 1, n_threads)
 
         # Set up function call with either CPU or GPU
         weights = np.ones((len(seqLabels)))
@@ -8,17 +8,18 @@ import os
 import sys
 # additional
 import numpy as np
-import random
 import pickle
 import shutil
 import re
-from sklearn import utils
 import scipy.optimize
 from scipy import stats
 import scipy.sparse
+import h5py
 import hdbscan
+from sklearn.neighbors import KDTree
 
 # Parallel support
+import threading
 from tqdm import tqdm
 from tqdm.contrib.concurrent import thread_map, process_map
 from functools import partial
@@ -43,24 +44,31 @@ try:
 except ImportError:
     pass
 
-import pp_sketchlib
 import poppunk_refine
 
 from .__main__ import betweenness_sample_default
 
 from .utils import set_env
 from .utils import check_and_set_gpu
+from .utils import sampleRows
+from .utils import coresetRows
+from .utils import DistanceStore
 
 # BGMM
 from .bgmm import fit2dMultiGaussian
+from .bgmm import weightedRefit2dGaussians
 from .bgmm import findWithinLabel
 from .bgmm import findBetweenLabel_bgmm
-from .bgmm import log_likelihood
+from .bgmm import precompute2dGaussians
+from .bgmm import assign2dGaussians
+from .bgmm import componentLabelType
 from .plot import plot_results
 from .plot import plot_contours
 
 # DBSCAN
 from .dbscan import fitDbScan
+from .dbscan import predictionArrays
+from .dbscan import approximatePredict
 from .dbscan import findBetweenLabel
 from .dbscan import evaluate_dbscan_clusters
 from .plot import plot_dbscan_results
@@ -68,16 +76,31 @@ from .plot import plot_dbscan_results
 # refine
 from .refine import refineFit, multi_refine
 from .refine import readManualStart
+from .refine import NetworkScoreCache
 from .plot import plot_refined_results
 
 # lineage
 from .plot import distHistogram
 epsilon = 1e-10
 
+# Cells along each axis of the assignment grid, and the label used for
+# cells on a decision boundary
+raster_resolution = 512
+raster_boundary = np.iinfo(np.int16).min
+raster_batch_size = 100000
+raster_edge_samples = 4
+raster_verify_samples = 100000
+raster_component_samples = 10000
+raster_compact_sd = 8
+raster_compact_cells = 8
+
 # Format for rank fits
 def rankFile(rank):
     return('_rank_' + str(rank) + '_fit.npz')
 
+# Single file containing the nearest neighbours and all ranks of a lineage fit
+lineage_archive_suffix = '_lineage_fit.h5'
+
 def loadClusterFit(pkl_file, npz_file, outPrefix = "", max_samples = 100000,
                    use_gpu = False):
     '''Call this to load a fitted model
@@ -109,9 +132,18 @@ def loadClusterFit(pkl_file, npz_file, outPrefix = "", max_samples = 100000,
         # file name processing
         fit_file = os.path.basename(pkl_file)
         prefix = re.match(r"^(.+)_fit\.pkl$", fit_file)
-        rank_file = os.path.dirname(pkl_file) + "/" + \
-                      prefix.group(1) + '_sparse_dists.npz'
-        fit_data = scipy.sparse.load_npz(rank_file)
+        archive_file = os.path.dirname(pkl_file) + "/" + \
+                      prefix.group(1) + lineage_archive_suffix
+        if os.path.isfile(archive_file):
+            fit_data = archive_file
+        else:
+            # Models saved before the archive only have the nearest neighbours
+            rank_file = os.path.dirname(pkl_file) + "/" + \
+                          prefix.group(1) + '_sparse_dists.npz'
+            if not os.path.isfile(rank_file):
+                raise RuntimeError("Lineage model " + pkl_file + " has neither " +
+                                   archive_file + " nor " + rank_file)
+            fit_data = scipy.sparse.load_npz(rank_file)
     else:
         fit_data = np.load(npz_file)
 
@@ -141,9 +173,9 @@ def assign_samples(chunk, X, y, model, scale, chunk_size, values = False):
     Args:
         chunk (int)
             Index of chunk to process
-        X (NumpyShared)
+        X (NumpyShared, numpy.array or DistanceStore)
             n x 2 array of core and accessory distances for n samples
-        y (NumpyShared)
+        y (NumpyShared or numpy.array)
             An n-vector to store results, with the most likely cluster memberships
             or an n by k matrix with the component responsibilities for each sample.
         weights (numpy.array)
@@ -178,18 +210,48 @@ def assign_samples(chunk, X, y, model, scale, chunk_size, values = False):
         if start >= end:
             raise RuntimeError("start >= end in BGMM assign")
 
-        if isinstance(model, BGMMFit):
-            logprob, lpr = log_likelihood(X[start:end, :], model.weights,
-                                          model.means, model.covariances, scale)
-            responsibilities = np.exp(lpr - logprob[:, np.newaxis])
-            # Default to return the most likely cluster
-            if values == False:
-                y[start:end] = responsibilities.argmax(axis=1)
-            # Can return the actual responsibilities
-            else:
-                y[start:end, :] = responsibilities
+        if model.raster is not None and values == False:
+            y[start:end] = model.raster_assign(X[start:end, :], scale)
+        elif isinstance(model, BGMMFit):
+            # Default to return the most likely cluster, but
+            # can return the actual responsibilities
+            y[start:end] = assign2dGaussians(X[start:end, :], model.weights,
+                                             model.means, model.precisions,
+                                             model.log_dets, scale, values)
         elif isinstance(model, DBSCANFit):
-            y[start:end] = hdbscan.approximate_predict(model.hdb, X[start:end, :]/scale)[0]
+            y[start:end] = model.exact_assign(X[start:end, :]/scale)
+
+# Model held by each process of a pool started by DBSCANFit.assign_stream
+pool_model = None
+
+def set_pool_model(model):
+    """Pool initializer which keeps a copy of the model in each process,
+    so it is not sent with every chunk
+
+    Args:
+        model (DBSCANFit)
+            Model to assign with
+    """
+    global pool_model
+    pool_model = model
+
+def assign_pool_samples(X, scale):
+    """Assign a block of distances with the model from :func:`~set_pool_model`
+
+    Args:
+        X (numpy.array)
+            n x 2 array of core and accessory distances
+        scale (numpy.array)
+            Scaling of core and accessory distances
+
+    Returns:
+        y (numpy.array)
+            Cluster assignments by samples
+    """
+    with set_env(MKL_NUM_THREADS='1',
+                 NUMEXPR_NUM_THREADS='1',
+                 OMP_NUM_THREADS='1'):
+        return pool_model.exact_assign(X/scale)
 
 
 class ClusterFit:
@@ -213,6 +275,9 @@ class ClusterFit:
         self.indiv_fitted = False
         self.default_dtype = default_dtype
         self.threads = 1
+        self.raster = None
+        self.coreset = False
+        self.sample_weight = None
 
     def set_threads(self, threads):
         self.threads = threads
@@ -220,7 +285,8 @@ class ClusterFit:
     def fit(self, X = None):
         '''Initial steps for all fit functions.
 
-        Creates output directory. If preprocess is set then subsamples passed X
+        Creates output directory. If preprocess is set then subsamples passed X,
+        at random or as a weighted coreset (if coreset is set)
 
         Args:
             X (numpy.array)
@@ -244,10 +310,11 @@ class ClusterFit:
 
         # preprocess subsampling
         if self.preprocess:
-            if X.shape[0] > self.max_samples:
-                self.subsampled_X = utils.shuffle(X, random_state=random.randint(1,10000))[0:self.max_samples,]
+            if self.coreset:
+                self.subsampled_X, self.sample_weight = coresetRows(X, self.max_samples)
             else:
-                self.subsampled_X = np.copy(X)
+                self.subsampled_X = sampleRows(X, self.max_samples)
+                self.sample_weight = None
 
             # perform scaling
             self.scale = np.amax(self.subsampled_X, axis = 0)
@@ -267,6 +334,164 @@ class ClusterFit:
         if not self.fitted:
             raise RuntimeError("Trying to plot unfitted model")
 
+    def assign_stream(self, X, within_label = None, label_file = None, chunk_size = None, **kwargs):
+        '''Assign distances one chunk at a time, so that memory use is bounded
+        by the chunk size rather than the number of distances
+
+        Args:
+            X (numpy.array or DistanceStore)
+                Core and accessory distances, which may be on disk
+            within_label (int)
+                If set, return the indices of distances with this label
+            label_file (str)
+                If set, write all the labels to this .npy file as int8
+            chunk_size (int)
+                Number of distances to assign at once
+                (default is the chunk size of X)
+            kwargs
+                Passed to the model's ``assign``
+
+        Returns:
+            labels (numpy.memmap)
+                Cluster assignments by samples, open from label_file
+                (None if no label_file)
+            within_rows (numpy.array)
+                Indices of the distances assigned within_label
+                (None if no within_label)
+        '''
+        if not isinstance(X, DistanceStore):
+            X = DistanceStore(X)
+        labels = None
+        if label_file is not None:
+            labels = np.lib.format.open_memmap(label_file, mode = 'w+',
+                                               dtype = np.int8, shape = (X.shape[0],))
+        within_rows = []
+        for start, block in X.iter_rows(chunk_size):
+            y = self.assign(block, progress = False, **kwargs)
+            if labels is not None:
+                if y.min(initial = 0) < np.iinfo(np.int8).min or y.max(initial = 0) > np.iinfo(np.int8).max:
+                    raise RuntimeError("Too many clusters to store assignments as int8")
+                labels[start:(start + block.shape[0])] = y
+            if within_label is not None:
+                within_rows.append(start + np.flatnonzero(y == within_label))
+
+        if labels is not None:
+            labels.flush()
+        if within_label is not None:
+            within_rows = np.concatenate(within_rows) if len(within_rows) > 0 \
+                else np.zeros(0, dtype = np.int64)
+        else:
+            within_rows = None
+        return labels, within_rows
+
+    def bake_raster(self, resolution = raster_resolution, edge_samples = raster_edge_samples,
+                    verify_X = None, boundary_boxes = None):
+        '''Precompute the assignment of each cell in a grid over the
+        scaled distances [0, 1) x [0, 1), used by :func:`~ClusterFit.raster_assign`
+
+        A cell is given the label of its centre if all the points sampled along
+        its edges have the same label, otherwise it straddles a decision boundary.
+        Cells next to a boundary cell are also marked, so that boundaries which
+        enter and leave through the same edge between samples are still caught.
+        Points in boundary cells are assigned exactly. Subclasses provide the
+        exact assignment as ``exact_assign``.
+
+        Args:
+            resolution (int)
+                Number of cells along each axis
+            edge_samples (int)
+                Number of intervals each cell edge is sampled at
+            verify_X (numpy.array)
+                Scaled distances to check the grid against. If any are given
+                a different label by the grid than by ``exact_assign`` the grid
+                is not used
+            boundary_boxes (numpy.array)
+                n x 2 x 2 array of the lower and upper corners of scaled regions
+                which are always assigned exactly, such as components smaller
+                than a cell
+
+        Returns:
+            verified (bool)
+                Whether the grid was kept
+        '''
+        def exactLabels(x, y):
+            points = np.column_stack((x.ravel(), y.ravel()))
+            labels = np.concatenate([self.exact_assign(points[start:(start + raster_batch_size), :])
+                                     for start in range(0, points.shape[0], raster_batch_size)])
+            return labels.reshape(x.shape)
+
+        edges = np.arange(resolution + 1, dtype = np.float64) / resolution
+        centres = (np.arange(resolution, dtype = np.float64) + 0.5) / resolution
+        along = np.arange(resolution * edge_samples + 1, dtype = np.float64) / (resolution * edge_samples)
+        raster = exactLabels(*np.meshgrid(centres, centres, indexing = 'ij'))
+        # Labels along lines of constant x, and lines of constant y
+        x_lines = exactLabels(*np.meshgrid(edges, along, indexing = 'ij'))
+        y_lines = exactLabels(*np.meshgrid(along, edges, indexing = 'ij'))
+
+        boundary = np.zeros(raster.shape, dtype = bool)
+        for offset in range(edge_samples + 1):
+            x_edge = x_lines[:, offset::edge_samples][:, :resolution]
+            y_edge = y_lines[offset::edge_samples, :][:resolution, :]
+            boundary |= (x_edge[:-1, :] != raster) | (x_edge[1:, :] != raster) | \
+                        (y_edge[:, :-1] != raster) | (y_edge[:, 1:] != raster)
+
+        if boundary_boxes is not None:
+            box_cells = np.clip(np.floor(np.asarray(boundary_boxes) * resolution).astype(np.int64),
+                                0, resolution - 1)
+            for (lo_x, lo_y), (hi_x, hi_y) in box_cells:
+                boundary[lo_x:(hi_x + 1), lo_y:(hi_y + 1)] = True
+
+        # Dilate by one cell
+        padded = np.pad(boundary, 1)
+        for dx in range(3):
+            for dy in range(3):
+                boundary |= padded[dx:(dx + resolution), dy:(dy + resolution)]
+
+        self.raster = raster.astype(np.int16)
+        self.raster[boundary] = raster_boundary
+
+        verified = True
+        if verify_X is not None:
+            cells = np.floor(verify_X * resolution).astype(np.int64)
+            in_grid = np.all((cells >= 0) & (cells < resolution), axis = 1)
+            looked_up = self.raster[cells[in_grid, 0], cells[in_grid, 1]]
+            on_grid = looked_up != raster_boundary
+            if np.any(on_grid):
+                exact = self.exact_assign(verify_X[in_grid, :][on_grid, :])
+                verified = np.array_equal(looked_up[on_grid], exact)
+            if not verified:
+                sys.stderr.write("Precomputed assignment grid does not match the model, "
+                                 "assigning exactly\n")
+                self.raster = None
+        return verified
+
+    def raster_assign(self, X, scale):
+        '''Assign distances using the grid from :func:`~ClusterFit.bake_raster`
+
+        Distances outside the grid, or in a cell on a decision boundary,
+        are assigned exactly.
+
+        Args:
+            X (numpy.array)
+                Core and accessory distances
+            scale (numpy.array)
+                Scaling of the core and accessory distances
+
+        Returns:
+            y (numpy.array)
+                Cluster assignments by samples
+        '''
+        resolution = self.raster.shape[0]
+        cells = np.floor(X * (resolution / scale)).astype(np.int64)
+        in_grid = np.all((cells >= 0) & (cells < resolution), axis = 1)
+        y = np.full(X.shape[0], raster_boundary, dtype = self.raster.dtype)
+        y[in_grid] = self.raster[cells[in_grid, 0], cells[in_grid, 1]]
+
+        exact = y == raster_boundary
+        if np.any(exact):
+            y[exact] = self.exact_assign(X[exact, :] / scale)
+        return y
+
     def no_scale(self):
         '''Turn off scaling (useful for refine, where optimization
         is done in the scaled space).
@@ -292,15 +517,20 @@ class BGMMFit(ClusterFit):
         max_samples (int)
             The number of subsamples to fit the model to
             (default = 100000)
+        coreset (bool)
+            Subsample with a weighted coreset rather than at random
+            (default = False)
     '''
 
-    def __init__(self, outPrefix, max_samples = 100000, max_batch_size = 100000, assign_points = True):
+    def __init__(self, outPrefix, max_samples = 100000, max_batch_size = 100000, assign_points = True,
+                 coreset = False):
         ClusterFit.__init__(self, outPrefix)
         self.type = 'bgmm'
         self.preprocess = True
         self.max_samples = max_samples
         self.max_batch_size = max_batch_size
         self.assign_points = assign_points
+        self.coreset = coreset
 
     def fit(self, X, max_components):
         '''Extends :func:`~ClusterFit.fit`
@@ -322,10 +552,16 @@ class BGMMFit(ClusterFit):
                 Cluster assignments of samples in X
         '''
         ClusterFit.fit(self, X)
+        self.raster = None
         self.dpgmm = fit2dMultiGaussian(self.subsampled_X, max_components)
         self.weights = self.dpgmm.weights_
         self.means = self.dpgmm.means_
         self.covariances = self.dpgmm.covariances_
+        if self.sample_weight is not None:
+            self.weights, self.means, self.covariances = \
+                weightedRefit2dGaussians(self.subsampled_X, self.sample_weight,
+                                         self.weights, self.means, self.covariances)
+        self.precisions, self.log_dets = precompute2dGaussians(self.covariances)
         self.fitted = True
         
         # Allow for partial fitting that only assigns the subsample not the full set
@@ -343,7 +579,12 @@ class BGMMFit(ClusterFit):
         if not self.fitted:
             raise RuntimeError("Trying to save unfitted model")
         else:
+            if self.raster is None:
+                self.bake_raster(verify_X = self.raster_verify_points(),
+                                 boundary_boxes = self.compact_components())
+            raster = {} if self.raster is None else {'raster': self.raster}
             np.savez(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_fit.npz',
+             **raster,
              weights=self.weights,
              means=self.means,
              covariances=self.covariances,
@@ -354,6 +595,37 @@ class BGMMFit(ClusterFit):
                 pickle.dump([self.dpgmm, self.type], pickle_file)
 
 
+    def compact_components(self):
+        '''Regions around components too small to be found by the sampling in
+        :func:`~ClusterFit.bake_raster`, which are always assigned exactly
+
+        Returns:
+            boxes (numpy.array)
+                n x 2 x 2 array of the lower and upper corners of a box
+                reaching raster_compact_sd standard deviations from the mean
+                of each compact component
+        '''
+        sd = raster_compact_sd * np.sqrt(np.diagonal(self.covariances, axis1 = 1, axis2 = 2))
+        compact = np.all(sd < raster_compact_cells / raster_resolution, axis = 1)
+        return np.stack((self.means - sd, self.means + sd), axis = 1)[compact]
+
+    def raster_verify_points(self):
+        '''Scaled distances to check the grid from :func:`~ClusterFit.bake_raster`
+        against: the fitted subsample, points drawn from each component and
+        points spread over the whole grid
+
+        Returns:
+            verify_X (numpy.array)
+                n x 2 array of scaled distances
+        '''
+        rng = np.random.default_rng(0)
+        verify_X = [rng.random((raster_verify_samples, 2))]
+        if getattr(self, 'subsampled_X', None) is not None:
+            verify_X.append(np.asarray(self.subsampled_X, dtype = np.float64))
+        for mean, covariance in zip(self.means, self.covariances):
+            verify_X.append(rng.multivariate_normal(mean, covariance, raster_component_samples))
+        return np.vstack(verify_X)
+
     def load(self, fit_npz, fit_obj):
         '''Load the model from disk. Called from :func:`~loadClusterFit`
 
@@ -367,12 +639,31 @@ class BGMMFit(ClusterFit):
         self.weights = fit_npz['weights']
         self.means = fit_npz['means']
         self.covariances = fit_npz['covariances']
+        self.precisions, self.log_dets = precompute2dGaussians(self.covariances)
         self.scale = fit_npz['scale']
         self.within_label = fit_npz['within'].item()
         self.between_label = fit_npz['between'].item()
+        if 'raster' in fit_npz.keys():
+            self.raster = fit_npz['raster']
         self.fitted = True
 
 
+    def exact_assign(self, X):
+        '''Assign scaled distances to the most likely component, without
+        using the grid from :func:`~ClusterFit.bake_raster`
+
+        Args:
+            X (numpy.array)
+                Scaled core and accessory distances
+
+        Returns:
+            y (numpy.array)
+                Cluster assignments by samples
+        '''
+        return assign2dGaussians(X, self.weights, self.means, self.precisions,
+                                 self.log_dets, np.ones(2, dtype = X.dtype))
+
+
     def plot(self, X, y):
         '''Extends :func:`~ClusterFit.plot`
 
@@ -388,7 +679,7 @@ class BGMMFit(ClusterFit):
         ClusterFit.plot(self, X)
         # Generate a subsampling if one was not used in the fit
         if not hasattr(self, 'subsampled_X'):
-            self.subsampled_X = utils.shuffle(X, random_state=random.randint(1,10000))[0:self.max_samples,]
+            self.subsampled_X = sampleRows(X, self.max_samples)
 
         y_subsample = self.assign(self.subsampled_X, max_batch_size = self.max_batch_size, values=True, progress=False)
         avg_entropy = np.mean(np.apply_along_axis(stats.entropy, 1,
@@ -409,10 +700,10 @@ class BGMMFit(ClusterFit):
 
 
     def assign(self, X, max_batch_size = 100000, values = False, progress=True):
-        '''Assign the clustering of new samples using :func:`~PopPUNK.bgmm.assign_samples`
+        '''Assign the clustering of new samples using :func:`~PopPUNK.bgmm.assign2dGaussians`
 
         Args:
-            X (numpy.array)
+            X (numpy.array or DistanceStore)
                 Core and accessory distances
             values (bool)
                 Return the responsibilities of assignment rather than most likely cluster
@@ -435,31 +726,20 @@ class BGMMFit(ClusterFit):
             if values:
                 y = np.zeros((X.shape[0], len(self.weights)), dtype=X.dtype)
             else:
-                y = np.zeros(X.shape[0], dtype=int)
+                y = np.zeros(X.shape[0], dtype=componentLabelType(len(self.weights)))
+            # Threads share X and y directly, so each only reads its own
+            # block of distances (from disk, if X is a DistanceStore)
             block_size = max_batch_size
-            with SharedMemoryManager() as smm:
-                shm_X = smm.SharedMemory(size = X.nbytes)
-                X_shared_array = np.ndarray(X.shape, dtype = X.dtype, buffer = shm_X.buf)
-                X_shared_array[:] = X[:]
-                X_shared = NumpyShared(name = shm_X.name, shape = X.shape, dtype = X.dtype)
-
-                shm_y = smm.SharedMemory(size = y.nbytes)
-                y_shared_array = np.ndarray(y.shape, dtype = y.dtype, buffer = shm_y.buf)
-                y_shared_array[:] = y[:]
-                y_shared = NumpyShared(name = shm_y.name, shape = y.shape, dtype = y.dtype)
-
-                thread_map(partial(assign_samples,
-                                           X = X_shared,
-                                           y = y_shared,
-                                           model = self,
-                                           scale = self.scale,
-                                           chunk_size = block_size,
-                                           values = values),
-                                    range((X.shape[0] - 1) // block_size + 1),
-                                    max_workers=self.threads,
-                                    disable=(progress == False))
-
-                y[:] = y_shared_array[:]
+            thread_map(partial(assign_samples,
+                                       X = X,
+                                       y = y,
+                                       model = self,
+                                       scale = self.scale,
+                                       chunk_size = block_size,
+                                       values = values),
+                                range((X.shape[0] - 1) // block_size + 1),
+                                max_workers=self.threads,
+                                disable=(progress == False))
 
         return y
 
@@ -486,6 +766,58 @@ class DBSCANFit(ClusterFit):
         self.max_samples = max_samples
         self.assign_points = assign_points
         self.use_gpu = use_gpu # Updated below
+        self.prediction = None
+        self._hdb = None
+        self._hdb_lock = threading.Lock()
+        self._nn_tree = None
+
+    @property
+    def hdb(self):
+        '''The fitted HDBSCAN object. Saved models only store the points, parameters
+        and the arrays :func:`~PopPUNK.dbscan.approximatePredict` needs, so it is
+        refitted the first time it is needed (assignment only needs it with a GPU,
+        or for models saved without prediction arrays).
+
+        Raises RuntimeError if the refitted clusters differ from the saved labels,
+        which the cluster means and within/between labels refer to.
+        '''
+        with self._hdb_lock:
+            if self._hdb is None and self.fitted:
+                sys.stderr.write("Rebuilding HDBSCAN model from saved fit\n")
+                hdb = fitDbScan(self.fit_X,
+                                self.min_samples,
+                                self.min_cluster_size,
+                                None,
+                                use_gpu = self.use_gpu)[0]
+                refit_labels = hdb.labels_
+                if self.use_gpu:
+                    import cupy as cp
+                    refit_labels = cp.asnumpy(refit_labels)
+                if not np.array_equal(np.asarray(refit_labels), np.asarray(self.labels)):
+                    raise RuntimeError("Refitted HDBSCAN model does not reproduce the saved clusters")
+                self._hdb = hdb
+        return self._hdb
+
+    @hdb.setter
+    def hdb(self, hdb):
+        self._hdb = hdb
+
+    @property
+    def nn_tree(self):
+        '''Nearest neighbour tree of the fitted points, used by :func:`~DBSCANFit.exact_assign`'''
+        with self._hdb_lock:
+            if self._nn_tree is None:
+                self._nn_tree = KDTree(np.asarray(self.fit_X, dtype = np.float64))
+        return self._nn_tree
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_hdb_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._hdb_lock = threading.Lock()
 
     def fit(self, X, max_num_clusters, min_cluster_prop, use_gpu = False):
         '''Extends :func:`~ClusterFit.fit`
@@ -511,6 +843,9 @@ class DBSCANFit(ClusterFit):
                 Cluster assignments of samples in X
         '''
         ClusterFit.fit(self, X)
+        self.raster = None
+        self.prediction = None
+        self._nn_tree = None
 
         # DBSCAN parameters
         cache_out = "./" + self.outPrefix + "_cache"
@@ -546,6 +881,8 @@ class DBSCANFit(ClusterFit):
                                                                 min_cluster_size,
                                                                 cache_out,
                                                                 use_gpu = use_gpu)
+            self.min_samples = min_samples
+            self.min_cluster_size = min_cluster_size
             self.fitted = True # needed for predict
 
             # Test whether model fit contains distinct clusters
@@ -600,6 +937,11 @@ class DBSCANFit(ClusterFit):
             sys.exit(1)
         elif not use_gpu:
             shutil.rmtree(cache_out)
+            self.fit_X = self.subsampled_X
+        else:
+            self.fit_X = cp.asnumpy(self.subsampled_X)
+        self.prediction = predictionArrays(self.hdb, self.fit_X, self.min_samples)
+        self._nn_tree = None
 
         # Allow for partial fitting that only assigns the subsample not the full set
         if self.assign_points:
@@ -615,7 +957,29 @@ class DBSCANFit(ClusterFit):
         if not self.fitted:
             raise RuntimeError("Trying to save unfitted model")
         else:
+            # The grid is assigned with the CPU model. DBSCAN regions can be
+            # smaller than a cell, so the grid is only used if it assigns
+            # the fitted points and a random sample of the grid exactly
+            if self.raster is None and self.prediction is not None:
+                verify_X = np.vstack((self.fit_X,
+                                      np.random.default_rng(0).random((raster_verify_samples, 2))))
+                self.bake_raster(verify_X = verify_X)
+            raster = {} if self.raster is None else {'raster': self.raster}
+            # Rather than pickling the HDBSCAN object, store the arrays used
+            # for assignment, and what is needed to refit it, see DBSCANFit.hdb
+            prediction = {} if self.prediction is None else \
+                {'prediction_' + key: value for key, value in self.prediction.items()}
+            labels = self.labels
+            if self.use_gpu:
+                import cupy as cp
+                labels = cp.asnumpy(labels)
             np.savez(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_fit.npz',
+             **raster,
+             **prediction,
+             fit_X=self.fit_X,
+             labels=labels,
+             min_samples=self.min_samples,
+             min_cluster_size=self.min_cluster_size,
              n_clusters=self.n_clusters,
              within=self.within_label,
              between=self.between_label,
@@ -626,7 +990,7 @@ class DBSCANFit(ClusterFit):
              assign_points = self.assign_points,
              use_gpu=self.use_gpu)
             with open(self.outPrefix + "/" + os.path.basename(self.outPrefix) + '_fit.pkl', 'wb') as pickle_file:
-                pickle.dump([self.hdb, self.type], pickle_file)
+                pickle.dump([None, self.type], pickle_file)
 
 
     def load(self, fit_npz, fit_obj):
@@ -635,11 +999,28 @@ class DBSCANFit(ClusterFit):
         Args:
             fit_npz (dict)
                 Fit npz opened with :func:`numpy.load`
-            fit_obj (hdbscan.HDBSCAN)
-                The saved fit object
+            fit_obj (hdbscan.HDBSCAN or None)
+                The saved fit object, if saved by an older version
         '''
         self.hdb = fit_obj
-        self.labels = self.hdb.labels_
+        self._nn_tree = None
+        if fit_obj is None:
+            self.fit_X = fit_npz['fit_X']
+            self.labels = fit_npz['labels']
+            self.min_samples = fit_npz['min_samples'].item()
+            self.min_cluster_size = fit_npz['min_cluster_size'].item()
+            prediction_keys = [key for key in fit_npz.keys() if key.startswith('prediction_')]
+            if len(prediction_keys) > 0:
+                self.prediction = {key[len('prediction_'):]: fit_npz[key] for key in prediction_keys}
+            else:
+                # Saved by an older version, refitted when needed
+                self.prediction = None
+        else:
+            self.fit_X = self.hdb._raw_data
+            self.labels = self.hdb.labels_
+            self.min_samples = self.hdb.min_samples
+            self.min_cluster_size = self.hdb.min_cluster_size
+            self.prediction = predictionArrays(self.hdb, self.fit_X, self.min_samples)
         self.n_clusters = fit_npz['n_clusters']
         self.scale = fit_npz['scale']
         self.within_label = fit_npz['within'].item()
@@ -658,6 +1039,8 @@ class DBSCANFit(ClusterFit):
         else:
             # Default for backwards compatibility
             self.assign_points = True
+        if 'raster' in fit_npz.keys():
+            self.raster = fit_npz['raster']
         self.fitted = True
 
 
@@ -676,7 +1059,7 @@ class DBSCANFit(ClusterFit):
         ClusterFit.plot(self, X)
         # Generate a subsampling if one was not used in the fit
         if not hasattr(self, 'subsampled_X'):
-            self.subsampled_X = utils.shuffle(X, random_state=random.randint(1,10000))[0:self.max_samples,]
+            self.subsampled_X = sampleRows(X, self.max_samples)
 
         non_noise = np.sum(self.labels != -1)
         sys.stderr.write("Fit summary:\n" + "\n".join(["\tNumber of clusters\t" + str(self.n_clusters),
@@ -704,11 +1087,50 @@ class DBSCANFit(ClusterFit):
                             self.use_gpu)
 
 
-    def assign(self, X, no_scale = False, progress = True, max_batch_size = 5000, use_gpu = False):
+    def assign_stream(self, X, within_label = None, label_file = None, chunk_size = None, **kwargs):
+        '''Extends :func:`~ClusterFit.assign_stream`
+
+        Without the grid from :func:`~ClusterFit.bake_raster`, assignment runs in
+        a process pool. This is started once for the whole stream, with a copy
+        of the model in each process, rather than for each chunk.
+        '''
+        if self.raster is not None or kwargs.get('use_gpu', False):
+            return ClusterFit.assign_stream(self, X, within_label, label_file, chunk_size, **kwargs)
+
+        # Any refit, or building the neighbour tree, happens before the model is copied
+        if self.prediction is None:
+            self.hdb
+        else:
+            self.nn_tree
+        with Pool(self.threads, initializer = set_pool_model, initargs = (self,)) as pool:
+            return ClusterFit.assign_stream(self, X, within_label, label_file, chunk_size,
+                                            pool = pool, **kwargs)
+
+    def exact_assign(self, X):
+        '''Assign scaled distances with :func:`~PopPUNK.dbscan.approximatePredict`
+        (or :func:`hdbscan.approximate_predict` for models saved without its arrays),
+        without using the grid from :func:`~ClusterFit.bake_raster`
+
+        Args:
+            X (numpy.array)
+                Scaled core and accessory distances
+
+        Returns:
+            y (numpy.array)
+                Cluster assignments by samples
+        '''
+        if self.prediction is None:
+            return hdbscan.approximate_predict(self.hdb, X)[0]
+        return approximatePredict(X, self.fit_X, self.prediction, self.min_samples,
+                                  tree = self.nn_tree)
+
+
+    def assign(self, X, no_scale = False, progress = True, max_batch_size = 5000, use_gpu = False,
+               pool = None):
         '''Assign the clustering of new samples using :func:`~PopPUNK.dbscan.assign_samples_dbscan`
 
         Args:
-            X (numpy.array or cupy.array)
+            X (numpy.array, cupy.array or DistanceStore)
                 Core and accessory distances
             no_scale (bool)
                 Do not scale X
@@ -722,6 +1144,10 @@ class DBSCANFit(ClusterFit):
             use_gpu (bool)
                 Use GPU-enabled algorithms for clustering
                 [default = False]
+            pool (multiprocessing.Pool)
+                Process pool started by :func:`~DBSCANFit.assign_stream`
+                to use for exact assignment
+                [default = None]
         Returns:
             y (numpy.array)
                 Cluster assignments by samples
@@ -751,14 +1177,44 @@ class DBSCANFit(ClusterFit):
                                                                                                   X[start_index:end_index,],
                                                                                                   convert_dtype = True)
                   del y_probabilities
+            elif self.raster is not None:
+              # Most distances are looked up in the precomputed grid, so
+              # threads are used on larger blocks
+              y = np.zeros(X.shape[0], dtype=int)
+              block_size = max(block_size, raster_batch_size)
+              thread_map(partial(assign_samples,
+                                 X = X,
+                                 y = y,
+                                 model = self,
+                                 scale = scale,
+                                 chunk_size = block_size,
+                                 values = False),
+                         range((X.shape[0] - 1) // block_size + 1),
+                         max_workers=self.threads,
+                         disable=(progress == False))
+            elif pool is not None:
+              blocks = (np.asarray(X[start:(start + block_size), :])
+                        for start in range(0, X.shape[0], block_size))
+              y = np.concatenate(pool.map(partial(assign_pool_samples, scale = scale), blocks))
             else:
+              # Any refit of a saved model, or building its neighbour tree,
+              # happens once here, not in each process
+              if self.prediction is None:
+                  self.hdb
+              else:
+                  self.nn_tree
               y = np.zeros(X.shape[0], dtype=int)
               n_blocks = (X.shape[0] - 1) // block_size + 1
               with SharedMemoryManager() as smm:
-                  shm_X = smm.SharedMemory(size = X.nbytes)
-                  X_shared_array = np.ndarray(X.shape, dtype = X.dtype, buffer = shm_X.buf)
-                  X_shared_array[:] = X[:]
-                  X_shared = NumpyShared(name = shm_X.name, shape = X.shape, dtype = X.dtype)
+                  # Memory-mapped distances are reopened by each process,
+                  # otherwise copy into shared memory
+                  if isinstance(X, DistanceStore) and X.filename is not None:
+                      X_shared = X
+                  else:
+                      shm_X = smm.SharedMemory(size = X.nbytes)
+                      X_shared_array = np.ndarray(X.shape, dtype = X.dtype, buffer = shm_X.buf)
+                      X_shared_array[:] = X[:]
+                      X_shared = NumpyShared(name = shm_X.name, shape = X.shape, dtype = X.dtype)
 
                   shm_y = smm.SharedMemory(size = y.nbytes)
                   y_shared_array = np.ndarray(y.shape, dtype = y.dtype, buffer = shm_y.buf)
@@ -806,7 +1262,8 @@ class RefineFit(ClusterFit):
 
     def fit(self, X, sample_names, model, max_move, min_move, startFile = None, indiv_refine = False,
             unconstrained = False, multi_boundary = 0, score_idx = 0, no_local = False,
-            betweenness_sample = betweenness_sample_default, sample_size = None, use_gpu = False):
+            betweenness_sample = betweenness_sample_default, sample_size = None, use_gpu = False,
+            tolerance = None):
         '''Extends :func:`~ClusterFit.fit`
 
         Fits the distances by optimising network score, by calling
@@ -852,6 +1309,10 @@ class RefineFit(ClusterFit):
                 Number of nodes to subsample for graph statistic calculation
             use_gpu (bool)
                 Whether to use cugraph for graph analyses
+            tolerance (float)
+                If set, search for the boundary with an adaptive grid, refining
+                until the grid spacing is below this (in scaled distances)
+                [default = None]
 
         Returns:
             y (numpy.array)
@@ -881,8 +1342,11 @@ class RefineFit(ClusterFit):
         else:
             raise RuntimeError("Unrecognised model type")
 
+        # Networks repeated between the searches below are only scored once
+        score_cache = NetworkScoreCache()
+
         # Main refinement in 2D
-        scaled_X = X / self.scale
+        scaled_X = np.asarray(X) / self.scale
         self.optimal_x, self.optimal_y, optimal_s = \
           refineFit(scaled_X,
                     sample_names,
@@ -898,7 +1362,9 @@ class RefineFit(ClusterFit):
                     num_processes = self.threads,
                     betweenness_sample = betweenness_sample,
                     sample_size = sample_size,
-                    use_gpu = use_gpu)
+                    use_gpu = use_gpu,
+                    score_cache = score_cache,
+                    tolerance = tolerance)
         self.fitted = True
 
         # Output clusters at more positions if requested
@@ -915,7 +1381,8 @@ class RefineFit(ClusterFit):
                         num_processes = self.threads,
                         betweenness_sample = betweenness_sample,
                         sample_size = sample_size,
-                        use_gpu = use_gpu)
+                        use_gpu = use_gpu,
+                        score_cache = score_cache)
 
         # Try and do a 1D refinement for both core and accessory
         self.core_boundary = self.optimal_x
@@ -940,7 +1407,9 @@ class RefineFit(ClusterFit):
                                     num_processes = self.threads,
                                     betweenness_sample = betweenness_sample,
                                     sample_size = sample_size,
-                                    use_gpu = use_gpu)
+                                    use_gpu = use_gpu,
+                                    score_cache = score_cache,
+                                    tolerance = tolerance)
                         if dist_type == "core":
                             self.core_boundary = core_boundary
                         if dist_type == "accessory":
@@ -950,6 +1419,7 @@ class RefineFit(ClusterFit):
                 print(e)
                 sys.stderr.write("Could not separately refine core and accessory boundaries. "
                                  "Using joint 2D refinement only.\n")
+        sys.stderr.write(score_cache.summary())
         y = self.assign(X)
         return y
 
@@ -1051,10 +1521,7 @@ class RefineFit(ClusterFit):
 
         # Subsamples huge plots to save on memory
         max_points = int(0.5*(5000)**2)
-        if X.shape[0] > max_points:
-            plot_X = utils.shuffle(X, random_state=random.randint(1, 10000))[0:max_points, ]
-        else:
-            plot_X = X
+        plot_X = sampleRows(X, max_points)
 
         plot_refined_results(plot_X, self.assign(plot_X), self.optimal_x, self.optimal_y, self.core_boundary,
             self.accessory_boundary, self.mean0, self.mean1, self.min_move,
@@ -1062,16 +1529,19 @@ class RefineFit(ClusterFit):
             "Refined fit boundary", self.outPrefix + "/" + os.path.basename(self.outPrefix) + "_refined_fit")
 
 
-    def assign(self, X, slope=None):
+    def assign(self, X, slope=None, progress=True):
         '''Assign the clustering of new samples
 
         Args:
-            X (numpy.array)
+            X (numpy.array or DistanceStore)
                 Core and accessory distances
             slope (int)
                 Override self.slope. Default - use self.slope
                 Set to 0 for a vertical line, 1 for a horizontal line, or
                 2 to use a slope
+            progress (bool)
+                Not used, as assignment has no progress output. Accepted so
+                this can be called by :func:`~ClusterFit.assign_stream`
         Returns:
             y (numpy.array)
                 Cluster assignments by samples
@@ -1082,30 +1552,153 @@ class RefineFit(ClusterFit):
             if slope == None:
                 slope = self.slope
             if slope == 2:
-                y = poppunk_refine.assignThreshold(X/self.scale, 2, self.optimal_x, self.optimal_y, self.threads)
+                x_max, y_max = self.optimal_x, self.optimal_y
             elif slope == 0:
-                y = poppunk_refine.assignThreshold(X/self.scale, 0, self.core_boundary, 0, self.threads)
+                x_max, y_max = self.core_boundary, 0
             elif slope == 1:
-                y = poppunk_refine.assignThreshold(X/self.scale, 1, 0, self.accessory_boundary, self.threads)
+                x_max, y_max = 0, self.accessory_boundary
+
+            # Only one block of scaled distances is held in memory at a time
+            if not isinstance(X, DistanceStore):
+                X = DistanceStore(X)
+            y = np.zeros(X.shape[0], dtype=np.float32)
+            for start, block in X.iter_rows():
+                y[start:(start + block.shape[0])] = \
+                    poppunk_refine.assignThreshold(block/self.scale, slope, x_max, y_max, self.threads)
 
         return y
 
-# Wrapper function for LineageFit.__reduce_rank__ to be called by
-# multiprocessing threads
-def reduce_rank(lower_rank, fit, higher_rank_sparse_mat, n_samples, dtype):
-    # Only modify the matrix if the method or rank differs - otherwise save in unmodified form
-    if lower_rank==fit.max_search_depth and fit.reciprocal_only is False and fit.count_unique_distances is False:
-        fit.__save_sparse__(higher_rank_sparse_mat[2],
-                       higher_rank_sparse_mat[0],
-                       higher_rank_sparse_mat[1],
-                       lower_rank,
-                       n_samples,
-                       dtype)
-    else:
-      fit.__reduce_rank__(higher_rank_sparse_mat,
-                          lower_rank,
-                          n_samples,
-                          dtype)
+    def edges(self, X, num_ref, self_dists = True, int_offset = 0, slope = None):
+        '''Find the within-strain edges directly from the distances, without
+        an intermediate vector of assignments
+
+        Args:
+            X (numpy.array or DistanceStore)
+                Core and accessory distances
+            num_ref (int)
+                Number of reference sequences
+            self_dists (bool)
+                Whether X contains ref-ref distances (True), or
+                query-ref distances (False)
+            int_offset (int)
+                Constant integer to add to each node index
+            slope (int)
+                Override self.slope. Default - use self.slope
+                Set to 0 for a vertical line, 1 for a horizontal line, or
+                2 to use a slope
+        Returns:
+            source (numpy.array)
+                Lower node index of each edge (int32)
+            target (numpy.array)
+                Higher node index of each edge (int32)
+            rows (numpy.array)
+                Index of the distance in X for each edge
+        '''
+        if not self.fitted:
+            raise RuntimeError("Trying to assign using an unfitted model")
+        if slope == None:
+            slope = self.slope
+        if slope == 2:
+            x_max, y_max = self.optimal_x, self.optimal_y
+        elif slope == 0:
+            x_max, y_max = self.core_boundary, 0
+        elif slope == 1:
+            x_max, y_max = 0, self.accessory_boundary
+
+        if not isinstance(X, DistanceStore):
+            X = DistanceStore(X)
+        sources = []
+        targets = []
+        rows = []
+        for start, block in X.iter_rows():
+            block_source, block_target, block_rows = \
+                poppunk_refine.thresholdEdges(block/self.scale,
+                                              slope, x_max, y_max,
+                                              self = self_dists,
+                                              num_ref = num_ref,
+                                              row_offset = start,
+                                              int_offset = int_offset,
+                                              num_threads = self.threads)
+            sources.append(block_source)
+            targets.append(block_target)
+            rows.append(start + block_rows)
+
+        if len(rows) == 0:
+            return np.zeros(0, dtype = np.int32), np.zeros(0, dtype = np.int32), \
+                np.zeros(0, dtype = np.int64)
+        return np.concatenate(sources), np.concatenate(targets), np.concatenate(rows)
+
+# Order the nearest neighbours found by poppunk_refine.updateKNN
+def sort_kNN_heaps(heap_dists, heap_idx):
+    '''Sort each sample's nearest neighbours by distance, then index,
+    which is the order get_kNN_distances gives
+
+    Args:
+        heap_dists (numpy.array)
+            n x k distances, inf where there is no neighbour
+        heap_idx (numpy.array)
+            n x k neighbour indices, -1 where there is no neighbour
+
+    Returns:
+        dists (numpy.array)
+            Sorted n x k distances
+        idx (numpy.array)
+            Sorted n x k neighbour indices
+    '''
+    order = np.lexsort((heap_idx, heap_dists), axis = 1)
+    return np.take_along_axis(heap_dists, order, axis = 1), \
+        np.take_along_axis(heap_idx, order, axis = 1)
+
+def merge_kNN(first_dists, first_idx, second_dists, second_idx, kNN):
+    '''Merge two sorted lists of nearest neighbours for each sample, keeping
+    the nearest kNN. Where distances are tied, neighbours in the first list
+    come first
+
+    Args:
+        first_dists (numpy.array)
+            Sorted distances to the first neighbours of each sample
+        first_idx (numpy.array)
+            Indices of the first neighbours
+        second_dists (numpy.array)
+            Sorted distances to the second neighbours of each sample
+        second_idx (numpy.array)
+            Indices of the second neighbours
+        kNN (int)
+            Number of neighbours to keep
+
+    Returns:
+        dists (numpy.array)
+            n x kNN distances, inf where there is no neighbour
+        idx (numpy.array)
+            n x kNN neighbour indices
+    '''
+    dists = np.concatenate((first_dists, second_dists), axis = 1)
+    idx = np.concatenate((first_idx, second_idx), axis = 1)
+    order = np.argsort(dists, axis = 1, kind = 'stable')[:, :kNN]
+    return np.take_along_axis(dists, order, axis = 1), \
+        np.take_along_axis(idx, order, axis = 1)
+
+def kNN_to_coo(dists, idx):
+    '''Convert n x k nearest neighbours to sparse (row, col, data) vectors,
+    skipping missing neighbours
+
+    Args:
+        dists (numpy.array)
+            n x k distances, inf where there is no neighbour
+        idx (numpy.array)
+            n x k neighbour indices
+
+    Returns:
+        row, col, data (numpy.array)
+            Sparse matrix of the nearest neighbours
+    '''
+    row = np.repeat(np.arange(dists.shape[0], dtype = np.int64), dists.shape[1])
+    col = idx.ravel()
+    data = dists.ravel()
+    if np.any(col < 0):
+        found = col >= 0
+        row, col, data = row[found], col[found], data[found]
+    return row, col, data
 
 class LineageFit(ClusterFit):
     '''Class for fits using the lineage assignment model. Inherits from :class:`ClusterFit`.
@@ -1128,6 +1721,7 @@ class LineageFit(ClusterFit):
                                                    # when there is redundancy (e.g. reciprocal matching, unique distance counting)
                                                    # or other sequences may be pruned out of the database
         self.nn_dists = None # stores the unprocessed kNN at the maximum search depth
+        self.rank_lengths = None # number of each sample's kNN kept at each rank
         self.ranks = []
         for rank in sorted(ranks):
             if (rank < 1):
@@ -1135,55 +1729,73 @@ class LineageFit(ClusterFit):
                 sys.exit(0)
             else:
                 self.ranks.append(int(rank))
-        self.lower_rank_dists = {}
+        self.lower_rank_dists = {} # ranks made from nn_dists so far
         self.reciprocal_only = reciprocal_only
         self.count_unique_distances = count_unique_distances
         self.dist_col = dist_col
         self.use_gpu = use_gpu
 
-    def __save_sparse__(self, data, row, col, rank, n_samples, dtype, is_nn_dist = False):
-        '''Save a sparse matrix in coo format
+    def __save_sparse__(self, data, row, col, n_samples, dtype):
+        '''Save the nearest neighbours in coo format, and find which of
+        them are kept at each rank
         '''
-        if self.use_gpu:
-            data = cp.array(data)
-            data[data < epsilon] = epsilon
-            if is_nn_dist:
-                self.nn_dists = cupyx.scipy.sparse.coo_matrix((data, (cp.array(row), cp.array(col))),
-                                                    shape=(n_samples, n_samples),
-                                                    dtype = dtype)
-            else:
-                self.lower_rank_dists[rank] = cupyx.scipy.sparse.coo_matrix((data, (cp.array(row), cp.array(col))),
-                                                    shape=(n_samples, n_samples),
-                                                    dtype = dtype)
-        else:
-            data = np.array(data)
-            data[data < epsilon] = epsilon
-            if is_nn_dist:
-                self.nn_dists = scipy.sparse.coo_matrix((data, (row, col)),
-                                                    shape=(n_samples, n_samples),
-                                                    dtype = dtype)
-            else:
-                self.lower_rank_dists[rank] = scipy.sparse.coo_matrix((data, (row, col)),
-                                                    shape=(n_samples, n_samples),
-                                                    dtype = dtype)
-
-    def __reduce_rank__(self, higher_rank_sparse_mat, lower_rank, n_samples, dtype):
-        '''Lowers the rank of a fit and saves it
-        '''
-        lower_rank_sparse_mat = \
-            poppunk_refine.lowerRank(
-                higher_rank_sparse_mat,
+        self.rank_lengths = \
+            poppunk_refine.rankPrefixLengths(
+                (row, col, data),
                 n_samples,
-                lower_rank,
-                self.reciprocal_only,
+                self.ranks,
                 self.count_unique_distances,
                 self.threads)
-        self.__save_sparse__(lower_rank_sparse_mat[2],
-                             lower_rank_sparse_mat[0],
-                             lower_rank_sparse_mat[1],
-                             lower_rank,
-                             n_samples,
-                             dtype)
+        self.lower_rank_dists = {}
+
+        data = np.array(data)
+        data[data < epsilon] = epsilon
+        self.nn_dists = scipy.sparse.coo_matrix((data, (row, col)),
+                                                shape=(n_samples, n_samples),
+                                                dtype = dtype)
+        if self.use_gpu:
+            self.nn_dists = cupyx.scipy.sparse.coo_matrix(self.nn_dists)
+
+    def rank_dists(self, rank):
+        '''Get the sparse distance matrix at a rank, which is made from
+        the nearest neighbours the first time it is needed
+
+        Args:
+            rank (int)
+                Rank to get
+        Returns:
+            rank_mat (scipy or cupyx coo_matrix)
+                The distances to each sample's neighbours at this rank
+        '''
+        if rank not in self.lower_rank_dists:
+            if self.use_gpu:
+                row, col, data = cp.asnumpy(self.nn_dists.row), \
+                    cp.asnumpy(self.nn_dists.col), cp.asnumpy(self.nn_dists.data)
+            else:
+                row, col, data = self.nn_dists.row, self.nn_dists.col, self.nn_dists.data
+            row = np.asarray(row)
+            n_samples = self.nn_dists.shape[0]
+
+            # Each rank keeps a prefix of each sample's neighbours
+            row_start = np.searchsorted(row, row, side = 'left')
+            row_pos = np.arange(len(row)) - row_start
+            keep = (row_pos < np.asarray(self.rank_lengths)[row, self.ranks.index(rank)]) & \
+                (col != row)
+            row, col, data = row[keep], np.asarray(col)[keep], np.asarray(data)[keep]
+            if self.reciprocal_only:
+                # Only keep i < j where j also has i as a neighbour
+                key = row.astype(np.int64) * n_samples + col
+                reverse_key = col.astype(np.int64) * n_samples + row
+                keep = (row < col) & np.isin(key, reverse_key[row > col])
+                row, col, data = row[keep], col[keep], data[keep]
+
+            rank_mat = scipy.sparse.coo_matrix((data, (row, col)),
+                                               shape=(n_samples, n_samples),
+                                               dtype = self.nn_dists.dtype)
+            if self.use_gpu:
+                rank_mat = cupyx.scipy.sparse.coo_matrix(rank_mat)
+            self.lower_rank_dists[rank] = rank_mat
+        return self.lower_rank_dists[rank]
 
     def fit(self, X, accessory):
         '''Extends :func:`~ClusterFit.fit`
@@ -1213,45 +1825,60 @@ class LineageFit(ClusterFit):
         else:
             self.dist_col = 0
 
-        row, col, data = \
-            poppunk_refine.get_kNN_distances(
-                distMat=pp_sketchlib.longToSquare(distVec=X[:, [self.dist_col]],
-                                                  num_threads=self.threads),
-                kNN=self.max_search_depth,
-                dist_col=self.dist_col,
-                num_threads=self.threads
-            )
-        self.__save_sparse__(data, row, col, self.max_search_depth, sample_size, X.dtype,
-                              is_nn_dist = True)
-
-        # Apply filtering of links if requested and extract lower ranks - parallelisation within C++ code
-        for rank in self.ranks:
-            reduce_rank(
-              rank,
-              fit=self,
-              higher_rank_sparse_mat=(row, col, data),
-              n_samples=sample_size,
-              dtype=X.dtype
-            )
+        # Keep the nearest neighbours of each sample while streaming through the
+        # long form distances, rather than converting them to a square matrix
+        if not isinstance(X, DistanceStore):
+            X = DistanceStore(X)
+        heap_dists = np.full((sample_size, self.max_search_depth), np.inf, dtype = np.float32)
+        heap_idx = np.full((sample_size, self.max_search_depth), -1, dtype = np.int64)
+        for start, block in X.iter_rows():
+            poppunk_refine.updateKNN(np.ascontiguousarray(block, dtype = np.float32),
+                                     heap_dists,
+                                     heap_idx,
+                                     dist_col = self.dist_col,
+                                     row_offset = start,
+                                     n_samples = sample_size,
+                                     num_threads = self.threads)
+
+        row, col, data = kNN_to_coo(*sort_kNN_heaps(heap_dists, heap_idx))
+        del heap_dists, heap_idx
+        # All ranks are found in one pass, and filtered when first used
+        self.__save_sparse__(data, row, col, sample_size, X.dtype)
 
         self.fitted = True
         y = self.assign(min(self.ranks))
         return y
 
     def save(self):
-        '''Save the model to disk, as an npz and pkl (using outPrefix).'''
+        '''Save the model to disk, as an h5 archive and pkl (using outPrefix).
+
+        The archive holds the nearest neighbours and the number kept at each
+        rank, uncompressed so it can be memory-mapped by :func:`~LineageFit.load`.
+        Each rank is also written as a sparse matrix npz, for use by other tools.'''
         if not self.fitted:
             raise RuntimeError("Trying to save unfitted model")
         else:
-            scipy.sparse.save_npz(
-                    self.outPrefix + "/" + os.path.basename(self.outPrefix) + \
-                    '_sparse_dists.npz',
-                    self.nn_dists)
+            if self.use_gpu:
+                nn_row, nn_col, nn_data = cp.asnumpy(self.nn_dists.row), \
+                    cp.asnumpy(self.nn_dists.col), cp.asnumpy(self.nn_dists.data)
+            else:
+                nn_row, nn_col, nn_data = self.nn_dists.row, self.nn_dists.col, self.nn_dists.data
+            with h5py.File(self.outPrefix + "/" + os.path.basename(self.outPrefix) + \
+                           lineage_archive_suffix, 'w') as archive:
+                archive.attrs['n_samples'] = self.nn_dists.shape[0]
+                archive.attrs['ranks'] = self.ranks
+                archive.create_dataset('row', data = np.asarray(nn_row))
+                archive.create_dataset('col', data = np.asarray(nn_col))
+                archive.create_dataset('data', data = np.asarray(nn_data))
+                archive.create_dataset('rank_lengths', data = np.asarray(self.rank_lengths))
             for rank in self.ranks:
+                rank_mat = self.rank_dists(rank)
+                if self.use_gpu:
+                    rank_mat = rank_mat.get()
                 scipy.sparse.save_npz(
                     self.outPrefix + "/" + os.path.basename(self.outPrefix) + \
                     rankFile(rank),
-                    self.lower_rank_dists[rank])
+                    rank_mat)
             with open(self.outPrefix + "/" + os.path.basename(self.outPrefix) + \
                       '_fit.pkl', 'wb') as pickle_file:
                 pickle.dump([[self.ranks,
@@ -1265,14 +1892,39 @@ class LineageFit(ClusterFit):
     def load(self, fit_npz, fit_obj):
         '''Load the model from disk. Called from :func:`~loadClusterFit`
 
+        The arrays in the archive are memory-mapped, and each rank is
+        only made when it is first used
+
         Args:
-            fit_npz (dict)
-                Fit npz opened with :func:`numpy.load`
-            fit_obj (sklearn.mixture.BayesianGaussianMixture)
-                The saved fit object
+            fit_npz (str or scipy.sparse.coo_matrix)
+                Location of the archive written by :func:`~LineageFit.save`,
+                or the nearest neighbours of models saved without one
+            fit_obj (list)
+                The saved fit parameters
         '''
         self.ranks, self.max_search_depth, self.reciprocal_only, self.count_unique_distances, self.dist_col = fit_obj
-        self.nn_dists = fit_npz
+        if isinstance(fit_npz, str):
+            with h5py.File(fit_npz, 'r') as archive:
+                n_samples = int(archive.attrs['n_samples'])
+                fit_arrays = {}
+                for name in ['row', 'col', 'data', 'rank_lengths']:
+                    dset = archive[name]
+                    offset = dset.id.get_offset()
+                    if offset is None:
+                        fit_arrays[name] = dset[...]
+                    else:
+                        fit_arrays[name] = np.memmap(fit_npz, dtype = dset.dtype, mode = 'r',
+                                                     offset = offset, shape = dset.shape)
+            self.rank_lengths = fit_arrays['rank_lengths']
+            self.lower_rank_dists = {}
+            self.nn_dists = scipy.sparse.coo_matrix((fit_arrays['data'],
+                                                     (fit_arrays['row'], fit_arrays['col'])),
+                                                    shape = (n_samples, n_samples))
+            if self.use_gpu:
+                self.nn_dists = cupyx.scipy.sparse.coo_matrix(self.nn_dists)
+        else:
+            self.__save_sparse__(fit_npz.data, fit_npz.row, fit_npz.col,
+                                 fit_npz.shape[0], fit_npz.dtype)
         self.fitted = True
 
     def plot(self, X, y = None):
@@ -1291,9 +1943,9 @@ class LineageFit(ClusterFit):
         ClusterFit.plot(self, X)
         for rank in self.ranks:
             if self.use_gpu:
-                hist_data = self.lower_rank_dists[rank].get().data
+                hist_data = self.rank_dists(rank).get().data
             else:
-                hist_data = self.lower_rank_dists[rank].data
+                hist_data = self.rank_dists(rank).data
             distHistogram(hist_data,
                               rank,
                               self.outPrefix + "/" + os.path.basename(self.outPrefix))
@@ -1307,15 +1959,17 @@ class LineageFit(ClusterFit):
             rank (int)
                 Rank to assign at
         Returns:
-            y (list of tuples)
-                Edges to include in network
+            y (numpy or cupy array)
+                Two column int32 array of the edges to include in network
         '''
         if not self.fitted:
             raise RuntimeError("Trying to assign using an unfitted model")
         else:
-            y = []
-            for row, col in zip(self.lower_rank_dists[rank].row, self.lower_rank_dists[rank].col):
-                y.append((row, col))
+            xp = cp if self.use_gpu else np
+            rank_mat = self.rank_dists(rank)
+            y = xp.empty((rank_mat.nnz, 2), dtype = np.int32)
+            y[:, 0] = rank_mat.row
+            y[:, 1] = rank_mat.col
 
         return y
 
@@ -1326,65 +1980,95 @@ class LineageFit(ClusterFit):
             rank (int)
                 Rank assigned at
         Returns:
-            weights (list)
-                Distance for each assignment
+            weights (numpy or cupy array)
+                Distance for each edge
         '''
         if not self.fitted:
             raise RuntimeError("Trying to get weights from an unfitted model")
         else:
-            return (self.lower_rank_dists[rank].data)
+            return (self.rank_dists(rank).data)
 
     def extend(self, qqDists, qrDists):
         '''Update the sparse distance matrix of nearest neighbours after querying
 
+        The long form distances are read a chunk at a time, keeping only the
+        nearest neighbours of each sample, which are then merged with the
+        existing sparse matrix
+
         Args:
-            qqDists (numpy or cupy ndarray)
+            qqDists (numpy.array or DistanceStore)
                 Two column array of query-query distances
-            qqDists (numpy or cupy ndarray)
+            qrDists (numpy.array or DistanceStore)
                 Two column array of reference-query distances
 
         Returns:
-            y (list of tuples)
-                Edges to include in network
+            y (numpy or cupy array)
+                Two column int32 array of the edges to include in network
         '''
-
-        # Convert data structures if using GPU
-        if self.use_gpu:
-            qqDists = cp.array(qqDists)
-            qrDists = cp.array(qrDists)
-
-        # Reshape qq and qr dist matrices
-        qqSquare = pp_sketchlib.longToSquare(distVec=qqDists[:, [self.dist_col]],
-                                             num_threads=self.threads)
-        qqSquare[qqSquare < epsilon] = epsilon
-
+        if not isinstance(qqDists, DistanceStore):
+            qqDists = DistanceStore(qqDists)
+        if not isinstance(qrDists, DistanceStore):
+            qrDists = DistanceStore(qrDists)
+        kNN = self.max_search_depth
         n_ref = self.nn_dists.shape[0]
-        n_query = qqSquare.shape[1]
-        qrRect = qrDists[:, [self.dist_col]].reshape(n_query, n_ref).T
-        qrRect[qrRect < epsilon] = epsilon
-
-        higher_rank = \
-          poppunk_refine.extend(
-            (self.nn_dists.row, self.nn_dists.col, self.nn_dists.data),
-            qqSquare,
-            qrRect,
-            self.max_search_depth,
-            self.threads)
-
-        # Update NN dist associated with model
+        n_query = qrDists.shape[0] // n_ref
+
+        # New neighbours of the references (from the queries), and of
+        # the queries (from the other queries and from the references)
+        ref_dists = np.full((n_ref, kNN), np.inf, dtype = np.float32)
+        ref_idx = np.full((n_ref, kNN), -1, dtype = np.int64)
+        qq_dists = np.full((n_query, kNN), np.inf, dtype = np.float32)
+        qq_idx = np.full((n_query, kNN), -1, dtype = np.int64)
+        qr_dists = np.full((n_query, kNN), np.inf, dtype = np.float32)
+        qr_idx = np.full((n_query, kNN), -1, dtype = np.int64)
+        for start, block in qqDists.iter_rows():
+            poppunk_refine.updateKNN(np.maximum(block, epsilon, dtype = np.float32),
+                                     qq_dists,
+                                     qq_idx,
+                                     dist_col = self.dist_col,
+                                     row_offset = start,
+                                     n_samples = n_query,
+                                     num_threads = self.threads)
+        for start, block in qrDists.iter_rows():
+            poppunk_refine.updateKNNRect(np.maximum(block, epsilon, dtype = np.float32),
+                                         ref_dists,
+                                         ref_idx,
+                                         qr_dists,
+                                         qr_idx,
+                                         dist_col = self.dist_col,
+                                         row_offset = start,
+                                         n_ref = n_ref,
+                                         num_threads = self.threads)
+        qq_idx[qq_idx >= 0] += n_ref
+
+        # Existing neighbours of the references, which are already sorted
+        if self.use_gpu:
+            nn_row, nn_col, nn_data = cp.asnumpy(self.nn_dists.row), \
+                cp.asnumpy(self.nn_dists.col), cp.asnumpy(self.nn_dists.data)
+        else:
+            nn_row, nn_col, nn_data = self.nn_dists.row, self.nn_dists.col, self.nn_dists.data
+        row_order = np.argsort(nn_row, kind = 'stable')
+        nn_row = nn_row[row_order]
+        row_pos = np.arange(len(nn_row)) - \
+            np.searchsorted(nn_row, nn_row, side = 'left')
+        in_kNN = row_pos < kNN
+        old_dists = np.full((n_ref, kNN), np.inf, dtype = np.float32)
+        old_idx = np.full((n_ref, kNN), -1, dtype = np.int64)
+        old_dists[nn_row[in_kNN], row_pos[in_kNN]] = nn_data[row_order][in_kNN]
+        old_idx[nn_row[in_kNN], row_pos[in_kNN]] = nn_col[row_order][in_kNN]
+
+        # Queries come first where distances are tied
+        ref_dists, ref_idx = merge_kNN(*sort_kNN_heaps(ref_dists, ref_idx),
+                                       old_dists, old_idx, kNN)
+        query_dists, query_idx = merge_kNN(*sort_kNN_heaps(qq_dists, qq_idx),
+                                           *sort_kNN_heaps(qr_dists, qr_idx), kNN)
+        del old_dists, old_idx, qq_dists, qq_idx, qr_dists, qr_idx
+        higher_rank = kNN_to_coo(np.concatenate((ref_dists, query_dists)),
+                                 np.concatenate((ref_idx, query_idx)))
+
+        # Update NN dist associated with model, and all ranks
         self.__save_sparse__(higher_rank[2], higher_rank[0], higher_rank[1],
-                             self.max_search_depth, n_ref + n_query, self.nn_dists.dtype,
-                             is_nn_dist = True)
-
-        # Apply lower ranks - parallelisation within C++ code
-        for rank in self.ranks:
-            reduce_rank(
-              rank,
-              fit=self,
-              higher_rank_sparse_mat=higher_rank,
-              n_samples=n_ref + n_query,
-              dtype=self.nn_dists.dtype
-            )
+                             n_ref + n_query, self.nn_dists.dtype)
         y = self.assign(min(self.ranks))
         return y
 
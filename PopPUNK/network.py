@@ -14,7 +14,6 @@ from scipy.stats import rankdata
 from collections import defaultdict, Counter
 from functools import partial
 from multiprocessing import Pool
-import pickle
 import graph_tool.all as gt
 
 # Load GPU libraries
@@ -35,9 +34,10 @@ from .__main__ import betweenness_sample_default
 
 from .sketchlib import addRandom
 
-from .utils import iterDistRows
 from .utils import readIsolateTypeFromCsv
 from .utils import check_and_set_gpu
+from .utils import SampleIndex
+from .utils import distRowsToEdges
 
 from .unwords import gen_unword
 
@@ -497,15 +497,12 @@ def network_to_edges(prev_G_fn, rlist, adding_qq_dists = False,
     else:
         prev_G = prev_G_fn
 
-    # load list of names in previous network if pkl name supplied
+    # load index of names in previous network if pkl name supplied
     if previous_pkl is not None:
-        with open(previous_pkl, 'rb') as pickle_file:
-            old_rlist, old_qlist, self = pickle.load(pickle_file)
-        if self:
-            old_ids = old_rlist
-        else:
-            old_ids = old_rlist + old_qlist
-    elif old_ids is None:
+        old_index = SampleIndex.from_distance_pickle(previous_pkl, persist = True)
+    elif old_ids is not None:
+        old_index = SampleIndex(old_ids)
+    else:
         sys.stderr.write('Missing .pkl file containing names of sequences in '
                          'previous network\n')
         sys.exit(1)
@@ -526,8 +523,8 @@ def network_to_edges(prev_G_fn, rlist, adding_qq_dists = False,
         old_target_ids = G_df['destination'].astype('int32').to_arrow().to_pylist()
     else:
         # get the source and target nodes
-        old_source_ids = gt.edge_endpoint_property(prev_G, prev_G.vertex_index, "source")
-        old_target_ids = gt.edge_endpoint_property(prev_G, prev_G.vertex_index, "target")
+        old_source_ids = gt.edge_endpoint_property(prev_G, prev_G.vertex_index, "source").a
+        old_target_ids = gt.edge_endpoint_property(prev_G, prev_G.vertex_index, "target").a
         # get the weights
         if weights:
             if prev_G.edge_properties.keys() is None or 'weight' not in prev_G.edge_properties.keys():
@@ -543,16 +540,18 @@ def network_to_edges(prev_G_fn, rlist, adding_qq_dists = False,
         source_ids = old_source_ids
         target_ids = old_target_ids
     else:
-        try:
-            # Update IDs to new versions
-            old_id_indices = [rlist.index(x) for x in old_ids]
-            # translate to indices
-            source_ids = [old_id_indices[x] for x in old_source_ids]
-            target_ids = [old_id_indices[x] for x in old_target_ids]
-        except ValueError:
-            sys.stderr.write(f"Network size mismatch. Previous network nodes: {max(old_id_indices)}."
-                             f"New network nodes: {max(old_source_ids.a)}/{max(old_target_ids.a)}\n")
+        # Map each old vertex to the position of its name in the new list
+        new_positions = old_index.lookup(rlist)
+        in_old = np.flatnonzero(new_positions >= 0)
+        old_id_indices = np.full(len(old_index), -1, dtype = np.int64)
+        old_id_indices[new_positions[in_old]] = in_old
+        if np.any(old_id_indices < 0):
+            sys.stderr.write(f"Network size mismatch. Previous network nodes: {len(old_index)}. "
+                             f"Nodes found in new network: {len(in_old)}\n")
             sys.exit(1)
+        # translate to indices
+        source_ids = old_id_indices[np.asarray(old_source_ids, dtype = np.int64)].tolist()
+        target_ids = old_id_indices[np.asarray(old_target_ids, dtype = np.int64)].tolist()
 
     # return values
     if weights:
@@ -701,8 +700,9 @@ def construct_network_from_edge_list(rlist,
             List of reference sequence labels
         qlist (list)
             List of query sequence labels
-        edge_list (list of tuples)
-            List of tuples describing the edges of the graph
+        edge_list (list of tuples, numpy or cupy array)
+            List of tuples describing the edges of the graph, or a
+            two column array of source and target indices
         weights (list)
             List of edge weights
         distMat (2 column ndarray)
@@ -744,7 +744,7 @@ def construct_network_from_edge_list(rlist,
     if use_gpu:
         # benchmarking concurs with https://stackoverflow.com/questions/55922162/recommended-cudf-dataframe-construction
         if len(edge_list) > 1:
-            edge_array = cp.array(edge_list, dtype = np.int32)
+            edge_array = cp.asarray(edge_list, dtype = np.int32)
             edge_gpu_matrix = cuda.to_device(edge_array)
             G_df = cudf.DataFrame(edge_gpu_matrix, columns = ['source','destination'])
         elif len(edge_list) == 1:
@@ -779,7 +779,17 @@ def construct_network_from_edge_list(rlist,
                                             use_gpu = use_gpu)
         # Construct list of tuples for graph-tool
         # Include information from previous graph if supplied
-        if weights is not None:
+        if isinstance(edge_list, np.ndarray):
+            # Arrays are passed to graph-tool as they are
+            if weights is not None:
+                edge_list = np.column_stack((edge_list, weights))
+                if previous_network is not None:
+                    edge_list = np.concatenate((edge_list,
+                        np.column_stack((extra_sources, extra_targets, extra_weights))))
+            elif previous_network is not None:
+                edge_list = np.concatenate((edge_list,
+                    np.column_stack((extra_sources, extra_targets)).astype(edge_list.dtype)))
+        elif weights is not None:
             weighted_edges = []
             for ((src, dest), weight) in zip(edge_list, weights):
                 weighted_edges.append((src, dest, weight))
@@ -1062,7 +1072,7 @@ def construct_dense_weighted_network(rlist, distMat, weights_type = None, use_gp
 def construct_network_from_assignments(rlist, qlist, assignments, within_label = 1, int_offset = 0,
     weights = None, distMat = None, weights_type = None, previous_network = None, old_ids = None,
     adding_qq_dists = False, previous_pkl = None, betweenness_sample = betweenness_sample_default,
-    summarise = True, sample_size = None, use_gpu = False):
+    summarise = True, sample_size = None, use_gpu = False, within_rows = None):
     """Construct an undirected network using sequence lists, assignments of pairwise distances
     to clusters, and the identifier of the cluster assigned to within-strain distances.
     Nodes are samples and edges where samples are within the same cluster
@@ -1075,7 +1085,8 @@ def construct_network_from_assignments(rlist, qlist, assignments, within_label =
         qlist (list)
             List of query sequence labels
         assignments (numpy.array or int)
-            Labels of most likely cluster assignment
+            Labels of most likely cluster assignment. Not used if within_rows
+            is given
         within_label (int)
             The label for the cluster representing within-strain distances
         int_offset (int)
@@ -1108,6 +1119,10 @@ def construct_network_from_assignments(rlist, qlist, assignments, within_label =
             Number of nodes to subsample for graph statistic calculation
         use_gpu (bool)
             Whether to use GPUs for network construction
+        within_rows (numpy.array)
+            Indices of the within-strain distances, as returned by
+            :func:`~PopPUNK.models.ClusterFit.assign_stream`, to use instead
+            of assignments
 
     Returns:
         G (graph)
@@ -1115,20 +1130,28 @@ def construct_network_from_assignments(rlist, qlist, assignments, within_label =
     """
 
     # Filter weights to only the relevant edges
-    if weights is not None:
-        weights = weights[assignments == within_label]
-    elif distMat is not None and weights_type is not None:
+    if within_rows is not None:
+        within = within_rows
+    elif weights is not None or (distMat is not None and weights_type is not None):
         if isinstance(assignments, list):
             assignments = np.array(assignments)
-        distMat = distMat[assignments == within_label,:]
+        within = assignments == within_label
+    if weights is not None:
+        weights = weights[within]
+    elif distMat is not None and weights_type is not None:
+        distMat = distMat[within,:]
         weights = process_weights(distMat, weights_type)
 
     # Convert edge indices to tuples
-    connections = poppunk_refine.generateTuples(assignments,
-                                                within_label,
-                                                self = (rlist == qlist),
-                                                num_ref = len(rlist),
-                                                int_offset = int_offset)
+    if within_rows is None:
+        connections = poppunk_refine.generateTuples(assignments,
+                                                    within_label,
+                                                    self = (rlist == qlist),
+                                                    num_ref = len(rlist),
+                                                    int_offset = int_offset)
+    else:
+        source, target = distRowsToEdges(within_rows, len(rlist), self = (rlist == qlist))
+        connections = list(zip((source + int_offset).tolist(), (target + int_offset).tolist()))
 
     # Construct network using edge list
     G = construct_network_from_edge_list(rlist, qlist, connections,
@@ -6,7 +6,6 @@
 import sys
 import os
 import subprocess
-import random
 import numpy as np
 import matplotlib as mpl
 mpl.use('Agg')
@@ -17,7 +16,6 @@ import itertools
 import pandas as pd
 from pandas.errors import DataError
 from collections import defaultdict
-from sklearn import utils
 try:  # sklearn >= 0.22
     from sklearn.neighbors import KernelDensity
 except ImportError:
@@ -27,6 +25,7 @@ from .trees import write_tree
 
 from .utils import isolateNameToLabel
 from .utils import decisionBoundary
+from .utils import sampleRows
 
 def plot_scatter(X, out_prefix, title, kde = True):
     """Draws a 2D scatter plot (png) of the core and accessory distances
@@ -34,7 +33,7 @@ def plot_scatter(X, out_prefix, title, kde = True):
     Also draws contours of kernel density estimare
 
     Args:
-        X (numpy.array)
+        X (numpy.array or DistanceStore)
             n x 2 array of core and accessory distances for n samples.
         out_prefix (str)
             Prefix for output plot file (.png will be appended)
@@ -47,8 +46,7 @@ def plot_scatter(X, out_prefix, title, kde = True):
     """
     # Plot results - max 1M for speed
     max_plot_samples = 1000000
-    if X.shape[0] > max_plot_samples:
-        X = utils.shuffle(X, random_state=random.randint(1,10000))[0:max_plot_samples,]
+    X = sampleRows(X, max_plot_samples)
 
     # Kernel estimate uses scaled data 0-1 on each axis
     scale = np.amax(X, axis = 0)
@@ -7,22 +7,23 @@ import os
 import sys
 # additional
 import numpy as np
-from collections import Counter
-
-import poppunk_refine
 
 from .network import prune_graph
-from .utils import storePickle, iterDistRows, readIsolateTypeFromCsv
+from .utils import readPickle, storeDistanceChunks, readIsolateTypeFromCsv, DistanceStore
+from .utils import distRowsToPairs, distRowsToEdges
 
 def prune_distance_matrix(refList, remove_seqs_in, distMat, output):
     """Rebuild distance matrix following selection of panel of references
 
+    Rows to keep are found with a mask over the sample indices of each
+    row, one chunk at a time, and written straight to the output file.
+
     Args:
         refList (list)
             List of sequences used to generate distance matrix
         remove_seqs_in (list)
             List of sequences to be omitted
-        distMat (numpy.array)
+        distMat (numpy.array or DistanceStore)
             nx2 matrix of core distances (column 0) and accessory
             distances (column 1)
         output (string)
@@ -30,59 +31,44 @@ def prune_distance_matrix(refList, remove_seqs_in, distMat, output):
     Returns:
         newRefList (list)
             List of sequences retained in distance matrix
-        newDistMat (numpy.array)
-            Updated version of distMat
+        newDistMat (DistanceStore)
+            Updated version of distMat, read from the new output files
     """
     # Find list items to remove
-    remove_seqs_list = []
-    removal_indices = []
+    ref_index = {}
+    for idx, item in enumerate(refList):
+        ref_index.setdefault(item, idx)
+    keep = np.ones(len(refList), dtype=bool)
     for to_remove in remove_seqs_in:
-        found = False
-        for idx, item in enumerate(refList):
-            if item == to_remove:
-                removal_indices.append(idx)
-                remove_seqs_list.append(item)
-                found = True
-                break
-        if not found:
+        if to_remove in ref_index:
+            keep[ref_index[to_remove]] = False
+        else:
             sys.stderr.write("Couldn't find " + to_remove + " in database\n")
-    remove_seqs = frozenset(remove_seqs_list)
-
-    if len(remove_seqs) > 0:
-        sys.stderr.write("Removing " + str(len(remove_seqs)) + " sequences\n")
-
-        numNew = len(refList) - len(remove_seqs)
-        newDistMat = np.zeros((int(0.5 * numNew * (numNew - 1)), 2), dtype=distMat.dtype)
-
-        # Create new reference list iterator
-        removal_indices.sort()
-        removal_indices.reverse()
-        next_remove = removal_indices.pop()
-        newRefList = []
-        for idx, seq in enumerate(refList):
-            if idx == next_remove:
-                if len(removal_indices) > 0:
-                    next_remove = removal_indices.pop()
-            else:
-                newRefList.append(seq)
-
-        newRowNames = iter(iterDistRows(newRefList, newRefList, self=True))
-
-        # Copy over rows which don't have an excluded sequence
-        # TODO this seems like it would be slow for a big dist matrix
-        # TODO didn't we used to have this as a slice?
-        newIdx = 0
-        for distRow, (ref1, ref2) in zip(distMat, iterDistRows(refList, refList, self=True)):
-            if ref1 not in remove_seqs and ref2 not in remove_seqs:
-                (newRef1, newRef2) = next(newRowNames)
-                if newRef1 == ref1 and newRef2 == ref2:
-                    newDistMat[newIdx, :] = distRow
-                    newIdx += 1
-                else:
-                    raise RuntimeError("Row name mismatch. Old: " + ref1 + "," + ref2 + "\n"
-                                       "New: " + newRef1 + "," + newRef2 + "\n")
-
-        storePickle(newRefList, newRefList, True, newDistMat, output)
+
+    if not np.all(keep):
+        sys.stderr.write("Removing " + str(np.sum(~keep)) + " sequences\n")
+
+        # Create new reference list
+        newRefList = [seq for seq, kept in zip(refList, keep) if kept]
+        numNew = len(newRefList)
+
+        # Keep rows which don't have an excluded sequence. As rows are
+        # ordered by (query, ref), this preserves the order of the new list
+        if not isinstance(distMat, DistanceStore):
+            distMat = DistanceStore(distMat)
+        def kept_rows():
+            for start, block in distMat.iter_rows():
+                ref_idx, query_idx = distRowsToPairs(np.arange(start, start + block.shape[0]),
+                                                     len(refList))
+                yield block[keep[ref_idx] & keep[query_idx], :]
+
+        storeDistanceChunks(newRefList, newRefList, True,
+                            (numNew * (numNew - 1)) // 2,
+                            kept_rows(),
+                            output,
+                            dtype = distMat.dtype,
+                            dist_format = distMat.dist_format)
+        newDistMat = readPickle(output, distances=True, mmap=True)[3]
     else:
         newRefList = refList
         newDistMat = distMat
@@ -118,18 +104,17 @@ def prune_query_distance_matrix(refList, queryList, remove_seqs, qrDistMat,
     if remove_seqs.intersection(refList):
         raise RuntimeError("Trying to remove references")
 
-    passing_queries = []
-    pass_rows = []
-    for name in queryList:
-        if name not in remove_seqs:
-            passing_queries.append(name)
-            pass_rows += [True] * len(refList)
-        else:
-            pass_rows += [False] * len(refList)
+    # Select whole blocks of rows, viewing the distances as (query, ref)
+    pass_queries = np.array([name not in remove_seqs for name in queryList], dtype = bool)
+    passing_queries = [name for name, passed in zip(queryList, pass_queries) if passed]
 
-    qrDistMat = qrDistMat[pass_rows, :]
+    qrDistMat = np.asarray(qrDistMat)
+    qrDistMat = qrDistMat.reshape(len(queryList), len(refList), -1)[pass_queries]\
+        .reshape(-1, qrDistMat.shape[1])
     if queryAssign is not None:
-        queryAssign = queryAssign[pass_rows]
+        queryAssign = np.asarray(queryAssign)
+        queryAssign = queryAssign.reshape(len(queryList), len(refList))[pass_queries]\
+            .reshape(-1)
 
     return passing_queries, qrDistMat, queryAssign
 
@@ -151,8 +136,7 @@ def sketchlibAssemblyQC(prefix, names, qc_dict):
         failed (dict)
             List of sequences failing, and reasons
     """
-    import h5py
-    from .sketchlib import removeFromDB
+    from .sketchlib import readSketchMetadata
 
     # Make user aware of all filters being used (including defaults)
     sys.stderr.write("Running QC on sketches\n")
@@ -166,68 +150,45 @@ def sketchlibAssemblyQC(prefix, names, qc_dict):
         sys.stderr.write("Using range for length cutoffs: " + str(qc_dict['length_range'][0]) + " - " + \
                           str(qc_dict['length_range'][1]) + "\n")
 
-    # open databases
+    # read sample metadata in one go
     db_name = prefix + '/' + os.path.basename(prefix) + '.h5'
-    hdf_in = h5py.File(db_name, 'r')
+    metadata = readSketchMetadata(db_name)
+    in_names = np.isin(metadata['names'], names)
+    seq_names = [name for name, keep in zip(metadata['names'], in_names) if keep]
+    seq_length = metadata['length'][in_names]
+    # If reads, do not QC based on Ns (simpler this way)
+    seq_ambiguous = np.where(metadata['reads'][in_names], 0, metadata['missing_bases'][in_names])
+
+    # calculate thresholds
+    # get mean length
+    mean_genome_length = np.mean(seq_length)
+
+    # calculate length threshold unless user-supplied
+    if qc_dict['length_range'][0] is None:
+        lower_length = mean_genome_length - \
+            qc_dict['length_sigma'] * np.std(seq_length)
+        upper_length = mean_genome_length + \
+            qc_dict['length_sigma'] * np.std(seq_length)
+    else:
+        lower_length, upper_length = qc_dict['length_range']
+
+    # determine which sequences pass filters
+    too_short = seq_length < lower_length
+    too_long = ~too_short & (seq_length > upper_length)
+    too_ambiguous = seq_ambiguous > qc_dict['prop_n'] * seq_length
+    if qc_dict['upper_n'] is not None:
+        too_ambiguous |= seq_ambiguous > qc_dict['upper_n']
 
-    # try/except structure to prevent h5 corruption
     failed_samples = {}
-    try:
-        # process data structures
-        read_grp = hdf_in['sketches']
-
-        seq_length = {}
-        seq_ambiguous = {}
-        # iterate through sketches
-        for dataset in read_grp:
-            if dataset in names:
-                # test thresholds
-                seq_length[dataset] = hdf_in['sketches'][dataset].attrs['length']
-                # If reads, do not QC based on Ns (simpler this way)
-                # Older versions of DB do not save reads, so attr may not be present
-                if 'reads' in hdf_in['sketches'][dataset].attrs and \
-                    hdf_in['sketches'][dataset].attrs['reads']:
-                    seq_ambiguous[dataset] = 0
-                else:
-                    seq_ambiguous[dataset] = hdf_in['sketches'][dataset].attrs['missing_bases']
-
-        # calculate thresholds
-        # get mean length
-        genome_lengths = np.fromiter(seq_length.values(), dtype = int)
-        mean_genome_length = np.mean(genome_lengths)
-
-        # calculate length threshold unless user-supplied
-        if qc_dict['length_range'][0] is None:
-            lower_length = mean_genome_length - \
-                qc_dict['length_sigma'] * np.std(genome_lengths)
-            upper_length = mean_genome_length + \
-                qc_dict['length_sigma'] * np.std(genome_lengths)
-        else:
-            lower_length, upper_length = qc_dict['length_range']
-
-        # open file to report QC failures
-        for dataset in seq_length.keys():
-            # determine if sequence passes filters
-            if seq_length[dataset] < lower_length:
-                failed_samples[dataset] = ['Below lower length threshold']
-            elif seq_length[dataset] > upper_length:
-                failed_samples[dataset] = ['Above upper length threshold']
-            if (qc_dict['upper_n'] is not None and seq_ambiguous[dataset] > qc_dict['upper_n']) or \
-                (seq_ambiguous[dataset] > qc_dict['prop_n'] * seq_length[dataset]):
-                message = "Ambiguous sequence too high"
-                if dataset in failed_samples:
-                    failed_samples[dataset].append(message)
-                else:
-                    failed_samples[dataset] = [message]
-
-        hdf_in.close()
-    # if failure still close files to avoid corruption
-    except:
-        hdf_in.close()
-        sys.stderr.write('Problem processing h5 databases during QC - aborting\n')
-
-        print("Unexpected error:", sys.exc_info()[0], file = sys.stderr)
-        raise
+    for idx in np.flatnonzero(too_short | too_long | too_ambiguous):
+        reasons = []
+        if too_short[idx]:
+            reasons.append('Below lower length threshold')
+        elif too_long[idx]:
+            reasons.append('Above upper length threshold')
+        if too_ambiguous[idx]:
+            reasons.append("Ambiguous sequence too high")
+        failed_samples[seq_names[idx]] = reasons
 
     # This gives back retained in the same order as names
     retained_samples = [x for x in names if x not in frozenset(failed_samples.keys())]
@@ -239,7 +200,7 @@ def qcDistMat(distMat, refList, queryList, ref_db, qc_dict):
     """Checks distance matrix for outliers.
 
     Args:
-        distMat (np.array)
+        distMat (np.array or DistanceStore)
             Core and accessory distances
         refList (list)
             Reference labels
@@ -275,50 +236,63 @@ def qcDistMat(distMat, refList, queryList, ref_db, qc_dict):
         qc_dict['type_isolate'] = pickTypeIsolate(ref_db, refList)
         sys.stderr.write('Selected type isolate for distance QC is ' + qc_dict['type_isolate'] + '\n')
 
-    # First check with numpy, which is quicker than iterating over everything
-    #long_distance_rows = np.where([(distMat[:, 0] > qc_dict['max_pi_dist']) | (distMat[:, 1] > qc_dict['max_a_dist'])])[1].tolist()
-    long_distance_rows = np.where([(distMat[:, 0] > qc_dict['max_pi_dist']) | (distMat[:, 1] > qc_dict['max_a_dist'])],0,1)[0].tolist()
-    long_edges = poppunk_refine.generateTuples(long_distance_rows,
-                                                0,
-                                                self = self,
-                                                num_ref = len(refList),
-                                                int_offset = 0)
-
-    failed = prune_edges(long_edges,
-                                 type_isolate=names.index(qc_dict['type_isolate']),
-                                 query_start=len(refList),
-                                 allow_ref_ref=self)
-    # Convert the edge IDs back to sample names
-    failed_samples = {names[x]: ["Failed distance QC (too high)"] for x in failed}
-
-    # Check if too many zeros, basically the same way but update the existing
-    # dicts/sets, and set a minimum count of zero lengths
+    # Distances are streamed in chunks, first to count the failing distances
+    # for each sample, then to decide which sample of each failing pair to
+    # remove, so only per-sample arrays are held in memory
+    if not isinstance(distMat, DistanceStore):
+        distMat = DistanceStore(distMat)
+    type_isolate = names.index(qc_dict['type_isolate'])
+
+    # Check for long distances, then for too many zeros, ignoring samples
+    # which failed the first check
+    failed = prune_edges(distMat,
+                         lambda block: (block[:, 0] > qc_dict['max_pi_dist']) | \
+                                       (block[:, 1] > qc_dict['max_a_dist']),
+                         type_isolate=type_isolate,
+                         num_ref=len(refList),
+                         self=self)
+    failed_samples = {names[x]: ["Failed distance QC (too high)"] for x in np.flatnonzero(failed)}
+
     if qc_dict["prop_zero"] < 1:
-        zero_count = round(qc_dict["prop_zero"] * len(names))
-        zero_distance_rows = np.where([(distMat[:, 0] == 0) | (distMat[:, 1] == 0)],0,1)[0].tolist()
-        zero_edges = poppunk_refine.generateTuples(zero_distance_rows,
-                                                    0,
-                                                    self = self,
-                                                    num_ref = len(refList),
-                                                    int_offset = 0)
-        failed = prune_edges(zero_edges,
-                            type_isolate=names.index(qc_dict['type_isolate']),
-                            query_start=len(refList),
-                            failed=failed,
-                            min_count=zero_count,
-                            allow_ref_ref=self)
+        zero_failed = prune_edges(distMat,
+                                  lambda block: (block[:, 0] == 0) | (block[:, 1] == 0),
+                                  type_isolate=type_isolate,
+                                  num_ref=len(refList),
+                                  self=self,
+                                  previously_failed=failed,
+                                  min_count=round(qc_dict["prop_zero"] * len(names)))
         message = ["Failed distance QC (too many zeros)"]
-        for sample in failed:
-            name = names[sample]
-            if name in failed_samples:
-                failed_samples[name] += message
-            else:
-                failed_samples[name] = message
+        for sample in np.flatnonzero(zero_failed):
+            failed_samples[names[sample]] = message
 
     retained_samples = [x for x in names if x not in frozenset(failed_samples.keys())]
     return retained_samples, failed_samples
 
 
+def failing_edges(criterion, start, block, num_ref, self):
+    """Find the edges between samples for the distances in a chunk which
+    fail a QC check
+
+    Args:
+        criterion (function)
+            Takes a block of distances, returns a boolean array of failing rows
+        start (int)
+            Row index of the first distance in block
+        block (numpy.array)
+            Chunk of core and accessory distances
+        num_ref (int)
+            Number of references
+        self (bool)
+            Whether the distances are a self-comparison
+
+    Returns:
+        source, target (numpy.array, numpy.array)
+            Sample IDs at each end of the failing edges (source < target)
+    """
+    rows = start + np.flatnonzero(criterion(block))
+    return distRowsToEdges(rows, num_ref, self)
+
+
 def qcQueryAssignments(rList, qList, query_assignments, max_clusters,
                        original_cluster_file):
     """Checks assignments for too many links between clusters.
@@ -345,79 +319,140 @@ def qcQueryAssignments(rList, qList, query_assignments, max_clusters,
     retained_samples = []
     failed_samples = {}
 
-    # Read the rList cluster assignments, and turn into a dict which
-    # is idx: cluster
+    # Read the rList cluster assignments, and turn into an array of
+    # integer cluster IDs in rList order
     clusters = readIsolateTypeFromCsv(original_cluster_file, return_dict=True)
-    clusters_idx = {idx: clusters['Cluster'][name] for idx, name in enumerate(rList)}
+    cluster_codes = {}
+    ref_clusters = np.array([cluster_codes.setdefault(clusters['Cluster'][name], len(cluster_codes))
+                             for name in rList], dtype = np.int64)
+    n_clusters = max(len(cluster_codes), 1)
 
     # Find the edges for each query, and count how many unique clusters they
     # appear in
-    for idx, query in enumerate(qList):
-        row_start = idx * len(rList)
-        row_end = (idx + 1) * len(rList)
-        edges = np.argwhere(query_assignments[row_start:row_end] == -1).reshape(-1)
-        cluster_links = set()
-        for edge in edges:
-            cluster_links.add(clusters_idx[edge])
-
-        if len(cluster_links) > max_clusters:
+    links = np.asarray(query_assignments).reshape(len(qList), len(rList)) == -1
+    query_idx, ref_idx = np.nonzero(links)
+    query_clusters = np.unique(query_idx * n_clusters + ref_clusters[ref_idx])
+    cluster_link_counts = np.bincount(query_clusters // n_clusters, minlength = len(qList))
+
+    for query, cluster_links in zip(qList, cluster_link_counts):
+        if cluster_links > max_clusters:
             failed_samples[query] = message
         else:
             retained_samples.append(query)
     return retained_samples, failed_samples
 
-def prune_edges(long_edges, type_isolate, query_start,
-                failed=None, min_count=1, allow_ref_ref=True):
-    """Gives a list of failed vertices from a list of failing
-    edges. Tries to prune by those nodes with highest degree of
-    bad nodes, preferentially removes queries, and doesn't remove
-    the type isolate
+def prune_edges(distMat, criterion, type_isolate, num_ref, self,
+                previously_failed=None, min_count=1):
+    """Gives an array of failed samples from the distances failing a check.
+    Tries to prune by those nodes with highest degree of bad edges,
+    preferentially removes queries, and doesn't remove the type isolate
+
+    Bad edges are never held as a list. A first pass over the distances
+    counts the bad edges at each sample, and a second visits them in row
+    order. As a sample can only be removed by an edge where it has at least
+    as many bad edges as the other end, visiting edges in row order gives
+    the same result as sorting all edges by their highest count, provided
+    the rows where each sample was removed are kept.
 
     Args:
-        long_edges (list of tuples)
-            List of bad edges as node IDs
+        distMat (DistanceStore)
+            Core and accessory distances
+        criterion (function)
+            Takes a block of distances, returns a boolean array of failing rows
         type_isolate (int)
             The node ID of the type isolate
-        query_start (int)
-            The first node ID which corresponds to queries
-        failed (set or None)
-            If set, an existing prune list to add to
+        num_ref (int)
+            Number of references. Node IDs from this onwards are queries
+        self (bool)
+            Whether the distances are a self-comparison. If not,
+            only queries are pruned
+        previously_failed (numpy.array or None)
+            Boolean array of node IDs already removed, whose edges are ignored
         min_count (int)
             Must be at least this many failures to prune
-        allow_ref_ref (bool)
-            Whether r-r edges can be pruned (set False if querying)
     Returns:
-        failed (set)
-            Failed sample IDs
+        failed (numpy.array)
+            Boolean array of newly failed node IDs
     """
-    if failed == None:
-        failed = set()
-    if len(long_edges) > 0:
-        # Find nodes with the most bad edges
-        counts = Counter()
-        for (r, q) in long_edges:
-            counts.update([r, q])
-
-        # Sorts by edges which appear most often
-        long_edges.sort(key=lambda x: max(counts[x[0]], counts[x[1]]), reverse=True)
-        for (r, q) in long_edges:
-            if q not in failed and r not in failed and (counts[r] >= min_count or counts[q] >= min_count):
-                # Do not add any refs if querying
-                if r < query_start and q < query_start:
-                    if allow_ref_ref:
-                        if q == type_isolate or (counts[r] > counts[q] and counts[r] >= min_count):
-                            failed.add(r)
-                        elif counts[q] >= min_count:
-                            failed.add(q)
-                # NB q > r
-                elif r < query_start and q >= query_start:
-                    failed.add(q)
-                else:
-                    if counts[r] > counts[q] and counts[r] >= min_count:
-                        failed.add(r)
-                    elif counts[q] >= min_count:
-                        failed.add(q)
-
+    num_nodes = num_ref if self else num_ref + distMat.shape[0] // num_ref
+    if previously_failed is None:
+        previously_failed = np.zeros(num_nodes, dtype = bool)
+
+    # Count the bad edges at each node, and where each node has a bad edge
+    # with the type isolate
+    counts = np.zeros(num_nodes, dtype = np.int64)
+    type_row = np.full(num_nodes, -1, dtype = np.int64)
+    for start, block in distMat.iter_rows():
+        source, target = failing_edges(criterion, start, block, num_ref, self)
+        counts += np.bincount(source, minlength = num_nodes)
+        counts += np.bincount(target, minlength = num_nodes)
+        if self:
+            rows = start + np.flatnonzero(criterion(block))
+            type_row[target[source == type_isolate]] = rows[source == type_isolate]
+            type_row[source[target == type_isolate]] = rows[target == type_isolate]
+
+    failed = np.zeros(num_nodes, dtype = bool)
+    if counts.max(initial = 0) < min_count:
+        return failed
+
+    # Samples with a bad edge to the type isolate are always removed,
+    # when that edge is reached
+    type_level = np.maximum(counts, counts[type_isolate])
+    type_failed = (type_row >= 0) & (type_level >= min_count) & ~previously_failed
+    type_failed[type_isolate] = False
+    failed |= type_failed
+
+    def removed_earlier(node, level, row):
+        return type_failed[node] & ((type_level[node] > level) | \
+                                    ((type_level[node] == level) & (type_row[node] < row)))
+
+    # Row of the first edge which removed each sample, which is at the level
+    # of its own count
+    no_row = np.iinfo(np.int64).max
+    removed_row = np.full(num_nodes, no_row, dtype = np.int64)
+    for start, block in distMat.iter_rows():
+        rows = start + np.flatnonzero(criterion(block))
+        source, target = distRowsToEdges(rows, num_ref, self)
+        source_counts = counts[source]
+        target_counts = counts[target]
+        level = np.maximum(source_counts, target_counts)
+        keep = (level >= min_count) & ~(previously_failed[source] | previously_failed[target])
+
+        # Between a reference and a query, always remove the query
+        ref_query = target >= num_ref
+        failed[target[keep & ref_query]] = True
+
+        # Between references, edges with the type isolate were dealt with
+        # above. Otherwise remove the sample with more bad edges, unless
+        # the other was already removed
+        keep &= ~ref_query & (source != type_isolate) & (target != type_isolate)
+        if not self or not np.any(keep):
+            continue
+        rows = rows[keep]
+        source = source[keep]
+        target = target[keep]
+        level = level[keep]
+        source_counts = source_counts[keep]
+        target_counts = target_counts[keep]
+
+        untied = source_counts != target_counts
+        winner = np.where(source_counts > target_counts, source, target)[untied]
+        loser = np.where(source_counts > target_counts, target, source)[untied]
+        untied_rows = rows[untied]
+        remove = ~removed_earlier(loser, level[untied], untied_rows)
+        np.minimum.at(removed_row, winner[remove], untied_rows[remove])
+
+        # Where tied, the later sample is removed. These depend on which
+        # samples were removed earlier at the same level, so go in order
+        tied = ~untied
+        for r, q, lvl, row in zip(source[tied].tolist(), target[tied].tolist(),
+                                  level[tied].tolist(), rows[tied].tolist()):
+            if removed_row[r] < row or removed_row[q] < row or \
+                removed_earlier(r, lvl, row) or removed_earlier(q, lvl, row):
+                continue
+            removed_row[q] = row
+
+    failed |= removed_row != no_row
     return failed
 
 def remove_qc_fail(qc_dict, names, passed, fail_dicts, ref_db, distMat, prefix,
@@ -550,36 +585,20 @@ def pickTypeIsolate(prefix, refList):
         type_isolate (str)
             Name of isolate selected as reference
     """
-    # open databases
-    import h5py
+    # read sample metadata in one go
+    from .sketchlib import readSketchMetadata, subsetSketchMetadata
     db_name = prefix + '/' + os.path.basename(prefix) + '.h5'
-    hdf_in = h5py.File(db_name, 'r')
+    metadata = readSketchMetadata(db_name)
+    in_db = np.isin(refList, metadata['names'])
+    metadata = subsetSketchMetadata(metadata, [sample for sample, found in zip(refList, in_db) if found])
 
-    min_prop_n = 1.0
+    # Pick the first sample with the minimal proportion of missing data
     type_isolate = None
-
-    try:
-        # process data structures
-        read_grp = hdf_in['sketches']
-        # iterate through sketches
-        for sample in refList:
-            if sample in read_grp:
-                if 'reads' in hdf_in['sketches'][sample].attrs and \
-                    hdf_in['sketches'][sample].attrs['reads']:
-                    sample_prop_n = 1.0
-                else:
-                    sample_prop_n = hdf_in['sketches'][sample].attrs['missing_bases']/hdf_in['sketches'][sample].attrs['length']
-                if sample_prop_n < min_prop_n:
-                    min_prop_n = sample_prop_n
-                    type_isolate = sample
-                if min_prop_n == 0.0:
-                    break
-    # if failure still close files to avoid corruption
-    except:
-        hdf_in.close()
-        sys.stderr.write('Problem processing h5 databases during QC - aborting\n')
-        print("Unexpected error:", sys.exc_info()[0], file = sys.stderr)
-        raise
+    if len(metadata['names']) > 0:
+        prop_n = np.where(metadata['reads'], 1.0,
+                          metadata['missing_bases'] / metadata['length'])
+        if prop_n.min() < 1.0:
+            type_isolate = metadata['names'][np.argmin(prop_n)]
 
     return type_isolate
 
@@ -70,7 +70,7 @@ def main():
     setGtThreads(args.threads)
 
     # Read in all distances
-    refList, queryList, self, distMat = readPickle(args.distances, enforce_self=True)
+    refList, queryList, self, distMat = readPickle(args.distances, enforce_self=True, mmap=True)
 
     # Read in full network
     genomeNetwork = load_network_file(args.network, use_gpu = args.use_gpu)
@@ -113,6 +113,7 @@ def main():
             os.rename(db_outfile, db_infile)
     else:
         sys.stderr.write("No sequences to remove\n")
+    distMat.close()
 
     # Copy model fit into new directory
     if args.model is not None and os.path.isdir(args.model):
@@ -6,6 +6,7 @@
 # universal
 import os
 import sys
+import threading
 # additional
 from itertools import chain
 from functools import partial
@@ -15,8 +16,8 @@ import collections
 from math import sqrt
 from tqdm import tqdm
 try:
-    from multiprocessing import Pool, shared_memory
-    from multiprocessing.managers import SharedMemoryManager
+    from multiprocessing import shared_memory
+    from multiprocessing.pool import ThreadPool
     NumpyShared = collections.namedtuple('NumpyShared', ('name', 'shape', 'dtype'))
 except ImportError as e:
     sys.stderr.write("This version of PopPUNK requires python v3.8 or higher\n")
@@ -48,11 +49,109 @@ from .utils import transformLine
 from .utils import decisionBoundary
 from .utils import check_and_set_gpu
 
+# Points along each axis at every level of the adaptive grid search. Odd, so
+# the best point of one level is the centre of the next
+adaptive_grid_resolution = 9
+
+class NetworkScoreCache:
+    """Scores of the networks made while refining a boundary.
+
+    Every boundary with the same orientation admits a prefix of the same
+    ordering of the distances, so the orientation and number of edges
+    admitted identify a network. The score and number of components of
+    each network are stored under these, so repeated networks are not
+    built and summarised again. Only valid for one score_idx and
+    sample_size, i.e. within one :func:`~PopPUNK.models.RefineFit.fit`.
+    May be shared between threads.
+    """
+    def __init__(self):
+        self.scores = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(slope, gradient, n_edges):
+        """Orientation of the boundary and number of edges.
+
+        Args:
+            slope (int)
+                0 for a vertical boundary, 1 for a horizontal boundary,
+                or 2 to use a slope
+            gradient (float)
+                Gradient of the search line, which the x_max/y_max ratio of
+                the boundary equals. Ignored unless slope is 2
+            n_edges (int)
+                Number of edges admitted by the boundary
+
+        Returns:
+            key (tuple)
+                Key for the network in the cache
+        """
+        if slope != 2:
+            gradient = None
+        return (slope, gradient, int(n_edges))
+
+    def lookup(self, slope, gradient, n_edges):
+        """Find a network in the cache, counting hits and misses.
+
+        Args:
+            slope (int)
+                Boundary slope type (see :func:`~NetworkScoreCache.key`)
+            gradient (float)
+                Gradient of the search line
+            n_edges (int)
+                Number of edges admitted by the boundary
+
+        Returns:
+            entry (tuple or None)
+                Number of components and -1 * network score,
+                or None if the network has not been scored
+        """
+        with self.lock:
+            entry = self.scores.get(self.key(slope, gradient, n_edges))
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def store(self, slope, gradient, n_edges, components, score):
+        """Add a network to the cache.
+
+        Args:
+            slope (int)
+                Boundary slope type (see :func:`~NetworkScoreCache.key`)
+            gradient (float)
+                Gradient of the search line
+            n_edges (int)
+                Number of edges admitted by the boundary
+            components (int)
+                Number of components in the network
+            score (float)
+                -1 * network score
+        """
+        with self.lock:
+            self.scores[self.key(slope, gradient, n_edges)] = (components, score)
+
+    def summary(self):
+        """Hit statistics, for the log.
+
+        Returns:
+            summary (str)
+                Numbers of networks stored, lookups and hits
+        """
+        lookups = self.hits + self.misses
+        hit_rate = 100 * self.hits / lookups if lookups > 0 else 0
+        return (f"Network score cache: {len(self.scores)} networks scored, "
+                f"{self.hits}/{lookups} lookups reused a score "
+                f"({hit_rate:.1f}%)\n")
+
 def refineFit(distMat, sample_names, mean0, mean1, scale,
               max_move, min_move, slope = 2, score_idx = 0,
               unconstrained = False, no_local = False, num_processes = 1,
               betweenness_sample = betweenness_sample_default, sample_size = None,
-              use_gpu = False):
+              use_gpu = False, score_cache = None, tolerance = None):
     """Try to refine a fit by maximising a network score based on transitivity and density.
 
     Iteratively move the decision boundary to do this, using starting point from existing model.
@@ -93,6 +192,13 @@ def refineFit(distMat, sample_names, mean0, mean1, scale,
             Number of nodes to subsample for graph statistic calculation
         use_gpu (bool)
             Whether to use cugraph for graph analyses
+        score_cache (NetworkScoreCache)
+            Scores of networks already made with the same score_idx and
+            sample_size, which is added to [default = None]
+        tolerance (float)
+            If set, use an adaptive grid search instead of a fixed grid,
+            stopping when the grid spacing is below this (in scaled
+            distances) [default = None]
 
     Returns:
         optimal_x (float)
@@ -108,20 +214,18 @@ def refineFit(distMat, sample_names, mean0, mean1, scale,
 
     # Boundary is left of line normal to this point and first line
     gradient = (mean1[1] - mean0[1]) / (mean1[0] - mean0[0])
+    sorted_edges = None
 
     if unconstrained:
         if slope != 2:
             raise RuntimeError("Unconstrained optimization and indiv-refine incompatible")
 
-        global_grid_resolution = 20
         x_max_start, y_max_start = decisionBoundary(mean0, gradient, adj = -1*min_move)
         x_max_end, y_max_end = decisionBoundary(mean1, gradient, adj = max_move)
 
         if x_max_start < 0 or y_max_start < 0:
             raise RuntimeError("Boundary range below zero")
 
-        x_max = np.linspace(x_max_start, x_max_end, global_grid_resolution, dtype=np.float32)
-        y_max = np.linspace(y_max_start, y_max_end, global_grid_resolution, dtype=np.float32)
         sys.stderr.write("Searching core intercept from " +
                          "{:.3f}".format(x_max_start * scale[0]) +
                          " to " + "{:.3f}".format(x_max_end * scale[0]) + "\n")
@@ -129,48 +233,31 @@ def refineFit(distMat, sample_names, mean0, mean1, scale,
                          "{:.3f}".format(y_max_start * scale[1]) +
                          " to " + "{:.3f}".format(y_max_end * scale[1]) + "\n")
 
-        if use_gpu:
-            global_s = map(partial(newNetwork2D,
-                                   sample_names = sample_names,
-                                   distMat = distMat,
-                                   x_range = x_max,
-                                   y_range = y_max,
-                                   score_idx = score_idx,
-                                   betweenness_sample = betweenness_sample,
-                                   sample_size = sample_size,
-                                   use_gpu = True),
-                           range(global_grid_resolution))
+        score_grid = partial(scoreGrid2D,
+                             sample_names = sample_names,
+                             distMat = distMat,
+                             score_idx = score_idx,
+                             num_processes = num_processes,
+                             betweenness_sample = betweenness_sample,
+                             sample_size = sample_size,
+                             use_gpu = use_gpu,
+                             score_cache = score_cache)
+        if tolerance is None:
+            global_grid_resolution = 20
+            x_max = np.linspace(x_max_start, x_max_end, global_grid_resolution, dtype=np.float32)
+            y_max = np.linspace(y_max_start, y_max_end, global_grid_resolution, dtype=np.float32)
+            global_s = score_grid(x_max, y_max)
+            min_idx = np.argmin(global_s)
+            optimal_x = x_max[min_idx % global_grid_resolution]
+            optimal_y = y_max[min_idx // global_grid_resolution]
+            optimised_s = global_s[min_idx]
+            delta = x_max[1] - x_max[0]
         else:
-            if gt.openmp_enabled():
-                gt.openmp_set_num_threads(1)
-
-            with SharedMemoryManager() as smm:
-                shm_distMat = smm.SharedMemory(size = distMat.nbytes)
-                distances_shared_array = np.ndarray(distMat.shape, dtype = distMat.dtype, buffer = shm_distMat.buf)
-                distances_shared_array[:] = distMat[:]
-                distances_shared = NumpyShared(name = shm_distMat.name, shape = distMat.shape, dtype = distMat.dtype)
-
-                with Pool(processes = num_processes) as pool:
-                    global_s = pool.map(partial(newNetwork2D,
-                                                sample_names = sample_names,
-                                                distMat = distances_shared,
-                                                x_range = x_max,
-                                                y_range = y_max,
-                                                score_idx = score_idx,
-                                                betweenness_sample = betweenness_sample,
-                                                sample_size = sample_size,
-                                                use_gpu = False),
-                                        range(global_grid_resolution))
-
-            if gt.openmp_enabled():
-                gt.openmp_set_num_threads(num_processes)
-
-        global_s = np.array(list(chain.from_iterable(global_s)))
-        global_s[np.isnan(global_s)] = 1
-        min_idx = np.argmin(global_s)
-        optimal_x = x_max[min_idx % global_grid_resolution]
-        optimal_y = y_max[min_idx // global_grid_resolution]
-        optimised_s = global_s[min_idx]
+            optimal_x, optimal_y, optimised_s, delta = \
+                adaptiveSearch2D(score_grid,
+                                 x_max_start, x_max_end,
+                                 y_max_start, y_max_end,
+                                 tolerance)
 
         if not (optimal_x > x_max_start and optimal_x < x_max_end and \
                 optimal_y > y_max_start and optimal_y < y_max_end):
@@ -180,39 +267,66 @@ def refineFit(distMat, sample_names, mean0, mean1, scale,
             # This parameterisation is a little awkward to match the 1D case:
             # Make two points along the right slope
             gradient = optimal_x / optimal_y # of 1D search
-            delta = x_max[1] - x_max[0]
             bounds = [-delta, delta]
             mean1 = (optimal_x + delta, delta * gradient)
 
     else:
         # Set the range of points to search
         search_length = max_move + ((mean1[0] - mean0[0])**2 + (mean1[1] - mean0[1])**2)**0.5
-        global_grid_resolution = 40 # Seems to work
-        s_range = np.linspace(-min_move, search_length, num = global_grid_resolution)
         (min_x, max_x), (min_y, max_y) = \
-            check_search_range(scale, mean0, mean1, s_range[0], s_range[-1])
+            check_search_range(scale, mean0, mean1, -min_move, search_length)
         if min_x < 0 or min_y < 0:
             raise RuntimeError("Boundary range below zero")
 
-        i_vec, j_vec, idx_vec = \
-            poppunk_refine.thresholdIterate1D(distMat, s_range, slope,
-                                              mean0[0], mean0[1],
-                                              mean1[0], mean1[1], num_processes)
-        if len(idx_vec) == distMat.shape[0]:
-            raise RuntimeError("Boundary range includes all points")
-        global_s = np.array(growNetwork(sample_names,
-                                        i_vec,
-                                        j_vec,
-                                        idx_vec,
-                                        s_range,
-                                        score_idx,
-                                        betweenness_sample = betweenness_sample,
-                                        sample_size = sample_size,
-                                        use_gpu = use_gpu))
+        if tolerance is None:
+            global_grid_resolution = 40 # Seems to work
+            s_range = np.linspace(-min_move, search_length, num = global_grid_resolution)
+            i_vec, j_vec, idx_vec = \
+                poppunk_refine.thresholdIterate1D(distMat, s_range, slope,
+                                                  mean0[0], mean0[1],
+                                                  mean1[0], mean1[1], num_processes)
+            if len(idx_vec) == distMat.shape[0]:
+                raise RuntimeError("Boundary range includes all points")
+            global_s = np.array(growNetwork(sample_names,
+                                            i_vec,
+                                            j_vec,
+                                            idx_vec,
+                                            s_range,
+                                            score_idx,
+                                            betweenness_sample = betweenness_sample,
+                                            sample_size = sample_size,
+                                            use_gpu = use_gpu,
+                                            score_cache = score_cache,
+                                            boundary = (slope, gradient)))
+        else:
+            s_range, global_s = \
+                adaptiveSearch1D(partial(scoreOffsets1D,
+                                         sample_names = sample_names,
+                                         distMat = distMat,
+                                         mean0 = mean0,
+                                         mean1 = mean1,
+                                         gradient = gradient,
+                                         slope = slope,
+                                         score_idx = score_idx,
+                                         num_processes = num_processes,
+                                         betweenness_sample = betweenness_sample,
+                                         sample_size = sample_size,
+                                         use_gpu = use_gpu,
+                                         score_cache = score_cache),
+                                 -min_move, search_length, tolerance)
         global_s[np.isnan(global_s)] = 1
         min_idx = np.argmin(np.array(global_s))
         if min_idx > 0 and min_idx < len(s_range) - 1:
             bounds = [s_range[min_idx-1], s_range[min_idx+1]]
+            # Edges entering within the bounds are already in boundary order
+            if tolerance is None and score_idx == 0 and sample_size is None \
+                    and not use_gpu:
+                idx_vec = np.asarray(idx_vec)
+                n_base = np.count_nonzero(idx_vec < min_idx)
+                n_sorted = np.count_nonzero(idx_vec <= min_idx + 1)
+                sorted_edges = (np.asarray(i_vec[:n_sorted], dtype=np.int64),
+                                np.asarray(j_vec[:n_sorted], dtype=np.int64),
+                                n_base)
         else:
             no_local = True
         if no_local:
@@ -221,14 +335,41 @@ def refineFit(distMat, sample_names, mean0, mean1, scale,
     # Local optimisation around global optimum
     if not no_local:
         sys.stderr.write("Trying to optimise score locally\n")
-        local_s = scipy.optimize.minimize_scalar(
-                    newNetwork,
-                    bounds = bounds,
-                    method = 'Bounded', options={'disp': True},
-                    args = (sample_names, distMat, mean0, mean1, gradient,
-                            slope, score_idx, num_processes,
-                            betweenness_sample, sample_size, use_gpu)
-                )
+        if sorted_edges is not None:
+            sorted_dists, sorted_components, sorted_scores = \
+                sortedNetworkScores(sample_names, distMat, *sorted_edges)
+            local_s = scipy.optimize.minimize_scalar(
+                        newNetworkSorted,
+                        bounds = bounds,
+                        method = 'Bounded', options={'disp': True},
+                        args = (sorted_dists, sorted_components,
+                                sorted_scores, sorted_edges[2], mean0, mean1,
+                                gradient, slope,
+                                partial(newNetwork,
+                                        sample_names = sample_names,
+                                        distMat = distMat,
+                                        mean0 = mean0,
+                                        mean1 = mean1,
+                                        gradient = gradient,
+                                        slope = slope,
+                                        score_idx = score_idx,
+                                        cpus = num_processes,
+                                        betweenness_sample = betweenness_sample,
+                                        sample_size = sample_size,
+                                        use_gpu = use_gpu,
+                                        score_cache = score_cache),
+                                score_cache)
+                    )
+        else:
+            local_s = scipy.optimize.minimize_scalar(
+                        newNetwork,
+                        bounds = bounds,
+                        method = 'Bounded', options={'disp': True},
+                        args = (sample_names, distMat, mean0, mean1, gradient,
+                                slope, score_idx, num_processes,
+                                betweenness_sample, sample_size, use_gpu,
+                                score_cache)
+                    )
         optimised_s = local_s.x
 
     # Convert to x_max, y_max if needed
@@ -246,10 +387,291 @@ def refineFit(distMat, sample_names, mean0, mean1, scale,
 
     return optimal_x, optimal_y, optimised_s
 
+def scoreOffsets1D(s_range, sample_names, distMat, mean0, mean1, gradient,
+                   slope = 2, score_idx = 0, num_processes = 1,
+                   betweenness_sample = betweenness_sample_default,
+                   sample_size = None, use_gpu = False, score_cache = None):
+    """Score the networks at each offset along the search line, using
+    ``poppunk_refine.thresholdIterate1D`` and :func:`growNetwork`.
+
+    Args:
+        s_range (numpy.array)
+            Sorted offsets along the line between mean0 and mean1
+        sample_names (list)
+            Sample names corresponding to distMat
+        distMat (numpy.array)
+            n x 2 array of core and accessory distances for n samples
+        mean0 (numpy.array)
+            Start point
+        mean1 (numpy.array)
+            End point
+        gradient (float)
+            Gradient of line to move along
+        slope (int)
+            Set to 0 for a vertical line, 1 for a horizontal line, or
+            2 to use a slope
+            [default = 2]
+        score_idx (int)
+            Index of score from :func:`~PopPUNK.network.networkSummary` to use
+            [default = 0]
+        num_processes (int)
+            Number of threads to use when sorting the distances
+            [default = 1]
+        betweenness_sample (int)
+            Number of sequences per component used to estimate betweenness using
+            a GPU. Smaller numbers are faster but less precise [default = 100]
+        sample_size (int)
+            Number of nodes to subsample for graph statistic calculation
+        use_gpu (bool)
+            Whether to use cugraph for graph analyses
+        score_cache (NetworkScoreCache)
+            Scores of networks already made, which is added to
+            [default = None]
+
+    Returns:
+        scores (numpy.array)
+            -1 * network score at each offset. NaN for an empty network
+        components (numpy.array)
+            Number of components at each offset
+    """
+    i_vec, j_vec, idx_vec = \
+        poppunk_refine.thresholdIterate1D(distMat, s_range, slope,
+                                          mean0[0], mean0[1],
+                                          mean1[0], mean1[1], num_processes)
+    if len(idx_vec) == distMat.shape[0]:
+        raise RuntimeError("Boundary range includes all points")
+    scores = np.full(len(s_range), np.nan)
+    components = np.full(len(s_range), len(sample_names))
+    if len(idx_vec) > 0:
+        group_scores, group_components = \
+            growNetwork(sample_names,
+                        i_vec,
+                        j_vec,
+                        idx_vec,
+                        s_range,
+                        score_idx,
+                        betweenness_sample = betweenness_sample,
+                        sample_size = sample_size,
+                        use_gpu = use_gpu,
+                        score_cache = score_cache,
+                        boundary = (slope, gradient),
+                        return_components = True)
+        # Offsets where no edges are added have the network of the last
+        # offset which added edges
+        groups = np.unique(idx_vec)
+        last_group = np.searchsorted(groups, np.arange(len(s_range)),
+                                     side = 'right') - 1
+        has_edges = last_group >= 0
+        scores[has_edges] = \
+            np.asarray(group_scores)[groups[last_group[has_edges]]]
+        components[has_edges] = \
+            np.asarray(group_components)[groups[last_group[has_edges]]]
+    return scores, components
+
+def scoreGrid2D(x_max, y_max, sample_names, distMat, score_idx = 0,
+                num_processes = 1, betweenness_sample = betweenness_sample_default,
+                sample_size = None, use_gpu = False, score_cache = None):
+    """Score the networks at each point of a grid of boundary intercepts,
+    using :func:`newNetwork2D` for each y-intercept.
+
+    Args:
+        x_max (numpy.array)
+            Sorted x-intercepts to search
+        y_max (numpy.array)
+            Sorted y-intercepts to search
+        sample_names (list)
+            Sample names corresponding to distMat
+        distMat (numpy.array)
+            n x 2 array of core and accessory distances for n samples
+        score_idx (int)
+            Index of score from :func:`~PopPUNK.network.networkSummary` to use
+            [default = 0]
+        num_processes (int)
+            Number of threads to score the y-intercepts over
+            [default = 1]
+        betweenness_sample (int)
+            Number of sequences per component used to estimate betweenness using
+            a GPU. Smaller numbers are faster but less precise [default = 100]
+        sample_size (int)
+            Number of nodes to subsample for graph statistic calculation
+        use_gpu (bool)
+            Whether to use cugraph for graph analyses
+        score_cache (NetworkScoreCache)
+            Scores of networks already made, which is added to
+            [default = None]
+
+    Returns:
+        global_s (numpy.array)
+            -1 * network score at each point, with x varying fastest.
+            Empty networks score 1
+    """
+    if use_gpu:
+        global_s = map(partial(newNetwork2D,
+                               sample_names = sample_names,
+                               distMat = distMat,
+                               x_range = x_max,
+                               y_range = y_max,
+                               score_idx = score_idx,
+                               betweenness_sample = betweenness_sample,
+                               sample_size = sample_size,
+                               use_gpu = True,
+                               score_cache = score_cache),
+                       range(len(y_max)))
+    else:
+        if gt.openmp_enabled():
+            gt.openmp_set_num_threads(1)
+
+        # Threads share distMat and the score cache. The boundary
+        # iteration and default score release the GIL
+        with ThreadPool(processes = num_processes) as pool:
+            global_s = pool.map(partial(newNetwork2D,
+                                        sample_names = sample_names,
+                                        distMat = distMat,
+                                        x_range = x_max,
+                                        y_range = y_max,
+                                        score_idx = score_idx,
+                                        betweenness_sample = betweenness_sample,
+                                        sample_size = sample_size,
+                                        use_gpu = False,
+                                        score_cache = score_cache),
+                                range(len(y_max)))
+
+        if gt.openmp_enabled():
+            gt.openmp_set_num_threads(num_processes)
+
+    global_s = np.array(list(chain.from_iterable(global_s)))
+    global_s[np.isnan(global_s)] = 1
+    return global_s
+
+def adaptiveSearch1D(score_offsets, lower_s, upper_s, tolerance,
+                     resolution = adaptive_grid_resolution):
+    """Coarse-to-fine grid search along the search line.
+
+    Starts with a coarse grid, then repeatedly scores a finer grid between
+    the neighbours of the best point, and across the largest change in the
+    number of components, until the points there are closer than tolerance.
+
+    Args:
+        score_offsets (function)
+            Called with sorted offsets, returning their scores and numbers
+            of components (e.g. :func:`scoreOffsets1D`)
+        lower_s (float)
+            Start of the search range
+        upper_s (float)
+            End of the search range
+        tolerance (float)
+            Stop refining intervals narrower than this
+        resolution (int)
+            Points in each grid [default = 9]
+
+    Returns:
+        s_range (numpy.array)
+            Sorted offsets which were scored
+        scores (numpy.array)
+            -1 * network score at each offset
+    """
+    s_range = np.array([])
+    scores = np.array([])
+    components = np.array([])
+    intervals = [(lower_s, upper_s)]
+    while len(intervals) > 0:
+        new_s = np.unique(np.concatenate([np.linspace(lower, upper, num = resolution)
+                                          for lower, upper in intervals]))
+        new_s = new_s[np.logical_not(np.isin(new_s, s_range))]
+        if len(new_s) == 0:
+            break
+        new_scores, new_components = score_offsets(new_s)
+
+        s_range = np.concatenate((s_range, new_s))
+        scores = np.concatenate((scores, new_scores))
+        components = np.concatenate((components, new_components))
+        s_order = np.argsort(s_range)
+        s_range = s_range[s_order]
+        scores = scores[s_order]
+        components = components[s_order]
+
+        intervals = []
+        min_idx = np.argmin(np.where(np.isnan(scores), 1, scores))
+        lower = s_range[max(min_idx - 1, 0)]
+        upper = s_range[min(min_idx + 1, len(s_range) - 1)]
+        if max(s_range[min_idx] - lower, upper - s_range[min_idx]) > tolerance:
+            intervals.append((lower, upper))
+        component_change = np.abs(np.diff(components))
+        change_idx = np.argmax(component_change)
+        if component_change[change_idx] > 0 and \
+                s_range[change_idx + 1] - s_range[change_idx] > tolerance and \
+                not (s_range[change_idx] >= lower and s_range[change_idx + 1] <= upper):
+            intervals.append((s_range[change_idx], s_range[change_idx + 1]))
+
+    sys.stderr.write(f"Adaptive search scored {len(s_range)} boundary positions\n")
+    return s_range, scores
+
+def adaptiveSearch2D(score_grid, x_max_start, x_max_end, y_max_start, y_max_end,
+                     tolerance, resolution = adaptive_grid_resolution):
+    """Coarse-to-fine grid search over boundary intercepts.
+
+    Starts with a coarse grid, then repeatedly scores a finer grid between
+    the neighbours of the best point, until the grid spacing is below
+    tolerance.
+
+    Args:
+        score_grid (function)
+            Called with sorted x- and y-intercepts, returning the score at each
+            point with x varying fastest (e.g. :func:`scoreGrid2D`)
+        x_max_start (float)
+            Lowest x-intercept to search
+        x_max_end (float)
+            Highest x-intercept to search
+        y_max_start (float)
+            Lowest y-intercept to search
+        y_max_end (float)
+            Highest y-intercept to search
+        tolerance (float)
+            Stop when the grid spacing is below this on both axes
+        resolution (int)
+            Points along each axis of each grid [default = 9]
+
+    Returns:
+        optimal_x (float)
+            x-intercept of the best boundary
+        optimal_y (float)
+            y-intercept of the best boundary
+        optimised_s (float)
+            -1 * network score of the best boundary
+        delta (float)
+            Spacing of x-intercepts in the final grid
+    """
+    optimised_s = None
+    n_scored = 0
+    while True:
+        x_max = np.linspace(x_max_start, x_max_end, resolution, dtype=np.float32)
+        y_max = np.linspace(y_max_start, y_max_end, resolution, dtype=np.float32)
+        global_s = score_grid(x_max, y_max)
+        n_scored += len(global_s)
+
+        min_idx = np.argmin(global_s)
+        x_idx = min_idx % resolution
+        y_idx = min_idx // resolution
+        if optimised_s is None or global_s[min_idx] < optimised_s:
+            optimal_x = x_max[x_idx]
+            optimal_y = y_max[y_idx]
+            optimised_s = global_s[min_idx]
+
+        delta = x_max[1] - x_max[0]
+        if delta <= tolerance and y_max[1] - y_max[0] <= tolerance:
+            break
+        x_max_start = x_max[max(x_idx - 1, 0)]
+        x_max_end = x_max[min(x_idx + 1, resolution - 1)]
+        y_max_start = y_max[max(y_idx - 1, 0)]
+        y_max_end = y_max[min(y_idx + 1, resolution - 1)]
+
+    sys.stderr.write(f"Adaptive search scored {n_scored} boundary positions\n")
+    return optimal_x, optimal_y, optimised_s, delta
+
 def multi_refine(distMat, sample_names, mean0, mean1, scale, s_max,
                  n_boundary_points, output_prefix, num_processes = 1,
                  betweenness_sample = betweenness_sample_default, sample_size = None,
-                 use_gpu = False):
+                 use_gpu = False, score_cache = None):
     """Move the refinement boundary between the optimum and where it meets an
     axis. Discrete steps, output the clusers at each step
 
@@ -278,6 +700,9 @@ def multi_refine(distMat, sample_names, mean0, mean1, scale, s_max,
             Number of nodes to subsample for graph statistic calculation
         use_gpu (bool)
             Whether to use cugraph for graph analyses
+        score_cache (NetworkScoreCache)
+            Scores of networks already made, which is added to
+            [default = None]
     """
 
     # Set the range
@@ -309,7 +734,9 @@ def multi_refine(distMat, sample_names, mean0, mean1, scale, s_max,
                 write_clusters = output_prefix,
                 betweenness_sample = betweenness_sample,
                 sample_size = sample_size,
-                use_gpu = use_gpu)
+                use_gpu = use_gpu,
+                score_cache = score_cache,
+                boundary = (2, gradient))
 
 def check_search_range(scale, mean0, mean1, lower_s, upper_s):
     """Checks a search range is within a valid range
@@ -374,7 +801,8 @@ def expand_cugraph_network(G, G_extra_df):
 
 def growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx = 0,
                 thread_idx = 0, betweenness_sample = betweenness_sample_default,
-                write_clusters = None, sample_size = None, use_gpu = False):
+                write_clusters = None, sample_size = None, use_gpu = False,
+                score_cache = None, boundary = None, return_components = False):
     """Construct a network, then add edges to it iteratively.
     Input is from ``pp_sketchlib.iterateBoundary1D`` or``pp_sketchlib.iterateBoundary2D``
 
@@ -405,14 +833,62 @@ def growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx = 0,
             Number of nodes to subsample for graph statistic calculation
         use_gpu (bool)
             Whether to use cugraph for graph analyses
+        score_cache (NetworkScoreCache)
+            Scores of networks already made, which is added to
+            [default = None]
+        boundary (tuple or list)
+            (slope, gradient) of the boundaries, or a list of these for each
+            offset, used to look up networks in score_cache
+            [default = None]
+        return_components (bool)
+            Also return the number of components at each offset
+            [default = False]
 
     Returns:
         scores (list)
             -1 * network score for each of x_range.
             Where network score is from :func:`~PopPUNK.network.networkSummary`
+        offset_components (list)
+            Number of components for each score (if return_components)
     """
     scores = []
+    offset_components = []
     prev_idx = -1
+    if boundary is None:
+        score_cache = None
+    elif isinstance(boundary, list):
+        boundaries = boundary
+    else:
+        boundaries = [boundary] * len(s_range)
+
+    # The base score can be updated as edges are added, without rebuilding
+    # the graph at each offset
+    if score_idx == 0 and sample_size is None and write_clusters is None \
+            and not use_gpu:
+        idx_values, components, density, transitivity = \
+            poppunk_refine.scoreEdgeStream(np.asarray(i_vec, dtype=np.int64),
+                                           np.asarray(j_vec, dtype=np.int64),
+                                           np.asarray(idx_vec, dtype=np.int64),
+                                           len(sample_names))
+        with tqdm(total = max(idx_values) + 1,
+                  bar_format = "{bar}| {n_fmt}/{total_fmt}",
+                  ncols = 40,
+                  position = thread_idx) as pbar:
+            n_edges = np.searchsorted(idx_vec, idx_values, side = 'right')
+            for idx, idx_edges, idx_components, idx_density, idx_transitivity in \
+                    zip(idx_values, n_edges, components, density, transitivity):
+                latest_score = -idx_transitivity * (1 - idx_density)
+                if score_cache is not None:
+                    score_cache.store(*boundaries[idx], idx_edges,
+                                      idx_components, latest_score)
+                for s in range(prev_idx, idx):
+                    scores.append(latest_score)
+                    offset_components.append(idx_components)
+                    pbar.update(1)
+                prev_idx = idx
+        if return_components:
+            return(scores, offset_components)
+        return(scores)
 
     # create data frame
     if use_gpu:
@@ -428,6 +904,7 @@ def growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx = 0,
         idx_values = edge_list_df.idx_list.unique()
 
     # Grow a network
+    n_edges = 0
     with tqdm(total = max(idx_values) + 1,
               bar_format = "{bar}| {n_fmt}/{total_fmt}",
               ncols = 40,
@@ -435,6 +912,7 @@ def growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx = 0,
         for idx in idx_values:
             # Create DF
             edge_df = edge_list_df.loc[(edge_list_df['idx_list']==idx),['source','destination']]
+            n_edges += len(edge_df)
             # At first offset, make a new network, otherwise just add the new edges
             if prev_idx == -1:
                 G = construct_network_from_df(sample_names, sample_names,
@@ -449,18 +927,29 @@ def growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx = 0,
                     G.add_edge_list(edge_list)
                     edge_list = []
             # Add score into vector for any offsets passed (should usually just be one)
-            G_summary = networkSummary(G,
-                                score_idx > 0,
-                                betweenness_sample = betweenness_sample,
-                                subsample = sample_size,
-                                use_gpu = use_gpu)
-            latest_score = -G_summary[1][score_idx]
+            cached = None
+            if score_cache is not None:
+                cached = score_cache.lookup(*boundaries[idx], n_edges)
+            if cached is None:
+                G_summary = networkSummary(G,
+                                    score_idx > 0,
+                                    betweenness_sample = betweenness_sample,
+                                    subsample = sample_size,
+                                    use_gpu = use_gpu)
+                components = G_summary[0][0]
+                latest_score = -G_summary[1][score_idx]
+                if score_cache is not None:
+                    score_cache.store(*boundaries[idx], n_edges,
+                                      components, latest_score)
+            else:
+                components, latest_score = cached
             for s in range(prev_idx, idx):
                 scores.append(latest_score)
+                offset_components.append(components)
                 pbar.update(1)
                 # Write the cluster output as long as there is at least one
                 # non-trivial cluster
-                if write_clusters and G_summary[0][0] < len(sample_names):
+                if write_clusters and components < len(sample_names):
                     o_prefix = \
                         f"{write_clusters}/{os.path.basename(write_clusters)}_boundary{s + 1}"
                     printClusters(G,
@@ -471,11 +960,142 @@ def growNetwork(sample_names, i_vec, j_vec, idx_vec, s_range, score_idx = 0,
 
             prev_idx = idx
 
+    if return_components:
+        return(scores, offset_components)
     return(scores)
 
+def lineBoundary(s, mean0, mean1, gradient, slope=2):
+    """Intercepts of the boundary at distance s along the search line
+
+    Args:
+        s (float)
+            Distance along line between start_point and mean1 from start_point
+        mean0 (numpy.array)
+            Start point
+        mean1 (numpy.array)
+            End point
+        gradient (float)
+            Gradient of line to move along
+        slope (int)
+            Set to 0 for a vertical line, 1 for a horizontal line, or
+            2 to use a slope
+            [default = 2]
+
+    Returns:
+        x_max (float)
+            The x-axis intercept of the boundary
+        y_max (float)
+            The y-axis intercept of the boundary
+    """
+    new_intercept = transformLine(s, mean0, mean1)
+    if slope == 2:
+        x_max, y_max = decisionBoundary(new_intercept, gradient)
+    elif slope == 0:
+        x_max = new_intercept[0]
+        y_max = 0
+    elif slope == 1:
+        x_max = 0
+        y_max = new_intercept[1]
+    return x_max, y_max
+
+def sortedNetworkScores(sample_names, distMat, i_vec, j_vec, n_base):
+    """Score a network as edges are added in boundary order.
+
+    The first n_base edges are added together, then the rest one at a time.
+
+    Args:
+        sample_names (list)
+            Sample names corresponding to distMat
+        distMat (numpy.array)
+            Core and accessory distances
+        i_vec (numpy.array)
+            Ordered ref vertex index to add, from
+            ``poppunk_refine.thresholdIterate1D``
+        j_vec (numpy.array)
+            Ordered query (==ref) vertex index to add
+        n_base (int)
+            Number of edges in the network before the local search
+
+    Returns:
+        sorted_dists (numpy.array)
+            Distances of the edges after the first n_base, in order
+        sorted_components (numpy.array)
+            Number of components after adding the first n_base edges, then
+            each following edge
+        sorted_scores (numpy.array)
+            -1 * network score after adding the first n_base edges, then
+            each following edge. NaN for an empty network
+    """
+    n_samples = len(sample_names)
+    sorted_rows = n_samples * i_vec[n_base:] - \
+        (i_vec[n_base:] * (i_vec[n_base:] + 1)) // 2 + \
+        j_vec[n_base:] - i_vec[n_base:] - 1
+    sorted_dists = np.ascontiguousarray(distMat[sorted_rows, :])
+
+    n_sorted = len(sorted_rows)
+    idx_vec = np.concatenate((np.zeros(n_base, dtype=np.int64),
+                              np.arange(1, n_sorted + 1, dtype=np.int64)))
+    idx_values, components, density, transitivity = \
+        poppunk_refine.scoreEdgeStream(i_vec, j_vec, idx_vec, n_samples)
+    sorted_components = np.full(n_sorted + 1, n_samples)
+    sorted_components[idx_values] = components
+    sorted_scores = np.full(n_sorted + 1, np.nan)
+    sorted_scores[idx_values] = -np.asarray(transitivity) * \
+        (1 - np.asarray(density))
+    return sorted_dists, sorted_components, sorted_scores
+
+def newNetworkSorted(s, sorted_dists, sorted_components, sorted_scores, n_base,
+                     mean0, mean1, gradient, slope, fallback, score_cache = None):
+    """Score the network at a boundary from scores precomputed by
+    :func:`~PopPUNK.refine.sortedNetworkScores`, which is called by the local
+    optimisation in :func:`~PopPUNK.refine.refineFit`.
+
+    Args:
+        s (float)
+            Distance along line between start_point and mean1 from start_point
+        sorted_dists (numpy.array)
+            Distances of the edges which may be added, in boundary order
+        sorted_components (numpy.array)
+            Number of components after adding each number of these edges
+        sorted_scores (numpy.array)
+            -1 * network score after adding each number of these edges
+        n_base (int)
+            Number of edges in the network before any of these are added
+        mean0 (numpy.array)
+            Start point
+        mean1 (numpy.array)
+            End point
+        gradient (float)
+            Gradient of line to move along
+        slope (int)
+            Set to 0 for a vertical line, 1 for a horizontal line, or
+            2 to use a slope
+        fallback (function)
+            Called with s to score the network from scratch, if the edges
+            within this boundary are not the first in the sorted order
+        score_cache (NetworkScoreCache)
+            Scores of networks already made, which is added to
+            [default = None]
+
+    Returns:
+        score (float)
+            -1 * network score. Where network score is from :func:`~PopPUNK.network.networkSummary`
+    """
+    x_max, y_max = lineBoundary(s, mean0, mean1, gradient, slope)
+    admitted = poppunk_refine.assignThreshold(sorted_dists, slope,
+                                              x_max, y_max) <= 0
+    n_admitted = np.count_nonzero(admitted)
+    if not np.all(admitted[:n_admitted]):
+        return fallback(s)
+    if score_cache is not None:
+        score_cache.store(slope, gradient, n_base + n_admitted,
+                          sorted_components[n_admitted],
+                          sorted_scores[n_admitted])
+    return sorted_scores[n_admitted]
+
 def newNetwork(s, sample_names, distMat, mean0, mean1, gradient,
                slope=2, score_idx=0, cpus=1, betweenness_sample = betweenness_sample_default,
-               sample_size = None, use_gpu = False):
+               sample_size = None, use_gpu = False, score_cache = None):
     """Wrapper function for :func:`~PopPUNK.network.construct_network_from_edge_list` which is called
     by optimisation functions moving a triangular decision boundary.
 
@@ -511,6 +1131,9 @@ def newNetwork(s, sample_names, distMat, mean0, mean1, gradient,
             Number of nodes to subsample for graph statistic calculation
         use_gpu (bool)
             Whether to use cugraph for graph analysis
+        score_cache (NetworkScoreCache)
+            Scores of networks already made, which is added to
+            [default = None]
 
     Returns:
         score (float)
@@ -521,18 +1144,14 @@ def newNetwork(s, sample_names, distMat, mean0, mean1, gradient,
         distMat = np.ndarray(distMat.shape, dtype = distMat.dtype, buffer = distMat_shm.buf)
 
     # Set up boundary
-    new_intercept = transformLine(s, mean0, mean1)
-    if slope == 2:
-        x_max, y_max = decisionBoundary(new_intercept, gradient)
-    elif slope == 0:
-        x_max = new_intercept[0]
-        y_max = 0
-    elif slope == 1:
-        x_max = 0
-        y_max = new_intercept[1]
+    x_max, y_max = lineBoundary(s, mean0, mean1, gradient, slope)
 
     # Make network
     connections = poppunk_refine.edgeThreshold(distMat, slope, x_max, y_max)
+    if score_cache is not None:
+        cached = score_cache.lookup(slope, gradient, len(connections))
+        if cached is not None:
+            return(cached[1])
     G = construct_network_from_edge_list(sample_names,
                                         sample_names,
                                         connections,
@@ -540,16 +1159,20 @@ def newNetwork(s, sample_names, distMat, mean0, mean1, gradient,
                                         use_gpu = use_gpu)
 
     # Return score
-    score = networkSummary(G,
-                            score_idx > 0,
-                            subsample = sample_size,
-                            betweenness_sample = betweenness_sample,
-                            use_gpu = use_gpu)[1][score_idx]
+    G_summary = networkSummary(G,
+                               score_idx > 0,
+                               subsample = sample_size,
+                               betweenness_sample = betweenness_sample,
+                               use_gpu = use_gpu)
+    score = G_summary[1][score_idx]
+    if score_cache is not None:
+        score_cache.store(slope, gradient, len(connections),
+                          G_summary[0][0], -score)
     return(-score)
 
 def newNetwork2D(y_idx, sample_names, distMat, x_range, y_range, score_idx=0,
                  betweenness_sample = betweenness_sample_default, sample_size = None,
-                 use_gpu = False):
+                 use_gpu = False, score_cache = None):
     """Wrapper function for thresholdIterate2D and :func:`growNetwork`.
 
     For a given y_max, constructs networks across x_range and returns a list
@@ -560,8 +1183,9 @@ def newNetwork2D(y_idx, sample_names, distMat, x_range, y_range, score_idx=0,
             Maximum y-intercept of boundary, as index into y_range
         sample_names (list)
             Sample names corresponding to distMat (accessed by iterator)
-        distMat (numpy.array or NumpyShared)
-            Core and accessory distances or NumpyShared describing these in sharedmem
+        distMat (numpy.array)
+            Core and accessory distances, as a float32 array shared by
+            the threads searching each y_max
         x_range (list)
             Sorted list of x-intercepts to search
         y_range (list)
@@ -576,6 +1200,9 @@ def newNetwork2D(y_idx, sample_names, distMat, x_range, y_range, score_idx=0,
             Number of nodes to subsample for graph statistic calculation
         use_gpu (bool)
             Whether to use cugraph for graph analysis
+        score_cache (NetworkScoreCache)
+            Scores of networks already made, which is added to
+            [default = None]
 
     Returns:
         scores (list)
@@ -584,9 +1211,6 @@ def newNetwork2D(y_idx, sample_names, distMat, x_range, y_range, score_idx=0,
     """
     if gt.openmp_enabled():
         gt.openmp_set_num_threads(1)
-    if isinstance(distMat, NumpyShared):
-        distMat_shm = shared_memory.SharedMemory(name = distMat.name)
-        distMat = np.ndarray(distMat.shape, dtype = distMat.dtype, buffer = distMat_shm.buf)
 
     y_max = y_range[y_idx]
     i_vec, j_vec, idx_vec = \
@@ -605,7 +1229,9 @@ def newNetwork2D(y_idx, sample_names, distMat, x_range, y_range, score_idx=0,
                                 y_idx,
                                 betweenness_sample,
                                 sample_size = sample_size,
-                                use_gpu = use_gpu)
+                                use_gpu = use_gpu,
+                                score_cache = score_cache,
+                                boundary = [(2, x_max / y_max) for x_max in x_range])
 
     return(scores)
 
@@ -21,6 +21,7 @@ from .utils import readRfile, stderr_redirected
 from .plot import plot_fit
 
 sketchlib_exe = "sketchlib"
+sketch_metadata_group = "sketch_metadata"
 
 def checkSketchlibVersion():
     """Checks that sketchlib can be run, and returns version
@@ -213,6 +214,131 @@ def getSeqsInDb(dbname):
 
     return seqs
 
+def buildSketchMetadata(hdf_in, names = None):
+    """Read the per-sample sketch attributes into a table, one sample
+    at a time. Used when a database does not already have a table,
+    see :func:`readSketchMetadata`
+
+    Args:
+        hdf_in (h5py.File)
+            Open sketch database
+        names (list)
+            Samples to include. If None, all samples in the database
+
+    Returns:
+        metadata (dict)
+            Arrays of name, length, missing_bases, base_freq, reads and
+            sketchsize64, in the order of names
+    """
+    read_grp = hdf_in['sketches']
+    if names is None:
+        names = list(read_grp.keys())
+    metadata = {'names': list(names),
+                'length': np.zeros(len(names), dtype = np.int64),
+                'missing_bases': np.zeros(len(names), dtype = np.int64),
+                'base_freq': np.zeros((len(names), 4), dtype = np.float64),
+                'reads': np.zeros(len(names), dtype = bool),
+                'sketchsize64': np.zeros(len(names), dtype = np.int64)}
+    for idx, sample_name in enumerate(names):
+        attrs = read_grp[sample_name].attrs
+        metadata['length'][idx] = attrs['length']
+        metadata['missing_bases'][idx] = attrs['missing_bases']
+        metadata['base_freq'][idx, :] = attrs['base_freq']
+        # Older versions of DB do not save reads, so attr may not be present
+        if 'reads' in attrs:
+            metadata['reads'][idx] = attrs['reads']
+        metadata['sketchsize64'][idx] = attrs['sketchsize64']
+    return metadata
+
+def subsetSketchMetadata(metadata, names):
+    """Reorder a table of per-sample sketch attributes
+
+    Args:
+        metadata (dict)
+            Table, as returned by :func:`readSketchMetadata`
+        names (list)
+            Samples to return, in this order
+
+    Returns:
+        metadata (dict)
+            Table with the rows for names. Missing samples raise
+            a KeyError
+    """
+    names = list(names)
+    name_index = {name: idx for idx, name in enumerate(metadata['names'])}
+    missing = [name for name in names if name not in name_index]
+    if len(missing) > 0:
+        raise KeyError("Samples not found in sketch metadata: " + ", ".join(missing))
+    order = np.array([name_index[name] for name in names], dtype = np.int64)
+    return {field: (names if field == 'names' else values[order])
+            for field, values in metadata.items()}
+
+def writeSketchMetadata(db_file, metadata = None):
+    """Store the table of per-sample sketch attributes in a
+    sketch database, replacing any existing table
+
+    Args:
+        db_file (str)
+            Path to the .h5 sketch database
+        metadata (dict)
+            Table to store, as returned by :func:`readSketchMetadata`,
+            which must contain every sample in the database.
+            If None, this is built from the sketches in the database
+    """
+    with h5py.File(db_file, 'r+') as hdf_out:
+        if metadata is None:
+            metadata = buildSketchMetadata(hdf_out)
+        else:
+            # Rows are stored in the same order as the sketches
+            db_names = list(hdf_out['sketches'].keys())
+            if metadata['names'] != db_names:
+                metadata = subsetSketchMetadata(metadata, db_names)
+        if sketch_metadata_group in hdf_out:
+            del hdf_out[sketch_metadata_group]
+        meta_grp = hdf_out.create_group(sketch_metadata_group)
+        meta_grp.create_dataset('names', data = metadata['names'],
+                                dtype = h5py.string_dtype())
+        for field in ['length', 'missing_bases', 'base_freq', 'reads', 'sketchsize64']:
+            meta_grp.create_dataset(field, data = metadata[field])
+
+def readSketchMetadata(db_file, names = None):
+    """Read the per-sample sketch attributes of a database in one go
+
+    Databases without a stored table (or where the sketches no longer
+    match it) are read sample by sample into memory. The database is
+    never written to here; tables are stored where PopPUNK creates or
+    updates a database, see :func:`writeSketchMetadata`.
+
+    Args:
+        db_file (str)
+            Path to the .h5 sketch database
+        names (list)
+            Samples to return, in this order. If None, all samples in the
+            database in the order they are stored. Missing samples are
+            an error
+
+    Returns:
+        metadata (dict)
+            Arrays of name, length, missing_bases, base_freq, reads and
+            sketchsize64
+    """
+    with h5py.File(db_file, 'r') as hdf_in:
+        db_names = list(hdf_in['sketches'].keys())
+        metadata = None
+        if sketch_metadata_group in hdf_in:
+            meta_grp = hdf_in[sketch_metadata_group]
+            stored_names = meta_grp['names'].asstr()[:].tolist()
+            if stored_names == db_names:
+                metadata = {'names': stored_names}
+                for field in ['length', 'missing_bases', 'base_freq', 'reads', 'sketchsize64']:
+                    metadata[field] = meta_grp[field][:]
+        if metadata is None:
+            metadata = buildSketchMetadata(hdf_in, db_names)
+
+    if names is not None:
+        metadata = subsetSketchMetadata(metadata, names)
+    return metadata
+
 def joinDBs(db1, db2, output, update_random = None, full_names = False):
     """Join two sketch databases with the low-level HDF5 copy interface
 
@@ -292,6 +418,13 @@ def joinDBs(db1, db2, output, update_random = None, full_names = False):
     # Rename results to correct location
     os.rename(join_prefix + ".tmp.h5", join_prefix + ".h5")
 
+    # Combine the sample metadata tables
+    metadata = [readSketchMetadata(db1_name), readSketchMetadata(db2_name)]
+    join_metadata = {'names': metadata[0]['names'] + metadata[1]['names']}
+    for field in ['length', 'missing_bases', 'base_freq', 'reads', 'sketchsize64']:
+        join_metadata[field] = np.concatenate([metadata[0][field], metadata[1][field]])
+    writeSketchMetadata(join_prefix + ".h5", join_metadata)
+
 
 def removeFromDB(db_name, out_name, removeSeqs, full_names = False):
     """Remove sketches from the DB the low-level HDF5 copy interface
@@ -345,6 +478,10 @@ def removeFromDB(db_name, out_name, removeSeqs, full_names = False):
     hdf_in.close()
     hdf_out.close()
 
+    # Keep the rows of the sample metadata table for retained samples
+    metadata = readSketchMetadata(db_file)
+    writeSketchMetadata(out_file, metadata)
+
 def constructDatabase(assemblyList, klist, sketch_size, oPrefix,
                         threads, overwrite,
                         strand_preserved, min_count,
@@ -431,6 +568,9 @@ def constructDatabase(assemblyList, klist, sketch_size, oPrefix,
                   overwrite = True,
                   threads = threads)
 
+    # Store sample metadata, so it can be read without visiting each sketch
+    writeSketchMetadata(dbfilename)
+
     return names
 
 
@@ -677,12 +817,5 @@ def get_database_statistics(prefix):
             Prefix of database
     """
     db_file = prefix + "/" + os.path.basename(prefix) + ".h5"
-    ref_db = h5py.File(db_file, 'r')
-
-    genome_lengths = []
-    ambiguous_bases = []
-    for sample_name in list(ref_db['sketches'].keys()):
-        genome_lengths.append(ref_db['sketches/' + sample_name].attrs['length'])
-        ambiguous_bases.append(ref_db['sketches/' + sample_name].attrs['missing_bases'])
-        
-    return genome_lengths, ambiguous_bases
+    metadata = readSketchMetadata(db_file)
+    return metadata['length'].tolist(), metadata['missing_bases'].tolist()
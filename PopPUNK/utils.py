@@ -8,6 +8,8 @@ import os
 import sys
 # additional
 import pickle
+import json
+import shutil
 import multiprocessing
 from collections import defaultdict
 from itertools import chain
@@ -17,6 +19,7 @@ import contextlib
 
 import numpy as np
 import pandas as pd
+import h5py
 
 try:
     import cudf
@@ -132,11 +135,24 @@ def setupDBFuncs(args):
 
     return dbFuncs
 
-def storePickle(rlist, qlist, self, X, pklName):
+# Encodings for the HDF5 distance container
+dist_formats = ['npy', 'hdf5', 'hdf5-16bit']
+quantised_max = np.iinfo(np.uint16).max
+dist_columns = ['core', 'accessory']
+coreset_bins = 128
+
+def storePickle(rlist, qlist, self, X, pklName, dist_format = 'npy'):
     """Saves core and accessory distances in a .npy file, names in a .pkl
 
     Called during ``--create-db``
 
+    With ``dist_format = 'hdf5'`` the distances are instead written to a
+    single ``.h5`` container with separate compressed core and accessory
+    columns, the sequence names and the self flag. ``'hdf5-16bit'``
+    additionally stores each distance as a 16-bit integer (distances are
+    in [0, 1], so the rounding error is below 1e-5). The ``.pkl`` is
+    always written, for tools which only need the names.
+
     Args:
         rlist (list)
             List of reference sequence names (for :func:`~iterDistRows`)
@@ -150,18 +166,190 @@ def storePickle(rlist, qlist, self, X, pklName):
             If None, do not save
         pklName (str)
             Prefix for output files
+        dist_format (str)
+            One of ``'npy'``, ``'hdf5'`` or ``'hdf5-16bit'``
+
+            [default = 'npy']
+    """
+    if isinstance(X, np.ndarray):
+        storeDistanceChunks(rlist, qlist, self, X.shape[0], [X], pklName,
+                            dtype = X.dtype, dist_format = dist_format)
+    else:
+        if dist_format not in dist_formats:
+            raise RuntimeError("Unknown distance format " + str(dist_format))
+        with open(pklName + ".pkl", 'wb') as pickle_file:
+            pickle.dump([rlist, qlist, self], pickle_file)
+
+
+def storeDistanceChunks(rlist, qlist, self, n_rows, blocks, pklName,
+                        dtype = np.float32, dist_format = 'npy'):
+    """Saves distances passed as consecutive blocks of rows, as in
+    :func:`~storePickle`, without needing them all in memory at once
+
+    Args:
+        rlist (list)
+            List of reference sequence names (for :func:`~iterDistRows`)
+        qlist (list)
+            List of query sequence names (for :func:`~iterDistRows`)
+        self (bool)
+            Whether an all-vs-all self DB (for :func:`~iterDistRows`)
+        n_rows (int)
+            Total number of rows in blocks
+        blocks (iterable)
+            Arrays of core and accessory distances, in row order
+        pklName (str)
+            Prefix for output files
+        dtype (numpy.dtype)
+            Type of the saved .npy
+
+            [default = np.float32]
+        dist_format (str)
+            One of ``'npy'``, ``'hdf5'`` or ``'hdf5-16bit'``
+
+            [default = 'npy']
     """
+    if dist_format not in dist_formats:
+        raise RuntimeError("Unknown distance format " + str(dist_format))
+
     with open(pklName + ".pkl", 'wb') as pickle_file:
         pickle.dump([rlist, qlist, self], pickle_file)
-    if isinstance(X, np.ndarray):
-        np.save(pklName + ".npy", X)
 
+    dist_suffix = distFileSuffix(dist_format)
+    writeDistanceFile(pklName + dist_suffix, n_rows, blocks, dtype = dtype,
+                      dist_format = dist_format, rlist = rlist, qlist = qlist,
+                      self = self)
+    # readPickle picks up a segmented store, then the .h5, first, so do not
+    # leave an old one behind
+    removeDistanceSegments(pklName)
+    for stale_suffix in [".npy", ".h5"]:
+        if stale_suffix != dist_suffix and os.path.isfile(pklName + stale_suffix):
+            os.remove(pklName + stale_suffix)
+
+
+def distFileSuffix(dist_format):
+    """File extension used for a distance format
 
-def readPickle(pklName, enforce_self=False, distances=True):
+    Args:
+        dist_format (str)
+            One of ``'npy'``, ``'hdf5'`` or ``'hdf5-16bit'``
+
+    Returns:
+        suffix (str)
+            ``'.npy'`` or ``'.h5'``
+    """
+    if dist_format not in dist_formats:
+        raise RuntimeError("Unknown distance format " + str(dist_format))
+    return ".npy" if dist_format == 'npy' else ".h5"
+
+
+def writeDistanceFile(distName, n_rows, blocks, dtype = np.float32,
+                      dist_format = 'npy', rlist = [], qlist = [], self = True):
+    """Write a single .npy or .h5 file of distances, passed as consecutive
+    blocks of rows
+
+    Written to a temporary file then renamed, so any DistanceStore still
+    mapping an old file of the same name keeps a valid view of it.
+
+    Args:
+        distName (str)
+            File to write, with the suffix from :func:`~distFileSuffix`
+        n_rows (int)
+            Total number of rows in blocks
+        blocks (iterable)
+            Arrays of core and accessory distances, in row order
+        dtype (numpy.dtype)
+            Type of a saved .npy
+        dist_format (str)
+            One of ``'npy'``, ``'hdf5'`` or ``'hdf5-16bit'``
+        rlist (list)
+            Reference names stored in a .h5 container
+        qlist (list)
+            Query names stored in a .h5 container
+        self (bool)
+            Self flag stored in a .h5 container
+    """
+    if dist_format == 'npy':
+        tmpName = distName[:-len(".npy")] + ".tmp.npy"
+        out_mat = np.lib.format.open_memmap(tmpName, mode = 'w+',
+                                            dtype = dtype, shape = (n_rows, 2))
+        start = 0
+        for block in blocks:
+            out_mat[start:(start + block.shape[0]), :] = block
+            start += block.shape[0]
+        if start != n_rows:
+            raise RuntimeError("Expected " + str(n_rows) + " distances, got " + str(start))
+        out_mat.flush()
+        del out_mat
+    else:
+        tmpName = distName[:-len(".h5")] + ".tmp.h5"
+        writeDistanceContainer(tmpName, rlist, qlist, self, n_rows, blocks,
+                               quantise = (dist_format == 'hdf5-16bit'))
+    os.replace(tmpName, distName)
+
+
+def writeDistanceContainer(h5Name, rlist, qlist, self, n_rows, blocks,
+                           quantise = False, chunk_size = 1000000):
+    """Write distances to a HDF5 container, one compressed dataset per column
+
+    Args:
+        h5Name (str)
+            File to write
+        rlist (list)
+            List of reference sequence names
+        qlist (list)
+            List of query sequence names
+        self (bool)
+            Whether an all-vs-all self DB
+        n_rows (int)
+            Total number of rows in blocks
+        blocks (iterable)
+            Arrays of core and accessory distances, in row order
+        quantise (bool)
+            Store distances as 16-bit integers
+
+            [default = False]
+        chunk_size (int)
+            Rows per HDF5 chunk, and per write
+
+            [default = 1000000]
+    """
+    store_dtype = np.uint16 if quantise else np.float32
+    with h5py.File(h5Name, 'w') as h5_file:
+        h5_file.attrs['self'] = self
+        h5_file.attrs['quantised'] = quantise
+        h5_file.create_dataset('rlist', data = rlist, dtype = h5py.string_dtype())
+        h5_file.create_dataset('qlist', data = qlist, dtype = h5py.string_dtype())
+        dsets = []
+        for col_name in dist_columns:
+            dsets.append(h5_file.create_dataset(col_name,
+                                                shape = (n_rows,),
+                                                dtype = store_dtype,
+                                                chunks = (min(chunk_size, n_rows),) if n_rows > 0 else None,
+                                                compression = 'gzip' if n_rows > 0 else None,
+                                                shuffle = n_rows > 0))
+        offset = 0
+        for block in blocks:
+            for start in range(0, block.shape[0], chunk_size):
+                end = min(start + chunk_size, block.shape[0])
+                for col, dset in enumerate(dsets):
+                    values = block[start:end, col]
+                    if quantise:
+                        values = np.rint(np.clip(values, 0, 1) * quantised_max)
+                    dset[(offset + start):(offset + end)] = values.astype(store_dtype)
+            offset += block.shape[0]
+        if offset != n_rows:
+            raise RuntimeError("Expected " + str(n_rows) + " distances, got " + str(offset))
+
+
+def readPickle(pklName, enforce_self=False, distances=True, mmap=False):
     """Loads core and accessory distances saved by :func:`~storePickle`
 
     Called during ``--fit-model``
 
+    Reads a segmented store written by :func:`~appendDistanceSegments` if
+    there is one, then the ``.h5`` container if one was written, otherwise
+    the ``.pkl`` and ``.npy`` pair.
+
     Args:
         pklName (str)
             Prefix for saved files
@@ -173,6 +361,12 @@ def readPickle(pklName, enforce_self=False, distances=True):
             Read the distance matrix
 
             [default = True]
+        mmap (bool)
+            Return a :class:`~DistanceStore` which reads distances from
+            disk when accessed, rather than loading the whole distance
+            matrix into memory
+
+            [default = False]
 
     Returns:
         rlist (list)
@@ -181,21 +375,633 @@ def readPickle(pklName, enforce_self=False, distances=True):
             List of query sequence names (for :func:`~iterDistRows`)
         self (bool)
             Whether an all-vs-all self DB (for :func:`~iterDistRows`)
-        X (numpy.array)
+        X (numpy.array or DistanceStore)
             n x 2 array of core and accessory distances
     """
-    with open(pklName + ".pkl", 'rb') as pickle_file:
-        rlist, qlist, self = pickle.load(pickle_file)
-        if enforce_self and (not self or rlist != qlist):
-            sys.stderr.write("Old distances " + pklName + ".npy not complete\n")
-            sys.exit(1)
+    segmented = os.path.isfile(pklName + ".segments.json")
+    if segmented:
+        dist_file = pklName + ".segments.json"
+        with open(pklName + ".pkl", 'rb') as pickle_file:
+            rlist, qlist, self = pickle.load(pickle_file)
+    elif os.path.isfile(pklName + ".h5"):
+        dist_file = pklName + ".h5"
+        with h5py.File(dist_file, 'r') as h5_file:
+            rlist = list(h5_file['rlist'].asstr()[:])
+            qlist = list(h5_file['qlist'].asstr()[:])
+            self = bool(h5_file.attrs['self'])
+    else:
+        dist_file = pklName + ".npy"
+        with open(pklName + ".pkl", 'rb') as pickle_file:
+            rlist, qlist, self = pickle.load(pickle_file)
+    if enforce_self and (not self or rlist != qlist):
+        sys.stderr.write("Old distances " + dist_file + " not complete\n")
+        sys.exit(1)
     if distances:
-        X = np.load(pklName + ".npy")
+        if segmented:
+            X = SegmentedDistanceStore(dist_file)
+        else:
+            X = DistanceStore(dist_file)
+        if not mmap:
+            with X as store:
+                X = np.asarray(store)
     else:
         X = None
     return rlist, qlist, self, X
 
 
+class DistanceStore:
+    '''Long-form distance matrix read from disk in chunks
+
+    Opens the ``.npy`` file written by :func:`~storePickle` with
+    ``mmap_mode='r'``, so rows are only paged in from disk as they are
+    accessed, or the ``.h5`` container, where only the requested rows and
+    columns are decompressed. Indexing, ``shape`` and ``dtype`` behave as
+    for a float32 array, and :func:`numpy.asarray` will load the whole
+    matrix if a consumer really does need it in memory.
+
+    Can also wrap an in-memory array, so functions which stream over
+    distances can take either.
+
+    Call :func:`~DistanceStore.close` when done, or use as a context manager,
+    to close the file.
+
+    Args:
+        X (str or numpy.array)
+            Location of a ``.npy`` or ``.h5`` file, or an array of distances
+        chunk_size (int)
+            Default number of rows returned by the iterators
+
+            [default = 1000000]
+    '''
+
+    def __init__(self, X, chunk_size = 1000000):
+        if isinstance(X, str):
+            self.filename = X
+        else:
+            self.filename = None
+            self.X = X
+        self.chunk_size = chunk_size
+        self._open()
+
+    def _open(self):
+        self.h5_file = None
+        if self.filename is None:
+            self.dist_format = 'npy'
+        elif self.filename.endswith(".h5"):
+            self.h5_file = h5py.File(self.filename, 'r')
+            self.columns = [self.h5_file[col_name] for col_name in dist_columns]
+            self.quantised = bool(self.h5_file.attrs['quantised'])
+            self.dist_format = 'hdf5-16bit' if self.quantised else 'hdf5'
+            self.X = None
+        else:
+            self.X = np.load(self.filename, mmap_mode='r')
+            self.dist_format = 'npy'
+
+    def __getstate__(self):
+        # Reopen file-backed stores in other processes rather than copying
+        state = self.__dict__.copy()
+        if self.filename is not None:
+            for attr in ['X', 'h5_file', 'columns']:
+                state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.filename is not None:
+            self._open()
+
+    def close(self):
+        '''Close the file distances are read from (if any)'''
+        if self.filename is not None:
+            if self.h5_file is not None:
+                self.h5_file.close()
+                self.h5_file = None
+                self.columns = None
+            self.X = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def shape(self):
+        if self.h5_file is not None:
+            return (self.columns[0].shape[0], len(self.columns))
+        return self.X.shape
+
+    @property
+    def dtype(self):
+        if self.h5_file is not None:
+            return np.dtype(np.float32)
+        return self.X.dtype
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def nbytes(self):
+        return self.shape[0] * self.shape[1] * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if self.h5_file is None:
+            return self.X[key]
+
+        if isinstance(key, tuple):
+            row_key, col_key = key
+        else:
+            row_key, col_key = key, slice(None)
+        if isinstance(col_key, (int, np.integer)):
+            return self._read_column(col_key, row_key)
+        cols = np.arange(len(self.columns))[col_key]
+        values = [self._read_column(col, row_key) for col in cols]
+        if isinstance(row_key, (int, np.integer)):
+            return np.array(values, dtype = np.float32)
+        return np.column_stack(values)
+
+    def _read_column(self, col, rows):
+        dset = self.columns[col]
+        if isinstance(rows, (int, np.integer)):
+            values = dset[rows:(rows + 1)]
+            return self._decode(values)[0]
+        elif isinstance(rows, slice):
+            values = dset[rows]
+        else:
+            # Gather by chunk, as point selection in HDF5 is slow
+            rows = np.asarray(rows)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+            order = np.argsort(rows, kind = 'stable')
+            sorted_rows = rows[order]
+            values = np.empty(rows.shape[0], dtype = dset.dtype)
+            bounds = np.searchsorted(sorted_rows,
+                                     np.arange(0, dset.shape[0] + self.chunk_size, self.chunk_size))
+            for chunk_idx, start in enumerate(range(0, dset.shape[0], self.chunk_size)):
+                first, last = bounds[chunk_idx], bounds[chunk_idx + 1]
+                if last > first:
+                    block = dset[start:min(start + self.chunk_size, dset.shape[0])]
+                    values[order[first:last]] = block[sorted_rows[first:last] - start]
+        return self._decode(values)
+
+    def _decode(self, values):
+        if self.quantised:
+            return values.astype(np.float32) / quantised_max
+        return np.asarray(values, dtype = np.float32)
+
+    def __array__(self, dtype = None, copy = None):
+        if self.h5_file is not None:
+            return np.asarray(self[:, :], dtype = dtype)
+        return np.asarray(self.X, dtype = dtype)
+
+    def __iter__(self):
+        for start, block in self.iter_rows():
+            yield from block
+
+    def chunks(self, chunk_size = None):
+        '''Row ranges covering the distance matrix
+
+        Args:
+            chunk_size (int)
+                Number of rows in each range (default self.chunk_size)
+
+        Returns:
+            start, end (int, int)
+                Iterable of half-open row ranges
+        '''
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        n_rows = self.shape[0]
+        for start in range(0, n_rows, chunk_size):
+            yield start, min(start + chunk_size, n_rows)
+
+    def iter_rows(self, chunk_size = None):
+        '''Iterate over blocks of rows, loaded into memory
+
+        Args:
+            chunk_size (int)
+                Number of rows in each block (default self.chunk_size)
+
+        Returns:
+            start, block (int, numpy.array)
+                Iterable of the first row index and an
+                (end - start) x 2 array of distances
+        '''
+        for start, end in self.chunks(chunk_size):
+            yield start, np.asarray(self[start:end, :])
+
+    def iter_column(self, col, chunk_size = None):
+        '''Iterate over blocks of a single distance column
+
+        Only this column is read from disk.
+
+        Args:
+            col (int)
+                Column to read (0 = core, 1 = accessory)
+            chunk_size (int)
+                Number of rows in each block (default self.chunk_size)
+
+        Returns:
+            start, block (int, numpy.array)
+                Iterable of the first row index and an
+                (end - start) vector of distances
+        '''
+        for start, end in self.chunks(chunk_size):
+            yield start, np.asarray(self[start:end, col])
+
+
+class SegmentedDistanceStore(DistanceStore):
+    '''All-vs-all distances stored as blocks appended by successive
+    ``--update-db`` runs, read as a single long-form matrix
+
+    Each update adds a batch of samples after those already present, along
+    with two blocks: the distances from every earlier sample to the batch
+    (earlier samples outer, batch inner) and the batch's own upper triangle.
+    The first batch only has the latter. These blocks are the segment
+    files listed in ``<prefix>.segments.json`` (see
+    :func:`~appendDistanceSegments`), each a ``.npy`` or ``.h5`` read
+    through a :class:`~DistanceStore`.
+
+    Rows are presented in the usual order for a self comparison of all the
+    samples, so any consumer of a :class:`~DistanceStore` can use this.
+    Consecutive rows map onto contiguous runs in each segment, so reading
+    in chunks stays sequential.
+
+    Args:
+        manifest (str)
+            Location of the ``.segments.json`` file
+        chunk_size (int)
+            Default number of rows returned by the iterators
+
+            [default = 1000000]
+    '''
+
+    def __init__(self, manifest, chunk_size = 1000000):
+        super().__init__(manifest, chunk_size)
+
+    def _open(self):
+        self.h5_file = None
+        self.X = None
+        segment_samples, segment_files = readSegmentManifest(self.filename)
+        self.segment_samples = np.array(segment_samples, dtype = np.int64)
+        self.segment_starts = np.concatenate(([0], np.cumsum(self.segment_samples)[:-1]))
+        self.n_samples = int(np.sum(self.segment_samples))
+        self.self_blocks = [DistanceStore(self_file, self.chunk_size)
+                            for self_file, cross_file in segment_files]
+        self.cross_blocks = [DistanceStore(cross_file, self.chunk_size)
+                             if cross_file is not None else None
+                             for self_file, cross_file in segment_files]
+        self.dist_format = self.self_blocks[0].dist_format
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        for attr in ['self_blocks', 'cross_blocks']:
+            state.pop(attr, None)
+        return state
+
+    def close(self):
+        '''Close the segment files'''
+        for block in self.self_blocks + self.cross_blocks:
+            if block is not None:
+                block.close()
+
+    @property
+    def shape(self):
+        return (self.n_samples * (self.n_samples - 1) // 2, 2)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            row_key, col_key = key
+        else:
+            row_key, col_key = key, slice(None)
+
+        if isinstance(row_key, (int, np.integer)):
+            rows = np.array([row_key], dtype = np.int64)
+        elif isinstance(row_key, slice):
+            rows = np.arange(*row_key.indices(self.shape[0]), dtype = np.int64)
+        else:
+            rows = np.asarray(row_key)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+        values = self._gather(rows)[:, col_key]
+
+        if isinstance(row_key, (int, np.integer)):
+            return values[0]
+        return values
+
+    def _gather(self, rows):
+        values = np.empty((rows.shape[0], 2), dtype = np.float32)
+        if rows.shape[0] == 0:
+            return values
+        sample_j, sample_i = distRowsToPairs(rows, self.n_samples)
+        n_segments = len(self.segment_samples)
+        segment_i = np.searchsorted(self.segment_starts, sample_i, side = 'right') - 1
+        segment_j = np.searchsorted(self.segment_starts, sample_j, side = 'right') - 1
+        block_ids = segment_i * n_segments + segment_j
+        for block_id in np.unique(block_ids):
+            in_block = block_ids == block_id
+            seg_i, seg_j = divmod(int(block_id), n_segments)
+            start = self.segment_starts[seg_j]
+            if seg_i == seg_j:
+                local_rows = pairsToDistRows(sample_j[in_block] - start,
+                                             sample_i[in_block] - start,
+                                             self.segment_samples[seg_j])
+                block = self.self_blocks[seg_j]
+            else:
+                local_rows = sample_i[in_block] * self.segment_samples[seg_j] + \
+                             sample_j[in_block] - start
+                block = self.cross_blocks[seg_j]
+            values[in_block, :] = readDistanceRows(block, local_rows)
+        return values
+
+    def __array__(self, dtype = None, copy = None):
+        return np.asarray(self[:, :], dtype = dtype)
+
+
+def readDistanceRows(distMat, rows):
+    """Read a set of rows from a distance store, as a single slice if
+    they are close together
+
+    Args:
+        distMat (DistanceStore)
+            Distances to read
+        rows (numpy.array)
+            Row indices
+
+    Returns:
+        values (numpy.array)
+            len(rows) x 2 array of distances
+    """
+    first_row = int(np.min(rows))
+    last_row = int(np.max(rows)) + 1
+    if last_row - first_row <= 2 * rows.shape[0]:
+        return np.asarray(distMat[first_row:last_row, :])[rows - first_row]
+    return np.asarray(distMat[rows, :])
+
+
+def readSegmentManifest(manifest):
+    """Read the list of segments making up a segmented distance store
+
+    Args:
+        manifest (str)
+            Location of the ``.segments.json`` file
+
+    Returns:
+        segment_samples (list)
+            Number of samples added by each segment
+        segment_files (list)
+            Paths of the self and cross distance files for each segment
+            (the cross file is None for the first)
+    """
+    with open(manifest, 'r') as manifest_file:
+        segments = json.load(manifest_file)
+    segment_dir = os.path.dirname(manifest)
+    segment_files = [[os.path.join(segment_dir, seg_file) if seg_file is not None else None
+                      for seg_file in seg_files] for seg_files in segments['files']]
+    return segments['samples'], segment_files
+
+
+def removeDistanceSegments(pklName):
+    """Remove a segmented distance store, if present
+
+    Args:
+        pklName (str)
+            Prefix of the distance files
+    """
+    manifest = pklName + ".segments.json"
+    if os.path.isfile(manifest):
+        segment_files = readSegmentManifest(manifest)[1]
+        os.remove(manifest)
+        for seg_files in segment_files:
+            for seg_file in seg_files:
+                if seg_file is not None and os.path.isfile(seg_file):
+                    os.remove(seg_file)
+
+
+def appendDistanceSegments(refPrefix, outPrefix, rlist, qlist, qrDistMat, qqDistMat):
+    """Add query distances to an all-vs-all distance store, without
+    rewriting the existing distances
+
+    Writes a segmented store at outPrefix (read with :func:`~readPickle` as
+    a :class:`~SegmentedDistanceStore`). The existing segments, or the
+    ``.npy`` or ``.h5`` file of a store at refPrefix which has not been
+    appended to before, are kept as they are: hard-linked into place if
+    outPrefix is elsewhere (copied if that is not possible), or left alone
+    if it is the same. Only the query-reference and query-query blocks are
+    written, in the format of the existing distances.
+
+    Args:
+        refPrefix (str)
+            Prefix of the existing distances
+        outPrefix (str)
+            Prefix for the updated distances (may equal refPrefix)
+        rlist (list)
+            Names of the samples in the existing distances
+        qlist (list)
+            Names of the queries
+        qrDistMat (numpy.array)
+            Query-reference distances (queries outer, references inner)
+        qqDistMat (numpy.array)
+            Query-query distances (upper triangle)
+    """
+    if os.path.isfile(refPrefix + ".segments.json"):
+        segment_samples, segment_files = readSegmentManifest(refPrefix + ".segments.json")
+    else:
+        if os.path.isfile(refPrefix + ".h5"):
+            base_file = refPrefix + ".h5"
+        else:
+            base_file = refPrefix + ".npy"
+        if not os.path.isfile(base_file):
+            sys.stderr.write("No distances found for " + refPrefix + ", only "
+                             "saving names of the updated samples\n")
+            combined_seq = rlist + qlist
+            storePickle(combined_seq, combined_seq, True, None, outPrefix)
+            return
+        segment_samples = [len(rlist)]
+        segment_files = [[base_file, None]]
+    if sum(segment_samples) != len(rlist):
+        raise RuntimeError("Distances in " + refPrefix + " do not match the reference list")
+
+    with DistanceStore(segment_files[0][0]) as first_segment:
+        dist_format = first_segment.dist_format
+    dist_suffix = distFileSuffix(dist_format)
+    out_files = []
+    for segment, seg_files in enumerate(segment_files):
+        out_seg_files = []
+        for seg_type, seg_file in zip(['self', 'cross'], seg_files):
+            if seg_file is None:
+                out_seg_files.append(None)
+                continue
+            out_file = outPrefix + ".seg" + str(segment) + "." + seg_type + \
+                os.path.splitext(seg_file)[1]
+            if os.path.abspath(seg_file) != os.path.abspath(out_file):
+                if os.path.isfile(out_file):
+                    os.remove(out_file)
+                try:
+                    os.link(seg_file, out_file)
+                except OSError:
+                    shutil.copyfile(seg_file, out_file)
+            out_seg_files.append(out_file)
+        out_files.append(out_seg_files)
+
+    # New segment: queries vs all existing samples, then queries vs queries
+    segment = len(segment_files)
+    num_ref = len(rlist)
+    num_query = len(qlist)
+    qrDistMat = np.asarray(qrDistMat).reshape(num_query, num_ref, 2)
+    def ref_outer_rows(chunk_size = 10000):
+        for start in range(0, num_ref, chunk_size):
+            end = min(start + chunk_size, num_ref)
+            yield qrDistMat[:, start:end, :].transpose(1, 0, 2).reshape(-1, 2)
+    cross_file = outPrefix + ".seg" + str(segment) + ".cross" + dist_suffix
+    writeDistanceFile(cross_file, num_ref * num_query, ref_outer_rows(),
+                      dist_format = dist_format)
+    self_file = outPrefix + ".seg" + str(segment) + ".self" + dist_suffix
+    writeDistanceFile(self_file, num_query * (num_query - 1) // 2,
+                      [np.asarray(qqDistMat)], dist_format = dist_format)
+    out_files.append([self_file, cross_file])
+    segment_samples = segment_samples + [num_query]
+
+    combined_seq = rlist + qlist
+    with open(outPrefix + ".pkl", 'wb') as pickle_file:
+        pickle.dump([combined_seq, combined_seq, True], pickle_file)
+    with open(outPrefix + ".segments.tmp.json", 'w') as manifest_file:
+        json.dump({'samples': segment_samples,
+                   'files': [[os.path.basename(seg_file) if seg_file is not None else None
+                              for seg_file in seg_files] for seg_files in out_files]},
+                  manifest_file)
+    os.replace(outPrefix + ".segments.tmp.json", outPrefix + ".segments.json")
+    # The segmented store takes precedence, but do not leave old distances behind
+    for stale_suffix in [".npy", ".h5"]:
+        if os.path.isfile(outPrefix + stale_suffix):
+            os.remove(outPrefix + stale_suffix)
+
+
+def sampleRows(X, max_samples):
+    """Randomly subsample rows of a distance matrix
+
+    Draws row indices rather than shuffling the whole matrix, so only the
+    sampled rows are read from a :class:`~DistanceStore`.
+
+    Args:
+        X (numpy.array or DistanceStore)
+            n x 2 array of core and accessory distances
+        max_samples (int)
+            Maximum number of rows to return
+
+    Returns:
+        subsample (numpy.array)
+            min(n, max_samples) x 2 array of distances, in their original order
+    """
+    if X.shape[0] > max_samples:
+        rng = np.random.default_rng()
+        rows = np.sort(rng.choice(X.shape[0], size = max_samples, replace = False))
+        subsample = np.asarray(X[rows, :])
+    else:
+        subsample = np.array(X[:, :])
+    return subsample
+
+
+def coresetRows(X, max_samples, bins = coreset_bins):
+    """Subsample rows of a distance matrix as a weighted coreset
+
+    Distances are binned into a 2D histogram, and each occupied cell keeps
+    at most the same number of rows, so sparse regions (such as the
+    within-strain distances) are kept whole while dense regions are thinned.
+    If there are more occupied cells than max_samples, one row is kept from
+    evenly spaced cells instead. Each kept row is weighted by the number of
+    rows it represents. Rows are picked evenly through each cell in the order
+    they are read, so the result is deterministic.
+
+    Makes three passes over X (range, histogram, selection), one chunk
+    at a time.
+
+    Args:
+        X (numpy.array or DistanceStore)
+            n x 2 array of core and accessory distances
+        max_samples (int)
+            Maximum number of rows to return
+        bins (int)
+            Number of histogram bins along each axis
+            (default = 128)
+
+    Returns:
+        subsample (numpy.array)
+            Array of at most max_samples x 2 distances, in their original order
+        sample_weight (numpy.array)
+            Number of rows of X represented by each row of subsample
+    """
+    if not isinstance(X, DistanceStore):
+        X = DistanceStore(X)
+    if X.shape[0] <= max_samples:
+        return np.array(X[:, :]), np.ones(X.shape[0])
+
+    # Range of each axis
+    dist_max = np.zeros(2)
+    for start, block in X.iter_rows():
+        dist_max = np.maximum(dist_max, np.amax(block, axis = 0))
+    dist_max[dist_max == 0] = 1
+
+    def binIndex(block):
+        cell = np.minimum((block * (bins / dist_max)).astype(np.int64), bins - 1)
+        return cell[:, 0] * bins + cell[:, 1]
+
+    # Histogram
+    counts = np.zeros(bins * bins, dtype = np.int64)
+    for start, block in X.iter_rows():
+        counts += np.bincount(binIndex(block), minlength = bins * bins)
+
+    occupied_cells = np.flatnonzero(counts)
+    if len(occupied_cells) > max_samples:
+        # Too many cells to keep a row from each: keep one row from evenly
+        # spaced cells, each also representing the cells skipped over
+        quota = np.zeros(bins * bins, dtype = np.int64)
+        quota[occupied_cells[(np.arange(max_samples) * len(occupied_cells)) // max_samples]] = 1
+        cell_weight = len(occupied_cells) / max_samples
+    else:
+        # Largest per-cell cap which keeps the total within max_samples
+        occupied = np.sort(counts[occupied_cells])
+        cap_lo, cap_hi = 1, occupied[-1]
+        while cap_lo < cap_hi:
+            cap = (cap_lo + cap_hi + 1) // 2
+            if np.minimum(occupied, cap).sum() <= max_samples:
+                cap_lo = cap
+            else:
+                cap_hi = cap - 1
+        quota = np.minimum(counts, cap_lo)
+        cell_weight = 1
+
+    # Keep quota rows from each cell, spaced evenly through the cell
+    seen = np.zeros(bins * bins, dtype = np.int64)
+    subsample = []
+    sample_weight = []
+    for start, block in X.iter_rows():
+        cell = binIndex(block)
+        order = np.argsort(cell, kind = 'stable')
+        sorted_cell = cell[order]
+        group_start = np.flatnonzero(np.r_[True, sorted_cell[1:] != sorted_cell[:-1]])
+        group_len = np.diff(np.r_[group_start, len(sorted_cell)])
+        rank = np.empty(len(cell), dtype = np.int64)
+        rank[order] = np.arange(len(cell)) - np.repeat(group_start, group_len)
+        rank += seen[cell]
+        seen += np.bincount(cell, minlength = bins * bins)
+
+        keep = ((rank + 1) * quota[cell]) // counts[cell] > \
+            (rank * quota[cell]) // counts[cell]
+        subsample.append(np.asarray(block[keep, :]))
+        sample_weight.append(cell_weight * counts[cell[keep]] / quota[cell[keep]])
+
+    return np.concatenate(subsample), np.concatenate(sample_weight)
+
+
 def iterDistRows(refSeqs, querySeqs, self=True):
     """Gets the ref and query ID for each row of the distance matrix
 
@@ -261,6 +1067,115 @@ def listDistInts(refSeqs, querySeqs, self=True):
         return comparisons
 
 
+def distRowsToPairs(rows, num_ref, self=True):
+    """Gets the ref and query index for each of a batch of distance matrix rows
+
+    Vectorised equivalent of :func:`~listDistInts`, using the same
+    arithmetic as ``calc_row_idx`` and ``calc_col_idx`` in ``boundary.cpp``.
+
+    Args:
+        rows (numpy.array)
+            Row indices of the long-form distance matrix
+        num_ref (int)
+            Number of reference sequences
+        self (bool)
+            Whether a self-comparison (rows of the upper triangle) rather than
+            query-vs-ref (queries outer, refs inner)
+            Default is True
+    Returns:
+        ref_idx (numpy.array)
+            Index in refSeqs for each row
+        query_idx (numpy.array)
+            Index in querySeqs for each row (< ref_idx if self)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if self:
+        n = num_ref
+        query_idx = n - 2 - np.floor(np.sqrt(4 * n * (n - 1) - 7 - 8 * rows.astype(np.float64)) / 2 - 0.5).astype(np.int64)
+        # Correct any floating point error at the end of a row
+        query_idx -= condensedRowStart(query_idx, n) > rows
+        query_idx += condensedRowStart(query_idx + 1, n) <= rows
+        ref_idx = rows - condensedRowStart(query_idx, n) + query_idx + 1
+    else:
+        ref_idx = rows % num_ref
+        query_idx = rows // num_ref
+    return ref_idx, query_idx
+
+
+def pairsToDistRows(ref_idx, query_idx, num_ref, self=True):
+    """Gets the distance matrix row for each of a batch of ref and query indices
+
+    Inverse of :func:`~distRowsToPairs`, as ``square_to_condensed``
+    in ``boundary.cpp``.
+
+    Args:
+        ref_idx (numpy.array)
+            Index in refSeqs of each pair
+        query_idx (numpy.array)
+            Index in querySeqs of each pair (if self, either order is
+            accepted, but the indices must differ)
+        num_ref (int)
+            Number of reference sequences
+        self (bool)
+            Whether a self-comparison
+            Default is True
+    Returns:
+        rows (numpy.array)
+            Row index of each pair in the long-form distance matrix
+    """
+    ref_idx = np.asarray(ref_idx, dtype=np.int64)
+    query_idx = np.asarray(query_idx, dtype=np.int64)
+    if self:
+        i = np.minimum(ref_idx, query_idx)
+        j = np.maximum(ref_idx, query_idx)
+        rows = condensedRowStart(i, num_ref) + j - i - 1
+    else:
+        rows = query_idx * num_ref + ref_idx
+    return rows
+
+
+def condensedRowStart(i, n):
+    """Distance matrix row of the comparison between sample i and sample i + 1,
+    the first row for i in a self-comparison
+
+    Args:
+        i (numpy.array)
+            Sample indices
+        n (int)
+            Number of samples
+    Returns:
+        rows (numpy.array)
+            Long-form row indices
+    """
+    return n * i - (i * (i + 1)) // 2
+
+
+def distRowsToEdges(rows, num_ref, self=True):
+    """Gets the network edge for each of a batch of distance matrix rows
+
+    Vectorised equivalent of ``generateTuples`` in ``poppunk_refine``: queries
+    are numbered from num_ref, and the first node of each edge is always the
+    smaller.
+
+    Args:
+        rows (numpy.array)
+            Row indices of the long-form distance matrix
+        num_ref (int)
+            Number of reference sequences
+        self (bool)
+            Whether a self-comparison
+            Default is True
+    Returns:
+        source, target (numpy.array, numpy.array)
+            Vertex IDs for each edge
+    """
+    ref_idx, query_idx = distRowsToPairs(rows, num_ref, self)
+    if self:
+        return query_idx, ref_idx
+    else:
+        return ref_idx, query_idx + num_ref
+
+
 def readIsolateTypeFromCsv(clustCSV, mode = 'clusters', return_dict = False):
     """Read cluster definitions from CSV file.
 
@@ -354,11 +1269,114 @@ def joinClusterDicts(d1, d2):
     return d1
 
 
+def fillSquareFromLong(squareMats, distMat, row_offset, n_rows, n_cols = None,
+                       chunk_size = 1000000):
+    """Copy a block of long form distances into square matrices, streaming
+    over the long form in chunks
+
+    Each row of the square matrix is a contiguous run of the long form, so
+    only one triangle (or the lower-left block for query-ref distances) is
+    written. Use :func:`~symmetriseSquare` to complete the matrices.
+
+    Args:
+        squareMats (list)
+            Square matrices to write into, one for each column of distMat
+            (e.g. core, accessory). Typically memory-mapped.
+        distMat (numpy.array or DistanceStore)
+            Long form distances
+        row_offset (int)
+            First row (and column, if self) of the block in the square matrices
+        n_rows (int)
+            Number of samples (self) or queries (query-ref) in the block
+        n_cols (int)
+            Number of references, if distMat holds query-ref distances with
+            queries outer and refs inner. If None, distMat is the upper
+            triangle of a self comparison
+        chunk_size (int)
+            Number of long form rows to read at a time
+    """
+    if not isinstance(distMat, DistanceStore):
+        distMat = DistanceStore(distMat)
+    if n_cols is None:
+        seg_starts = condensedRowStart(np.arange(n_rows + 1, dtype = np.int64), n_rows)
+        col_starts = row_offset + np.arange(1, n_rows + 1)
+    else:
+        seg_starts = np.arange(n_rows + 1, dtype = np.int64) * n_cols
+        col_starts = np.zeros(n_rows, dtype = np.int64)
+
+    for start, block in distMat.iter_rows(chunk_size):
+        end = start + block.shape[0]
+        first_seg = np.searchsorted(seg_starts, start, side = 'right') - 1
+        last_seg = np.searchsorted(seg_starts, end, side = 'left')
+        for seg in range(first_seg, last_seg):
+            lo = max(seg_starts[seg], start)
+            hi = min(seg_starts[seg + 1], end)
+            if hi <= lo:
+                continue
+            col = col_starts[seg] + lo - seg_starts[seg]
+            for dist_col, squareMat in enumerate(squareMats):
+                squareMat[row_offset + seg, col:(col + hi - lo)] = \
+                    block[(lo - start):(hi - start), dist_col]
+
+def symmetriseSquare(squareMat, tile_size = 4096):
+    """Make a square distance matrix symmetric, tile by tile
+
+    Where only one of each pair of entries has been written (the other
+    being zero), takes the maximum, so either triangle may be the filled one.
+
+    Args:
+        squareMat (numpy.array)
+            NxN distance matrix, modified in place. Typically memory-mapped.
+        tile_size (int)
+            Number of rows and columns in each tile
+    """
+    n = squareMat.shape[0]
+    for row_start in range(0, n, tile_size):
+        row_end = min(row_start + tile_size, n)
+        for col_start in range(row_start, n, tile_size):
+            col_end = min(col_start + tile_size, n)
+            tile = np.maximum(squareMat[row_start:row_end, col_start:col_end],
+                              squareMat[col_start:col_end, row_start:row_end].T)
+            squareMat[row_start:row_end, col_start:col_end] = tile
+            squareMat[col_start:col_end, row_start:row_end] = tile.T
+
+def squareToLongMatrix(squareMats, outName = None):
+    """Convert square distance matrices back into a long form matrix
+    (upper triangle, one column per square matrix), row by row
+
+    Args:
+        squareMats (list)
+            NxN distance matrices e.g. [core, accessory]
+        outName (str)
+            If given, write the long form to this .npy file and return it
+            memory-mapped, rather than holding it in memory
+
+    Returns:
+        distMat (numpy.array)
+            N(N-1)/2 x len(squareMats) long form distances
+    """
+    n = squareMats[0].shape[0]
+    shape = (n * (n - 1) // 2, len(squareMats))
+    if outName is not None:
+        distMat = np.lib.format.open_memmap(outName, mode = 'w+',
+                                            dtype = np.float32, shape = shape)
+    else:
+        distMat = np.zeros(shape, dtype = np.float32)
+    for i in range(n - 1):
+        start = condensedRowStart(i, n)
+        for dist_col, squareMat in enumerate(squareMats):
+            distMat[start:(start + n - i - 1), dist_col] = squareMat[i, (i + 1):]
+    return distMat
+
 def update_distance_matrices(refList, distMat, queryList = None, query_ref_distMat = None,
-                             query_query_distMat = None, threads = 1):
+                             query_query_distMat = None, threads = 1,
+                             square_prefix = None, tile_size = 4096):
     """Convert distances from long form (1 matrix with n_comparisons rows and 2 columns)
     to a square form (2 NxN matrices), with merging of query distances if necessary.
 
+    If square_prefix is given the square matrices are built on disk, streaming
+    over the long form inputs, and returned memory-mapped.
+
     Args:
         refList (list)
             List of references
@@ -376,6 +1394,11 @@ def update_distance_matrices(refList, distMat, queryList = None, query_ref_distM
             for pairwise comparisons between query sequences
         threads (int)
             Number of threads to use
+        square_prefix (str)
+            If given, write the square matrices to <square_prefix>.core.npy
+            and <square_prefix>.acc.npy, and return them memory-mapped
+        tile_size (int)
+            Rows and columns in each tile when building on disk
 
     Returns:
         seqLabels (list)
@@ -389,7 +1412,25 @@ def update_distance_matrices(refList, distMat, queryList = None, query_ref_distM
     if queryList is not None:
         seqLabels = seqLabels + queryList
 
-    if queryList == None:
+    if square_prefix is not None:
+        squareNames = [square_prefix + ".core.npy", square_prefix + ".acc.npy"]
+        squareMats = [np.lib.format.open_memmap(squareName, mode = 'w+',
+                                                dtype = np.float32,
+                                                shape = (len(seqLabels), len(seqLabels)))
+                      for squareName in squareNames]
+        fillSquareFromLong(squareMats, distMat, 0, len(refList))
+        if queryList is not None:
+            fillSquareFromLong(squareMats, query_ref_distMat, len(refList),
+                               len(queryList), n_cols = len(refList))
+            fillSquareFromLong(squareMats, query_query_distMat, len(refList),
+                               len(queryList))
+        for squareMat in squareMats:
+            symmetriseSquare(squareMat, tile_size)
+            squareMat.flush()
+        del squareMats
+        coreMat, accMat = [np.load(squareName, mmap_mode = 'r')
+                           for squareName in squareNames]
+    elif queryList == None:
         coreMat = pp_sketchlib.longToSquare(distVec=distMat[:, [0]],
                                             num_threads=threads)
         accMat = pp_sketchlib.longToSquare(distVec=distMat[:, [1]],
@@ -617,6 +1658,120 @@ def read_rlist_from_distance_pickle(fn, allow_non_self = True, include_queries =
             rlist = rlist + qlist
     return rlist
 
+class SampleIndex:
+    """Name to vertex index mapping for the samples in a database.
+
+    Names are held as a sorted array alongside their original positions, so
+    lookups of many names are a single vectorised binary search rather than
+    repeated ``list.index`` calls.
+
+    Args:
+        names (list or numpy.array)
+            Sample names, in vertex order
+    """
+    def __init__(self, names):
+        self.names = np.asarray(names, dtype = str)
+        self.order = np.argsort(self.names, kind = 'stable')
+        self.sorted_names = self.names[self.order]
+
+    @classmethod
+    def from_distance_pickle(cls, pklName, persist = False):
+        """Build the index for the samples in a distance pickle
+
+        The names are those of the vertices of a network built from these
+        distances i.e. the references, followed by the queries if the
+        distances are not self-self. With ``persist`` the index is cached
+        as ``<pklName>.idx.npz`` and reused while it is newer than the pickle.
+
+        Args:
+            pklName (str)
+                Name of the distance pickle (including .pkl)
+            persist (bool)
+                Whether to read and write the cached index file
+
+        Returns:
+            index (SampleIndex)
+                Index of sample names
+        """
+        idxName = pklName + ".idx.npz"
+        if persist and os.path.isfile(idxName) and \
+                os.path.getmtime(idxName) >= os.path.getmtime(pklName):
+            return cls.load(idxName)
+
+        with open(pklName, 'rb') as pickle_file:
+            rlist, qlist, self = pickle.load(pickle_file)
+        names = rlist if self else rlist + qlist
+        index = cls(names)
+        if persist:
+            try:
+                index.save(idxName)
+            except OSError:
+                sys.stderr.write("Could not write sample index " + idxName + "\n")
+        return index
+
+    @classmethod
+    def load(cls, idxName):
+        """Load an index written by :func:`~SampleIndex.save`
+
+        Args:
+            idxName (str)
+                Name of the .npz file
+
+        Returns:
+            index (SampleIndex)
+                Index of sample names
+        """
+        index = cls.__new__(cls)
+        with np.load(idxName) as idx_file:
+            index.names = idx_file['names']
+            index.order = idx_file['order']
+        index.sorted_names = index.names[index.order]
+        return index
+
+    def save(self, idxName):
+        """Write the index to an .npz file
+
+        Args:
+            idxName (str)
+                Name of the .npz file
+        """
+        tmpName = idxName + ".tmp.npz"
+        np.savez(tmpName, names = self.names, order = self.order)
+        os.replace(tmpName, idxName)
+
+    def lookup(self, names):
+        """Vertex indices of a set of names
+
+        Args:
+            names (list or numpy.array)
+                Names to look up
+
+        Returns:
+            indices (numpy.array)
+                Index of each name, or -1 where the name is absent
+        """
+        names = np.asarray(names, dtype = str)
+        indices = np.full(names.shape, -1, dtype = np.int64)
+        if len(self.sorted_names) == 0 or names.size == 0:
+            return indices
+        pos = np.searchsorted(self.sorted_names, names)
+        pos[pos == len(self.sorted_names)] = 0
+        found = self.sorted_names[pos] == names
+        indices[found] = self.order[pos[found]]
+        return indices
+
+    def __getitem__(self, name):
+        index = self.lookup([name])[0]
+        if index < 0:
+            raise KeyError(name)
+        return int(index)
+
+    def __contains__(self, name):
+        return self.lookup([name])[0] >= 0
+
+    def __len__(self):
+        return len(self.names)
+
 def get_match_search_depth(rlist,rank_list):
     """Return a default search depth for lineage model fitting.
 
@@ -145,6 +145,9 @@ def get_options():
     other.add_argument('--gpu-graph', default=False, action='store_true', help='Use a GPU when calculating graphs [default = False]')
     other.add_argument('--deviceid', default=0, type=int, help='CUDA device ID, if using GPU [default = 0]')
     other.add_argument('--tmp', default='/tmp/', type=str, help='Directory for large temporary files')
+    other.add_argument('--mmap-square', default=False, action='store_true',
+                       help='Build square distance matrices as memory-mapped files in --tmp, '
+                            'rather than in memory [default = False]')
     other.add_argument('--strand-preserved', default=False, action='store_true',
                        help='If distances being calculated, treat strand as known when calculating random '
                             'match chances [default = False]')
@@ -215,7 +218,8 @@ def generate_visualisations(query_db,
                             display_cluster,
                             use_partial_query_graph,
                             recalculate_distances,
-                            tmp):
+                            tmp,
+                            mmap_square = False):
 
     from .models import loadClusterFit
 
@@ -246,6 +250,7 @@ def generate_visualisations(query_db,
     from .utils import readPickle
     from .utils import setGtThreads
     from .utils import update_distance_matrices
+    from .utils import squareToLongMatrix
     from .utils import readIsolateTypeFromCsv
     from .utils import joinClusterDicts
     from .utils import read_rlist_from_distance_pickle
@@ -278,6 +283,11 @@ def generate_visualisations(query_db,
             sys.stderr.write("Cannot create output directory\n")
             sys.exit(1)
 
+    # Square distance matrices may be built on disk rather than in memory
+    square_prefix = None
+    if mmap_square:
+        square_prefix = os.path.join(tmp, os.path.basename(output) + "_square")
+
     #*******************************#
     #*                             *#
     #* Extract subset of sequences *#
@@ -468,13 +478,14 @@ def generate_visualisations(query_db,
             combined_seq, core_distMat, acc_distMat = \
               update_distance_matrices(sequences_to_analyse,
                                        subset_distMat,
-                                       threads = threads)
+                                       threads = threads,
+                                       square_prefix = square_prefix)
 
         else:
             sys.stderr.write("Reading pairwise distances for tree construction\n")
             
             # Process dense distance matrix
-            rlist, qlist, self, complete_distMat = readPickle(distances)
+            rlist, qlist, self, complete_distMat = readPickle(distances, mmap = mmap_square)
             if not self:
                 qr_distMat = complete_distMat
                 combined_seq = rlist + qlist
@@ -487,7 +498,7 @@ def generate_visualisations(query_db,
                 sys.stderr.write("Note: Distances in " + distances + " are from assign mode\n"
                                  "Note: Distance will be extended to full all-vs-all distances\n"
                                  "Note: Re-run poppunk_assign with --update-db to avoid this\n")
-                rlist_original, qlist_original, self_ref, rr_distMat = readPickle(ref_db_loc + ".dists")
+                rlist_original, qlist_original, self_ref, rr_distMat = readPickle(ref_db_loc + ".dists", mmap = mmap_square)
                 if not self_ref:
                     sys.stderr.write("Distances in " + ref_db + " not self all-vs-all either\n")
                     sys.exit(1)
@@ -529,7 +540,8 @@ def generate_visualisations(query_db,
             combined_seq, core_distMat, acc_distMat = \
                     update_distance_matrices(rlist, rr_distMat,
                                              qlist, qr_distMat, qq_distMat,
-                                             threads = threads)
+                                             threads = threads,
+                                             square_prefix = square_prefix)
 
             # Prune distance matrix if subsetting data
             if viz_subset is not None:
@@ -581,9 +593,14 @@ def generate_visualisations(query_db,
                                                             gpu_graph = gpu_graph)
                     elif use_dense:
                         # Get distance matrix
-                        complete_distMat = \
-                            np.hstack((pp_sketchlib.squareToLong(core_distMat, threads).reshape(-1, 1),
-                                    pp_sketchlib.squareToLong(acc_distMat, threads).reshape(-1, 1)))
+                        if isinstance(core_distMat, np.memmap):
+                            complete_distMat = \
+                                squareToLongMatrix([core_distMat, acc_distMat],
+                                                   outName = square_prefix + ".long.npy")
+                        else:
+                            complete_distMat = \
+                                np.hstack((pp_sketchlib.squareToLong(core_distMat, threads).reshape(-1, 1),
+                                        pp_sketchlib.squareToLong(acc_distMat, threads).reshape(-1, 1)))
                         # Dense network may be slow
                         sys.stderr.write("Generating MST from dense distances (may be slow)\n")
                         G = construct_network_from_assignments(combined_seq,
@@ -717,6 +734,12 @@ def generate_visualisations(query_db,
         if model.type == 'lineage':
             sys.stderr.write("Note: Only support for output of cytoscape graph at lowest rank\n")
 
+    # Tidy up memory-mapped distance matrices
+    if square_prefix is not None:
+        for suffix in [".core.npy", ".acc.npy", ".long.npy"]:
+            if os.path.isfile(square_prefix + suffix):
+                os.remove(square_prefix + suffix)
+
     sys.stderr.write("\nDone\n")
 
 def main():
@@ -757,7 +780,8 @@ def main():
                             args.display_cluster,
                             args.use_partial_query_graph,
                             args.recalculate_distances,
-                            args.tmp)
+                            args.tmp,
+                            args.mmap_square)
 
 if __name__ == '__main__':
     main()
@@ -4,9 +4,10 @@
 
 import sys
 import argparse
-import pickle
 import numpy as np
 
+from PopPUNK.utils import readPickle
+
 # command line parsing
 def get_options():
 
@@ -44,12 +45,10 @@ if __name__ == "__main__":
     if "weight" in G.edge_properties:
         quit_msg("Graph already contains weights")
 
-    # Load dists
-    with open(args.distances + ".pkl", 'rb') as pickle_file:
-        rlist, qlist, self = pickle.load(pickle_file)
-        if not self:
-            quit_msg("Distances are from query mode")
-    dist_mat = np.load(args.distances + ".npy")
+    # Load dists, read from disk when accessed
+    rlist, qlist, self, dist_mat = readPickle(args.distances, mmap = True)
+    if not self:
+        quit_msg("Distances are from query mode")
 
     # Check network and dists are compatible
     network_labels = G.vertex_properties["id"]
@@ -65,11 +64,17 @@ if __name__ == "__main__":
     else:
         v_idx = range(n)
 
-    eprop = G.new_edge_property("float")
-    for edge in G.edges():
+    # Read the distances of all edges at once
+    edges = list(G.edges())
+    row_idx = np.zeros(len(edges), dtype = np.int64)
+    for edge_idx, edge in enumerate(edges):
         v1, v2 = sorted(tuple(edge))
-        row_idx = square_to_condensed(v_idx[int(v1)], v_idx[int(v2)], n)
-        dist = np.linalg.norm(dist_mat[row_idx, :])
+        row_idx[edge_idx] = square_to_condensed(v_idx[int(v1)], v_idx[int(v2)], n)
+    edge_dists = np.linalg.norm(dist_mat[row_idx, :], axis = 1)
+    dist_mat.close()
+
+    eprop = G.new_edge_property("float")
+    for edge, dist in zip(edges, edge_dists):
         eprop[edge] = dist
 
     # Add as edge attribute
@@ -4,13 +4,14 @@
 
 import os
 import sys
-import pickle
 import re
 import numpy as np
 import pandas as pd
 from scipy.spatial.distance import euclidean
 from sklearn.metrics import silhouette_score
 
+from PopPUNK.utils import readPickle
+
 #############
 # functions #
 #############
@@ -42,10 +43,8 @@ if __name__ == "__main__":
     # Check input ok
     args = get_options()
 
-    # Read in old distances
-    with open(args.distances + ".pkl", 'rb') as pickle_file:
-        rlist, qlist, self = pickle.load(pickle_file)
-    distMat = np.load(args.distances  + ".npy")
+    # Read in old distances, from disk when accessed
+    rlist, qlist, self, distMat = readPickle(args.distances, mmap = True)
     if not self:
         raise RuntimeError("Distance DB should be self-self distances")
 
@@ -57,14 +56,15 @@ if __name__ == "__main__":
     i = 0
     j = 1
     X_mat = np.zeros((len(rlist), len(rlist)))
-    for distRow in distMat:
-        X_mat[i, j] = euclidean(distRow[0], distRow[1])
-        X_mat[j, i] = X_mat[i, j]
-        if j == (len(rlist) - 1):
-            i += 1
-            j = i + 1
-        else:
-            j += 1
+    with distMat:
+        for distRow in distMat:
+            X_mat[i, j] = euclidean(distRow[0], distRow[1])
+            X_mat[j, i] = X_mat[i, j]
+            if j == (len(rlist) - 1):
+                i += 1
+                j = i + 1
+            else:
+                j += 1
 
     # Read in clustering
     clustering = pd.read_csv(args.cluster_csv, index_col = args.id_col - 1, quotechar='"')
@@ -7,6 +7,9 @@ import sys
 import argparse
 import tarfile
 import re
+import json
+
+from PopPUNK.models import lineage_archive_suffix
 
 def get_options():
     description = 'Generates distributable fits from PopPUNK'
@@ -29,7 +32,17 @@ def rename_and_copy(curr_dir, out_dir, exts=None, rename_refs=False):
             new_name = re.sub(rf"^{os.path.basename(curr_dir)}", os.path.basename(out_dir), os.path.basename(file))
             if rename_refs:
                 new_name = re.sub(rf"\.refs\.", ".", new_name)
-            shutil.copy(file, os.path.join(out_dir, new_name))
+            if file.endswith(".segments.json"):
+                # The manifest lists the segment files, which are renamed too
+                with open(file, 'r') as manifest_file:
+                    segments = json.load(manifest_file)
+                segments['files'] = [[re.sub(rf"^{os.path.basename(curr_dir)}", os.path.basename(out_dir), seg_file)
+                                      if seg_file is not None else None
+                                      for seg_file in seg_files] for seg_files in segments['files']]
+                with open(os.path.join(out_dir, new_name), 'w') as manifest_file:
+                    json.dump(segments, manifest_file)
+            else:
+                shutil.copy(file, os.path.join(out_dir, new_name))
 
 if __name__ == "__main__":
     options = get_options()
@@ -70,10 +83,12 @@ if __name__ == "__main__":
         sys.exit(1)
 
     # database extensions
-    db_exts = (".dists.npy", ".dists.pkl", ".h5", ".png", "_qcreport.txt")
-    fit_exts = (".refs", "_fit.npz", "_fit.pkl", "_graph.gt", ".csv", ".png")
+    # (distances from --update-db are in segments listed in .dists.segments.json)
+    db_exts = (".dists.npy", ".dists.pkl", ".h5", ".png", "_qcreport.txt",
+               ".dists.segments.json", ".self.npy", ".cross.npy")
+    fit_exts = [".refs", "_fit.npz", "_fit.pkl", "_graph.gt", ".csv", ".png"]
     if lineage:
-        fit_exts.append("rank_k_fit.npz")
+        fit_exts += [lineage_archive_suffix, "_sparse_dists.npz"]
 
     # get files in db_dir
     rename_and_copy(db_dir, out_full, db_exts)
@@ -84,9 +99,9 @@ if __name__ == "__main__":
     # repeat for refs, will be in fit_dir
     out_dir = out_refs
 
-    fit_exts = ("_fit.npz", "_fit.pkl", ".csv", ".png", "_qcreport.txt")
+    fit_exts = ["_fit.npz", "_fit.pkl", ".csv", ".png", "_qcreport.txt"]
     if lineage:
-        fit_exts.append("rank_k_fit.npz")
+        fit_exts += [lineage_archive_suffix, "_sparse_dists.npz"]
 
     # get files in db_dir
     rename_and_copy(fit_dir, out_refs, rename_refs=True)
@@ -2,13 +2,14 @@
 # vim: set fileencoding=<utf-8> :
 # Copyright 2018 John Lees and Nick Croucher
 
-import pickle
 import sys, os
 import numpy as np
 import argparse
 import dendropy
 from scipy import sparse
 
+from PopPUNK.utils import readPickle, distRowsToPairs
+
 # command line parsing
 def get_options():
 
@@ -29,38 +30,6 @@ def get_options():
 
     return parser.parse_args()
 
-def listDistInts(refSeqs, querySeqs, self=True):
-    """Gets the ref and query ID for each row of the distance matrix
-
-    Returns an iterable with ref and query ID pairs by row.
-
-    Args:
-        refSeqs (list)
-            List of reference sequence names.
-        querySeqs (list)
-            List of query sequence names.
-        self (bool)
-            Whether a self-comparison, used when constructing a database.
-            Requires refSeqs == querySeqs
-            Default is True
-    Returns:
-        ref, query (str, str)
-            Iterable of tuples with ref and query names for each distMat row.
-    """
-    num_ref = len(refSeqs)
-    num_query = len(querySeqs)
-    if self:
-        if refSeqs != querySeqs:
-            raise RuntimeError('refSeqs must equal querySeqs for db building (self = true)')
-        for i in range(num_ref):
-            for j in range(i + 1, num_ref):
-                yield(j, i)
-    else:
-        comparisons = [(0,0)] * (len(refSeqs) * len(querySeqs))
-        for i in range(num_query):
-            for j in range(num_ref):
-                yield(j, i)
-
 def isolateNameToLabel(names):
     """Function to process isolate names to labels
     appropriate for visualisation.
@@ -84,8 +53,9 @@ if __name__ == "__main__":
     args = get_options()
 
     # open stored distances
-    with open(args.distances + ".pkl", 'rb') as pickle_file:
-        rlist, qlist, self = pickle.load(pickle_file)
+    rlist, qlist, self, X = readPickle(args.distances,
+                                       distances = (args.sparse is None),
+                                       mmap = True)
 
     # get names order
     r_names = isolateNameToLabel(rlist)
@@ -108,8 +78,6 @@ if __name__ == "__main__":
     # Load sparse matrix
     if args.sparse is not None:
         sparse_mat = sparse.load_npz(args.sparse)
-    else:
-        X = np.load(args.distances + ".npy")
 
     # open output file
     with open(args.output, 'w') as oFile:
@@ -129,8 +97,17 @@ if __name__ == "__main__":
                     oFile.write("\t" + str(pdc(tip_index[r_index], tip_index[q_index])))
                 oFile.write("\n")
         else:
-            for i, (r_index, q_index) in enumerate(listDistInts(r_names, q_names, r_names == q_names)):
-                oFile.write("\t".join([q_names[q_index], r_names[r_index], str(X[i,0]), str(X[i,1])]))
+            r_name_array = np.array(r_names)
+            q_name_array = np.array(q_names)
+            for start, block in X.iter_rows():
+                r_index, q_index = distRowsToPairs(np.arange(start, start + block.shape[0]),
+                                                   len(r_names),
+                                                   self)
+                columns = [q_name_array[q_index],
+                           r_name_array[r_index],
+                           block[:, 0].astype(str),
+                           block[:, 1].astype(str)]
                 if args.tree is not None:
-                    oFile.write("\t" + str(pdc(tip_index[r_index], tip_index[q_index])))
-                oFile.write("\n")
+                    columns.append([str(pdc(tip_index[r], tip_index[q])) for r, q in zip(r_index, q_index)])
+                oFile.write("".join(["\t".join(row) + "\n" for row in zip(*columns)]))
+            X.close()
@@ -19,23 +19,6 @@ template <class T> inline size_t rows_to_samples(const T &longMat) {
   return 0.5 * (1 + sqrt(1 + 8 * (longMat.rows())));
 }
 
-inline size_t calc_row_idx(const uint64_t k, const size_t n) {
-  return n - 2 -
-         std::floor(
-             std::sqrt(static_cast<double>(-8 * k + 4 * n * (n - 1) - 7)) / 2 -
-             0.5);
-}
-
-inline size_t calc_col_idx(const uint64_t k, const size_t i, const size_t n) {
-  return k + i + 1 - n * (n - 1) / 2 + (n - i) * ((n - i) - 1) / 2;
-}
-
-inline size_t square_to_condensed(const size_t i, const size_t j,
-                                  const size_t n) {
-  assert(j > i);
-  return (n * i - ((i * (i + 1)) >> 1) + j - 1 - i);
-}
-
 // Unnormalised (signed_ distance between a point (x0, y0) and a line defined
 // by the two points (xmax, 0) and (0, ymax)
 // Divide by 1/sqrt(xmax^2 + ymax^2) to get distance
@@ -122,6 +105,66 @@ edge_tuple generate_tuples(const std::vector<int> &assignments,
     return edge_vec;
 }
 
+// Fused version of assign_threshold followed by generate_tuples, returning
+// the within-strain edges (and their rows in distMat) as arrays
+edge_arrays threshold_edges(const NumpyMatrix &distMat, const int slope,
+                            const float x_max, const float y_max,
+                            const bool self, const size_t num_ref,
+                            const uint64_t row_offset, const int int_offset,
+                            unsigned int num_threads) {
+  const long n_rows = distMat.rows();
+  const long n_chunks =
+      std::max(1L, std::min(static_cast<long>(num_threads) * 4, n_rows));
+
+  // Each chunk of rows finds its edges independently, so they are
+  // returned in row order
+  std::vector<std::vector<int64_t>> chunk_rows(n_chunks);
+#pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+  for (long chunk = 0; chunk < n_chunks; chunk++) {
+    const long start = chunk * n_rows / n_chunks;
+    const long end = (chunk + 1) * n_rows / n_chunks;
+    for (long row_idx = start; row_idx < end; row_idx++) {
+      if (line_dist(distMat(row_idx, 0), distMat(row_idx, 1), x_max, y_max,
+                    slope) < 0) {
+        chunk_rows[chunk].push_back(row_idx);
+      }
+    }
+  }
+
+  std::vector<long> chunk_start(n_chunks + 1, 0);
+  for (long chunk = 0; chunk < n_chunks; chunk++) {
+    chunk_start[chunk + 1] = chunk_start[chunk] + chunk_rows[chunk].size();
+  }
+  IndexVector source(chunk_start[n_chunks]);
+  IndexVector target(chunk_start[n_chunks]);
+  RowVector rows(chunk_start[n_chunks]);
+
+#pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+  for (long chunk = 0; chunk < n_chunks; chunk++) {
+    long edge_idx = chunk_start[chunk];
+    for (const int64_t row_idx : chunk_rows[chunk]) {
+      const uint64_t dist_row = row_idx + row_offset;
+      unsigned long i, j;
+      if (self) {
+        i = calc_row_idx(dist_row, num_ref);
+        j = calc_col_idx(dist_row, i, num_ref);
+      } else {
+        i = dist_row % num_ref;
+        j = dist_row / num_ref + num_ref;
+      }
+      if (i > j) {
+        std::swap(i, j);
+      }
+      source[edge_idx] = i + int_offset;
+      target[edge_idx] = j + int_offset;
+      rows[edge_idx] = row_idx;
+      edge_idx++;
+    }
+    std::vector<int64_t>().swap(chunk_rows[chunk]);
+  }
+  return std::make_tuple(source, target, rows);
+}
+
 edge_tuple generate_all_tuples(const int num_ref,
                                const int num_queries,
                                bool self,
@@ -209,27 +252,86 @@ network_coo threshold_iterate_1D(const NumpyMatrix &distMat,
   return (std::make_tuple(i_vec, j_vec, offset_idx));
 }
 
-network_coo threshold_iterate_2D(const NumpyMatrix &distMat,
-                                 const std::vector<float> &x_max,
-                                 const float y_max) {
-  std::vector<long> i_vec;
-  std::vector<long> j_vec;
-  std::vector<long> offset_idx;
+// First offset at which a boundary with intercepts (x_max[k], y_max)
+// includes (x0, y0), or x_max.size() if none do
+inline size_t first_offset_2D(const float x0, const float y0,
+                              const std::vector<float> &x_max,
+                              const float y_max) {
+  // The boundary passes through the point at the critical x-intercept
+  // x0 * y_max / (y_max - y0), and includes it at any larger x_max
+  size_t offset_nr = x_max.size();
+  if (y0 < y_max) {
+    const float x_crit = x0 * y_max / (y_max - y0);
+    offset_nr = std::lower_bound(x_max.cbegin(), x_max.cend(), x_crit) -
+                x_max.cbegin();
+  }
+  // Correct for rounding, so this agrees with line_dist
+  while (offset_nr < x_max.size() &&
+         line_dist(x0, y0, x_max[offset_nr], y_max, 2) > 0) {
+    offset_nr++;
+  }
+  while (offset_nr > 0 &&
+         line_dist(x0, y0, x_max[offset_nr - 1], y_max, 2) <= 0) {
+    offset_nr--;
+  }
+  return offset_nr;
+}
+
+// Takes a reference rather than a copy of distMat, as this is called
+// from multiple threads on the same distances
+network_arrays
+threshold_iterate_2D(const Eigen::Ref<const NumpyMatrix> &distMat,
+                     const std::vector<float> &x_max, const float y_max,
+                     const int num_threads) {
   const size_t n_samples = rows_to_samples(distMat);
+  const size_t n_offsets = x_max.size();
+  const long n_rows = distMat.rows();
 
-  for (int offset_nr = 0; offset_nr < x_max.size(); ++offset_nr) {
-    for (long row_idx = 0; row_idx < distMat.rows(); row_idx++) {
-      if (line_dist(distMat(row_idx, 0), distMat(row_idx, 1), x_max[offset_nr],
-                    y_max, 2) <= 0) {
-        if (offset_nr == 0 ||
-            (line_dist(distMat(row_idx, 0), distMat(row_idx, 1),
-                       x_max[offset_nr - 1], y_max, 2) > 0)) {
-          long i = calc_row_idx(row_idx, n_samples);
-          long j = calc_col_idx(row_idx, i, n_samples);
-          i_vec.push_back(i);
-          j_vec.push_back(j);
-          offset_idx.push_back(offset_nr);
-        }
+  // Counting sort of the rows by the offset they are first included at.
+  // Each thread takes a contiguous block of rows, so that rows stay in
+  // order within each offset.
+  // First pass counts the rows at each offset in each block
+  const long n_blocks = std::max(num_threads, 1);
+  const long block_size = (n_rows + n_blocks - 1) / n_blocks;
+  std::vector<std::vector<size_t>> block_counts(
+      n_blocks, std::vector<size_t>(n_offsets + 1, 0));
+#pragma omp parallel for schedule(static) num_threads(num_threads)
+  for (long block = 0; block < n_blocks; ++block) {
+    const long block_end = std::min(n_rows, (block + 1) * block_size);
+    for (long row_idx = block * block_size; row_idx < block_end; ++row_idx) {
+      block_counts[block][first_offset_2D(distMat(row_idx, 0),
+                                          distMat(row_idx, 1), x_max,
+                                          y_max)]++;
+    }
+  }
+
+  // Positions of each block's rows, ordered by offset then block
+  std::vector<std::vector<size_t>> block_starts(
+      n_blocks, std::vector<size_t>(n_offsets, 0));
+  size_t n_edges = 0;
+  for (size_t offset_nr = 0; offset_nr < n_offsets; ++offset_nr) {
+    for (long block = 0; block < n_blocks; ++block) {
+      block_starts[block][offset_nr] = n_edges;
+      n_edges += block_counts[block][offset_nr];
+    }
+  }
+
+  // Second pass writes the edges
+  IndexVector i_vec(n_edges), j_vec(n_edges), offset_idx(n_edges);
+#pragma omp parallel for schedule(static) num_threads(num_threads)
+  for (long block = 0; block < n_blocks; ++block) {
+    std::vector<size_t> &edge_idx = block_starts[block];
+    const long block_end = std::min(n_rows, (block + 1) * block_size);
+    for (long row_idx = block * block_size; row_idx < block_end; ++row_idx) {
+      const size_t offset_nr = first_offset_2D(
+          distMat(row_idx, 0), distMat(row_idx, 1), x_max, y_max);
+      if (offset_nr < n_offsets) {
+        const long i = calc_row_idx(row_idx, n_samples);
+        const long j = calc_col_idx(row_idx, i, n_samples);
+        i_vec[edge_idx[offset_nr]] = i;
+        j_vec[edge_idx[offset_nr]] = j;
+        offset_idx[edge_idx[offset_nr]] = offset_nr;
+        edge_idx[offset_nr]++;
       }
     }
   }
@@ -6,6 +6,8 @@
  */
 #pragma once
 
+#include <cassert>
+#include <cmath>
 #include <cstddef>
 #include <cstdint>
 #include <string>
@@ -22,6 +24,28 @@ typedef Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>
 typedef std::tuple<std::vector<long>, std::vector<long>, std::vector<long>>
     network_coo;
 typedef std::vector<std::tuple<long, long>> edge_tuple;
+typedef Eigen::Matrix<int32_t, Eigen::Dynamic, 1> IndexVector;
+typedef Eigen::Matrix<int64_t, Eigen::Dynamic, 1> RowVector;
+typedef std::tuple<IndexVector, IndexVector, RowVector> edge_arrays;
+typedef std::tuple<IndexVector, IndexVector, IndexVector> network_arrays;
+
+// Conversions between the condensed long form and square indices
+inline size_t calc_row_idx(const uint64_t k, const size_t n) {
+  return n - 2 -
+         std::floor(
+             std::sqrt(static_cast<double>(-8 * k + 4 * n * (n - 1) - 7)) / 2 -
+             0.5);
+}
+
+inline size_t calc_col_idx(const uint64_t k, const size_t i, const size_t n) {
+  return k + i + 1 - n * (n - 1) / 2 + (n - i) * ((n - i) - 1) / 2;
+}
+
+inline size_t square_to_condensed(const size_t i, const size_t j,
+                                  const size_t n) {
+  assert(j > i);
+  return (n * i - ((i * (i + 1)) >> 1) + j - 1 - i);
+}
 
 // https://stackoverflow.com/a/12399290
 template <typename T>
@@ -47,6 +71,12 @@ Eigen::VectorXf assign_threshold(const NumpyMatrix &distMat, const int slope,
 edge_tuple edge_iterate(const NumpyMatrix &distMat, const int slope,
                         const float x_max, const float y_max);
 
+edge_arrays threshold_edges(const NumpyMatrix &distMat, const int slope,
+                            const float x_max, const float y_max,
+                            const bool self, const size_t num_ref,
+                            const uint64_t row_offset, const int int_offset,
+                            unsigned int num_threads);
+
 edge_tuple generate_tuples(const std::vector<int> &assignments,
                            const int within_label,
                            bool self,
@@ -64,6 +94,7 @@ network_coo threshold_iterate_1D(const NumpyMatrix &distMat,
                                  const float y0, const float x1, const float y1,
                                  const int num_threads);
 
-network_coo threshold_iterate_2D(const NumpyMatrix &distMat,
-                                 const std::vector<float> &x_max,
-                                 const float y_max);
+network_arrays
+threshold_iterate_2D(const Eigen::Ref<const NumpyMatrix> &distMat,
+                     const std::vector<float> &x_max, const float y_max,
+                     const int num_threads);
@@ -279,3 +279,210 @@ sparse_coo get_kNN_distances(const NumpyMatrix &distMat, const int kNN,
 
   return (std::make_tuple(i_vec, j_vec, dists));
 }
+
+// All the ranks of lower_rank from one pass over the sparse matrix. As rows
+// are sorted by distance, each rank keeps a prefix of every row; this returns
+// the length of that prefix, for each row (rows) and each rank (columns).
+// Reciprocal filtering is then applied to the prefixes of each rank
+NumpyIndexMatrix rank_prefix_lengths(const sparse_coo &sparse_rr_mat,
+                                     const size_t n_samples,
+                                     const std::vector<size_t> &ranks,
+                                     bool count_unique_distances,
+                                     const size_t num_threads) {
+  std::vector<long> row_start_idx = row_start_indices(sparse_rr_mat, n_samples);
+  const std::vector<long> &j_sparse = std::get<1>(sparse_rr_mat);
+  const std::vector<float> &dist_vec = std::get<2>(sparse_rr_mat);
+  NumpyIndexMatrix prefix_lengths(n_samples, ranks.size());
+
+#pragma omp parallel for schedule(static) num_threads(num_threads)
+  for (long i = 0; i < n_samples; ++i) {
+    const long row_start = row_start_idx[i];
+    const long n_rr_dists = std::max(0L, row_start_idx[i + 1] - row_start);
+    std::vector<bool> done(ranks.size(), false);
+    long unique_neighbors = 0;
+    long n_neighbors = 0;
+    float prev_value = -1;
+    for (long pos = 0; pos < n_rr_dists; ++pos) {
+      if (j_sparse[row_start + pos] == i) {
+        continue;
+      }
+      // Each rank stops adding neighbours once it has enough, as in lower_rank
+      for (size_t rank_idx = 0; rank_idx < ranks.size(); ++rank_idx) {
+        if (!done[rank_idx] && unique_neighbors >= ranks[rank_idx]) {
+          prefix_lengths(i, rank_idx) = pos;
+          done[rank_idx] = true;
+        }
+      }
+      n_neighbors++;
+      const float dist = dist_vec[row_start + pos];
+      if (count_unique_distances && abs(dist - prev_value) >= epsilon) {
+        unique_neighbors++;
+        prev_value = dist;
+      } else {
+        unique_neighbors = n_neighbors;
+      }
+    }
+    for (size_t rank_idx = 0; rank_idx < ranks.size(); ++rank_idx) {
+      if (!done[rank_idx]) {
+        prefix_lengths(i, rank_idx) = n_rr_dists;
+      }
+    }
+  }
+  return prefix_lengths;
+}
+
+// Bounded max-heaps of (distance, index), ordered as sort_indexes would
+// order them (by distance, then by index)
+inline bool heap_less(const float d1, const int64_t j1, const float d2,
+                      const int64_t j2) {
+  return d1 < d2 || (d1 == d2 && j1 < j2);
+}
+
+inline void heap_push(float *dists, int64_t *idx, const size_t kNN,
+                      const float new_dist, const int64_t new_idx) {
+  // Only kept if smaller than the largest in the heap, which is then replaced
+  if (!heap_less(new_dist, new_idx, dists[0], idx[0])) {
+    return;
+  }
+  size_t pos = 0;
+  while (true) {
+    size_t child = 2 * pos + 1;
+    if (child >= kNN) {
+      break;
+    }
+    if (child + 1 < kNN &&
+        heap_less(dists[child], idx[child], dists[child + 1], idx[child + 1])) {
+      child++;
+    }
+    if (heap_less(new_dist, new_idx, dists[child], idx[child])) {
+      dists[pos] = dists[child];
+      idx[pos] = idx[child];
+      pos = child;
+    } else {
+      break;
+    }
+  }
+  dists[pos] = new_dist;
+  idx[pos] = new_idx;
+}
+
+// Add a chunk of rows from the condensed long form of the distances to
+// the k nearest-neighbours of each sample. heap_dists and heap_idx are
+// n_samples x kNN, and should start as inf and -1
+void update_kNN(const NumpyMatrix &dist_chunk, const size_t dist_col,
+                const uint64_t row_offset, const size_t n_samples,
+                Eigen::Ref<NumpyMatrix> heap_dists,
+                Eigen::Ref<NumpyIndexMatrix> heap_idx,
+                const size_t num_threads) {
+  const size_t n_rows = dist_chunk.rows();
+  const size_t kNN = heap_dists.cols();
+  if (n_rows == 0 || kNN == 0) {
+    return;
+  }
+  const uint64_t row_end = row_offset + n_rows;
+  const long i_first = calc_row_idx(row_offset, n_samples);
+  const long i_last = calc_row_idx(row_end - 1, n_samples);
+
+  // Rows in this chunk with first sample i
+  auto row_range = [&](const long i) {
+    const uint64_t i_start = square_to_condensed(i, i + 1, n_samples);
+    const uint64_t i_end = i_start + n_samples - i - 1;
+    return std::make_pair(std::max(i_start, row_offset),
+                          std::min(i_end, row_end));
+  };
+
+  // Each row of the long form is (i, j) with i < j. First add j to the
+  // heap of i, with each thread taking different i
+#pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+  for (long i = i_first; i <= i_last; i++) {
+    const auto range = row_range(i);
+    float *dists = heap_dists.row(i).data();
+    int64_t *idx = heap_idx.row(i).data();
+    for (uint64_t row = range.first; row < range.second; row++) {
+      const int64_t j = calc_col_idx(row, i, n_samples);
+      heap_push(dists, idx, kNN, dist_chunk(row - row_offset, dist_col), j);
+    }
+  }
+
+  // Then add i to the heap of j, with each thread taking a different
+  // block of j, so no heap is updated by two threads
+  const long j_first = i_first + 1;
+  const long n_blocks = std::max(
+      1L, std::min(static_cast<long>(num_threads) * 4,
+                   static_cast<long>(n_samples) - j_first));
+#pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+  for (long block = 0; block < n_blocks; block++) {
+    const long block_start = j_first + block * (n_samples - j_first) / n_blocks;
+    const long block_end =
+        j_first + (block + 1) * (n_samples - j_first) / n_blocks;
+    for (long i = i_first; i <= i_last; i++) {
+      const auto range = row_range(i);
+      if (range.first >= range.second) {
+        continue;
+      }
+      const long j_start = std::max(
+          block_start, static_cast<long>(calc_col_idx(range.first, i, n_samples)));
+      const long j_end =
+          std::min(block_end, static_cast<long>(calc_col_idx(range.second - 1, i,
+                                                             n_samples)) + 1);
+      for (long j = j_start; j < j_end; j++) {
+        const uint64_t row = square_to_condensed(i, j, n_samples);
+        heap_push(heap_dists.row(j).data(), heap_idx.row(j).data(), kNN,
+                  dist_chunk(row - row_offset, dist_col), i);
+      }
+    }
+  }
+}
+
+// As update_kNN, but for a chunk of query-reference distances, where row
+// q * n_ref + r is the distance between query q and reference r. Queries
+// are added to the reference heaps with index n_ref + q, and references to
+// the query heaps with index r
+void update_kNN_rect(const NumpyMatrix &dist_chunk, const size_t dist_col,
+                     const uint64_t row_offset, const size_t n_ref,
+                     Eigen::Ref<NumpyMatrix> ref_heap_dists,
+                     Eigen::Ref<NumpyIndexMatrix> ref_heap_idx,
+                     Eigen::Ref<NumpyMatrix> query_heap_dists,
+                     Eigen::Ref<NumpyIndexMatrix> query_heap_idx,
+                     const size_t num_threads) {
+  const size_t n_rows = dist_chunk.rows();
+  const size_t kNN = ref_heap_dists.cols();
+  if (n_rows == 0 || kNN == 0) {
+    return;
+  }
+  const uint64_t row_end = row_offset + n_rows;
+  const long q_first = row_offset / n_ref;
+  const long q_last = (row_end - 1) / n_ref;
+
+  // Each query's distances are contiguous
+#pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+  for (long q = q_first; q <= q_last; q++) {
+    const uint64_t start = std::max(q * n_ref, row_offset);
+    const uint64_t end = std::min((q + 1) * n_ref, row_end);
+    float *dists = query_heap_dists.row(q).data();
+    int64_t *idx = query_heap_idx.row(q).data();
+    for (uint64_t row = start; row < end; row++) {
+      heap_push(dists, idx, kNN, dist_chunk(row - row_offset, dist_col),
+                row - q * n_ref);
+    }
+  }
+
+  // Threads take different blocks of references
+  const long n_blocks = std::max(
+      1L, std::min(static_cast<long>(num_threads) * 4, static_cast<long>(n_ref)));
+#pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+  for (long block = 0; block < n_blocks; block++) {
+    const long block_start = block * n_ref / n_blocks;
+    const long block_end = (block + 1) * n_ref / n_blocks;
+    for (long q = q_first; q <= q_last; q++) {
+      const long r_start = std::max(
+          block_start, static_cast<long>(std::max(q * n_ref, row_offset) - q * n_ref));
+      const long r_end = std::min(
+          block_end, static_cast<long>(std::min((q + 1) * n_ref, row_end) - q * n_ref));
+      for (long r = r_start; r < r_end; r++) {
+        heap_push(ref_heap_dists.row(r).data(), ref_heap_idx.row(r).data(), kNN,
+                  dist_chunk(q * n_ref + r - row_offset, dist_col), n_ref + q);
+      }
+    }
+  }
+}
@@ -4,6 +4,8 @@
 
 typedef std::tuple<std::vector<long>, std::vector<long>, std::vector<float>>
     sparse_coo;
+typedef Eigen::Matrix<int64_t, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>
+    NumpyIndexMatrix;
 
 sparse_coo extend(const sparse_coo &sparse_rr_mat,
                   const NumpyMatrix &qq_mat_square,
@@ -22,3 +24,27 @@ sparse_coo get_kNN_distances(const NumpyMatrix &distMat,
                              const int kNN,
                              const size_t dist_col,
                              const size_t num_threads);
+
+void update_kNN(const NumpyMatrix &dist_chunk,
+                const size_t dist_col,
+                const uint64_t row_offset,
+                const size_t n_samples,
+                Eigen::Ref<NumpyMatrix> heap_dists,
+                Eigen::Ref<NumpyIndexMatrix> heap_idx,
+                const size_t num_threads);
+
+void update_kNN_rect(const NumpyMatrix &dist_chunk,
+                     const size_t dist_col,
+                     const uint64_t row_offset,
+                     const size_t n_ref,
+                     Eigen::Ref<NumpyMatrix> ref_heap_dists,
+                     Eigen::Ref<NumpyIndexMatrix> ref_heap_idx,
+                     Eigen::Ref<NumpyMatrix> query_heap_dists,
+                     Eigen::Ref<NumpyIndexMatrix> query_heap_idx,
+                     const size_t num_threads);
+
+NumpyIndexMatrix rank_prefix_lengths(const sparse_coo &sparse_rr_mat,
+                                     const size_t n_samples,
+                                     const std::vector<size_t> &ranks,
+                                     bool count_unique_distances,
+                                     const size_t num_threads);
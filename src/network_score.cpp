@@ -0,0 +1,99 @@
+/*
+ *
+ * network_score.cpp
+ * Score a network as edges are added, without rebuilding it
+ *
+ */
+#include <algorithm>
+#include <numeric>
+
+#include "network_score.hpp"
+
+// Union-find with path halving and union by size
+long find_root(std::vector<long> &parent, long i) {
+  while (parent[i] != i) {
+    parent[i] = parent[parent[i]];
+    i = parent[i];
+  }
+  return i;
+}
+
+bool merge_sets(std::vector<long> &parent, std::vector<long> &set_size,
+                const long i, const long j) {
+  long root_i = find_root(parent, i);
+  long root_j = find_root(parent, j);
+  if (root_i == root_j) {
+    return false;
+  }
+  if (set_size[root_i] < set_size[root_j]) {
+    std::swap(root_i, root_j);
+  }
+  parent[root_j] = root_i;
+  set_size[root_i] += set_size[root_j];
+  return true;
+}
+
+// Edges are added in the order given, which must be grouped by idx. The
+// network is undirected with n_samples vertices, and each edge must appear
+// once. After each group of edges, the summary statistics calculated by
+// networkSummary (without betweenness) are recorded: the number of
+// components from a union-find, the density from the number of edges, and
+// the transitivity (3 * triangles / connected triples) from the triangles
+// and triples each new edge makes
+stream_scores score_edge_stream(const Eigen::Ref<const RowVector> &i_vec,
+                                const Eigen::Ref<const RowVector> &j_vec,
+                                const Eigen::Ref<const RowVector> &idx_vec,
+                                const size_t n_samples) {
+  std::vector<long> parent(n_samples);
+  std::iota(parent.begin(), parent.end(), 0);
+  std::vector<long> set_size(n_samples, 1);
+  // Neighbours of each vertex, kept sorted
+  std::vector<std::vector<long>> adjacency(n_samples);
+
+  long components = n_samples;
+  uint64_t n_edges = 0;
+  uint64_t triangles = 0;
+  uint64_t triples = 0;
+  const double max_edges = 0.5 * n_samples * (n_samples - 1);
+
+  std::vector<long> idx_values, component_counts;
+  std::vector<double> densities, transitivities;
+  for (long edge_idx = 0; edge_idx < idx_vec.size(); ++edge_idx) {
+    const long i = i_vec[edge_idx];
+    const long j = j_vec[edge_idx];
+
+    // New triangles are the common neighbours of i and j
+    const std::vector<long> &smaller = adjacency[i].size() < adjacency[j].size()
+                                           ? adjacency[i]
+                                           : adjacency[j];
+    const std::vector<long> &larger = adjacency[i].size() < adjacency[j].size()
+                                          ? adjacency[j]
+                                          : adjacency[i];
+    for (const long k : smaller) {
+      if (std::binary_search(larger.cbegin(), larger.cend(), k)) {
+        triangles++;
+      }
+    }
+    // and each existing edge of i and j makes a new triple
+    triples += adjacency[i].size() + adjacency[j].size();
+    adjacency[i].insert(
+        std::lower_bound(adjacency[i].begin(), adjacency[i].end(), j), j);
+    adjacency[j].insert(
+        std::lower_bound(adjacency[j].begin(), adjacency[j].end(), i), i);
+    if (merge_sets(parent, set_size, i, j)) {
+      components--;
+    }
+    n_edges++;
+
+    if (edge_idx + 1 == idx_vec.size() ||
+        idx_vec[edge_idx + 1] != idx_vec[edge_idx]) {
+      idx_values.push_back(idx_vec[edge_idx]);
+      component_counts.push_back(components);
+      densities.push_back(static_cast<double>(n_edges) / max_edges);
+      transitivities.push_back(static_cast<double>(3 * triangles) /
+                               static_cast<double>(triples));
+    }
+  }
+  return std::make_tuple(idx_values, component_counts, densities,
+                         transitivities);
+}
@@ -0,0 +1,25 @@
+/*
+ *
+ * network_score.hpp
+ * prototypes for incremental network scoring
+ *
+ */
+#pragma once
+
+#include <cstddef>
+#include <cstdint>
+#include <tuple>
+#include <vector>
+
+#include "boundary.hpp"
+
+// Distinct idx values, then components, density and transitivity after
+// adding the edges with each
+typedef std::tuple<std::vector<long>, std::vector<long>, std::vector<double>,
+                   std::vector<double>>
+    stream_scores;
+
+stream_scores score_edge_stream(const Eigen::Ref<const RowVector> &i_vec,
+                                const Eigen::Ref<const RowVector> &j_vec,
+                                const Eigen::Ref<const RowVector> &idx_vec,
+                                const size_t n_samples);
@@ -13,6 +13,7 @@ namespace py = pybind11;
 
 #include "boundary.hpp"
 #include "extend.hpp"
+#include "network_score.hpp"
 
 // Wrapper which makes a ref to the python/numpy array
 Eigen::VectorXf assignThreshold(const Eigen::Ref<NumpyMatrix> &distMat,
@@ -31,6 +32,38 @@ edge_tuple edgeThreshold(const Eigen::Ref<NumpyMatrix> &distMat,
   return (edges);
 }
 
+edge_arrays thresholdEdges(const Eigen::Ref<NumpyMatrix> &distMat,
+                           const int slope, const double x_max,
+                           const double y_max, const bool self,
+                           const size_t num_ref, const uint64_t row_offset = 0,
+                           const int int_offset = 0,
+                           const unsigned int num_threads = 1) {
+  edge_arrays edges =
+      threshold_edges(distMat, slope, x_max, y_max, self, num_ref, row_offset,
+                      int_offset, num_threads);
+  return (edges);
+}
+
+void updateKNN(const Eigen::Ref<NumpyMatrix> &dist_chunk,
+               Eigen::Ref<NumpyMatrix> heap_dists,
+               Eigen::Ref<NumpyIndexMatrix> heap_idx, const size_t dist_col,
+               const uint64_t row_offset, const size_t n_samples,
+               const size_t num_threads = 1) {
+  update_kNN(dist_chunk, dist_col, row_offset, n_samples, heap_dists, heap_idx,
+             num_threads);
+}
+
+void updateKNNRect(const Eigen::Ref<NumpyMatrix> &dist_chunk,
+                   Eigen::Ref<NumpyMatrix> ref_heap_dists,
+                   Eigen::Ref<NumpyIndexMatrix> ref_heap_idx,
+                   Eigen::Ref<NumpyMatrix> query_heap_dists,
+                   Eigen::Ref<NumpyIndexMatrix> query_heap_idx,
+                   const size_t dist_col, const uint64_t row_offset,
+                   const size_t n_ref, const size_t num_threads = 1) {
+  update_kNN_rect(dist_chunk, dist_col, row_offset, n_ref, ref_heap_dists,
+                  ref_heap_idx, query_heap_dists, query_heap_idx, num_threads);
+}
+
 edge_tuple generateTuples(const std::vector<int> &assignments,
                           const int within_label, bool self, const int num_ref,
                           const int int_offset) {
@@ -60,18 +93,29 @@ network_coo thresholdIterate1D(const Eigen::Ref<NumpyMatrix> &distMat,
   return (add_idx);
 }
 
-network_coo thresholdIterate2D(const Eigen::Ref<NumpyMatrix> &distMat,
-                               const std::vector<float> &x_max,
-                               const float y_max) {
+network_arrays thresholdIterate2D(const Eigen::Ref<NumpyMatrix> &distMat,
+                                  const std::vector<float> &x_max,
+                                  const float y_max,
+                                  const int num_threads = 1) {
   if (!std::is_sorted(x_max.begin(), x_max.end())) {
     throw std::runtime_error(
         "x_max range to thresholdIterate2D must be sorted");
   }
-  std::tuple<std::vector<long>, std::vector<long>, std::vector<long>> add_idx =
-      threshold_iterate_2D(distMat, x_max, y_max);
+  py::gil_scoped_release release;
+  network_arrays add_idx =
+      threshold_iterate_2D(distMat, x_max, y_max, num_threads);
   return (add_idx);
 }
 
+stream_scores scoreEdgeStream(const Eigen::Ref<const RowVector> &i_vec,
+                              const Eigen::Ref<const RowVector> &j_vec,
+                              const Eigen::Ref<const RowVector> &idx_vec,
+                              const size_t n_samples) {
+  py::gil_scoped_release release;
+  stream_scores scores = score_edge_stream(i_vec, j_vec, idx_vec, n_samples);
+  return (scores);
+}
+
 PYBIND11_MODULE(poppunk_refine, m) {
   m.doc() = "Network refine helper functions";
 
@@ -89,6 +133,15 @@ PYBIND11_MODULE(poppunk_refine, m) {
         py::arg("distMat").noconvert(), py::arg("slope"), py::arg("x_max"),
         py::arg("y_max"));
 
+  m.def("thresholdEdges", &thresholdEdges,
+        py::return_value_policy::reference_internal,
+        "Assign distances based on their relation to a 2D boundary, returning "
+        "arrays of within-strain edges and their rows",
+        py::arg("distMat").noconvert(), py::arg("slope"), py::arg("x_max"),
+        py::arg("y_max"), py::arg("self"), py::arg("num_ref"),
+        py::arg("row_offset") = 0, py::arg("int_offset") = 0,
+        py::arg("num_threads") = 1);
+
   m.def("generateTuples", &generateTuples,
         py::return_value_policy::reference_internal,
         "Return edge tuples based on assigned groups", py::arg("assignments"),
@@ -100,6 +153,13 @@ PYBIND11_MODULE(poppunk_refine, m) {
         py::arg("num_ref"), py::arg("num_queries") = 0, py::arg("self") = true,
         py::arg("int_offset") = 0);
 
+  m.def("scoreEdgeStream", &scoreEdgeStream,
+        py::return_value_policy::reference_internal,
+        "Network components, density and transitivity as groups of edges "
+        "are added",
+        py::arg("i_vec"), py::arg("j_vec"), py::arg("idx_vec"),
+        py::arg("n_samples"));
+
   m.def("thresholdIterate1D", &thresholdIterate1D,
         py::return_value_policy::reference_internal,
         "Move a 2D boundary to grow a network by adding edges at each offset",
@@ -110,7 +170,8 @@ PYBIND11_MODULE(poppunk_refine, m) {
   m.def("thresholdIterate2D", &thresholdIterate2D,
         py::return_value_policy::reference_internal,
         "Move a 2D boundary to grow a network by adding edges at each offset",
-        py::arg("distMat").noconvert(), py::arg("x_max"), py::arg("y_max"));
+        py::arg("distMat").noconvert(), py::arg("x_max"), py::arg("y_max"),
+        py::arg("num_threads") = 1);
 
   m.def("extend", &extend, py::return_value_policy::reference_internal,
         "Extend a sparse distance matrix keeping k nearest-neighbours",
@@ -127,6 +188,31 @@ PYBIND11_MODULE(poppunk_refine, m) {
         py::arg("count_unique_distances") = false,
         py::arg("num_threads") = 1);
 
+  m.def("updateKNN", &updateKNN,
+        "Add a chunk of long form distances to the k nearest-neighbours of "
+        "each sample",
+        py::arg("dist_chunk").noconvert(), py::arg("heap_dists").noconvert(),
+        py::arg("heap_idx").noconvert(), py::arg("dist_col"),
+        py::arg("row_offset"), py::arg("n_samples"),
+        py::arg("num_threads") = 1);
+
+  m.def("updateKNNRect", &updateKNNRect,
+        "Add a chunk of long form query-reference distances to the k "
+        "nearest-neighbours of each reference and query",
+        py::arg("dist_chunk").noconvert(), py::arg("ref_heap_dists").noconvert(),
+        py::arg("ref_heap_idx").noconvert(),
+        py::arg("query_heap_dists").noconvert(),
+        py::arg("query_heap_idx").noconvert(), py::arg("dist_col"),
+        py::arg("row_offset"), py::arg("n_ref"), py::arg("num_threads") = 1);
+
+  m.def("rankPrefixLengths", &rank_prefix_lengths,
+        py::return_value_policy::reference_internal,
+        "Find the neighbours kept at each rank of a sorted sparse distance "
+        "matrix, as the length of the prefix of each row",
+        py::arg("rr_mat"), py::arg("n_samples"), py::arg("ranks"),
+        py::arg("count_unique_distances") = false,
+        py::arg("num_threads") = 1);
+
   m.def("get_kNN_distances", &get_kNN_distances, py::return_value_policy::reference_internal,
         "Identify k nearest-neighbours from a square distance matrix",
         py::arg("distMat").noconvert(),
@@ -27,6 +27,7 @@ with open("references.txt", 'r') as ref_file:
 # clean up
 outputDirs = [
     "example_db",
+    "example_db_hdf5",
     "example_qc",
     "example_dbscan",
     "example_refine",
@@ -45,6 +46,7 @@ outputDirs = [
     "example_lineage_viz",
     "example_viz_query_lineages",
     "example_mst",
+    "example_mst_mmap",
     "example_sparse_mst",
     "example_mandrake",
     "example_iterate",
@@ -59,7 +61,10 @@ outputDirs = [
     "strain_1_lineage_db",
     "strain_2_lineage_db",
     "lineage_querying_output",
-    "example_network_qc"
+    "example_network_qc",
+    "raster_bgmm",
+    "raster_dbscan",
+    "raster_compact"
 ]
 for outDir in outputDirs:
     deleteDir(outDir)
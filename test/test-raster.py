@@ -0,0 +1,69 @@
+import os, sys
+import shutil
+import numpy as np
+
+# testing without install
+#sys.path.insert(0, '..')
+from PopPUNK.models import BGMMFit, DBSCANFit, loadClusterFit
+from PopPUNK.bgmm import precompute2dGaussians
+
+# Two clouds of core and accessory distances, as in a within/between strain fit
+rng = np.random.default_rng(1)
+X = np.vstack((rng.normal([0.002, 0.05], [0.0005, 0.01], (5000, 2)),
+               rng.normal([0.02, 0.3], [0.003, 0.04], (20000, 2)))).clip(1e-6)
+X = X.astype(np.float32)
+
+def check_raster(model, prefix, n_points = 200000, extra_points = None):
+    model.save()
+    loaded = loadClusterFit(prefix + "/" + prefix + "_fit.pkl",
+                            prefix + "/" + prefix + "_fit.npz")
+    loaded.set_threads(1)
+    if loaded.raster is None:
+        if isinstance(loaded, DBSCANFit):
+            sys.stderr.write("DBSCAN grid was not verified, checking exact assignment only\n")
+        else:
+            raise RuntimeError("No grid saved with " + prefix)
+    # Points over the whole grid, and a little past its edges
+    query = (rng.random((n_points, 2)) * 1.05 * loaded.scale).astype(np.float32)
+    if extra_points is not None:
+        query = np.vstack((query, extra_points.astype(np.float32)))
+    exact = loaded.exact_assign(query / loaded.scale)
+    if loaded.raster is not None:
+        grid = loaded.raster_assign(query, loaded.scale)
+        if not np.array_equal(grid, exact):
+            raise RuntimeError("Grid assignment does not match exact assignment for " + prefix)
+    assigned = loaded.assign(query, progress = False)
+    if not np.array_equal(assigned, exact):
+        raise RuntimeError("Assignment does not match exact assignment for " + prefix)
+    shutil.rmtree(prefix)
+
+sys.stderr.write("Checking BGMM grid assignment\n")
+bgmm = BGMMFit("raster_bgmm")
+bgmm.set_threads(1)
+bgmm.fit(X, 3)
+check_raster(bgmm, "raster_bgmm")
+
+sys.stderr.write("Checking DBSCAN grid assignment\n")
+dbscan = DBSCANFit("raster_dbscan")
+dbscan.set_threads(1)
+dbscan.fit(X, 10, 0.0001)
+check_raster(dbscan, "raster_dbscan")
+
+# A component much smaller than a grid cell, which touches neither the
+# centre nor the edges of its cell
+sys.stderr.write("Checking BGMM grid assignment with a compact component\n")
+compact = BGMMFit("raster_compact")
+os.makedirs("raster_compact", exist_ok = True)
+compact.dpgmm = None
+compact.weights = np.array([0.3, 0.7])
+compact.means = np.array([[153.5 / 512 + 0.0005, 153.5 / 512], [0.5, 0.5]])
+compact.covariances = np.array([np.eye(2) * 1e-9, np.eye(2) * 0.01])
+compact.precisions, compact.log_dets = precompute2dGaussians(compact.covariances)
+compact.scale = np.ones(2)
+compact.within_label = 0
+compact.between_label = 1
+compact.fitted = True
+near_compact = rng.normal(compact.means[0], 3e-5, (1000, 2))
+if not np.all(compact.exact_assign(near_compact) == 0):
+    raise RuntimeError("Compact component test points are not in the compact component")
+check_raster(compact, "raster_compact", extra_points = near_compact)
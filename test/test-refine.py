@@ -137,3 +137,22 @@ for offset_idx, offset in enumerate(offsets):
   if set(zip(py_i, py_j)) != set(zip(sketchlib_i, sketchlib_j)):
     raise RuntimeError("Threshold 2D iterate mismatch at offset " + str(offset))
 
+
+# score network as 2D boundary moves
+idx_values, components, density, transitivity = \
+  poppunk_refine.scoreEdgeStream(np.asarray(i_vec, dtype=np.int64),
+                                 np.asarray(j_vec, dtype=np.int64),
+                                 np.asarray(idx_vec, dtype=np.int64),
+                                 samples)
+for offset_idx, offset_components, offset_density, offset_transitivity in \
+    zip(idx_values, components, density, transitivity):
+  adj = np.zeros((samples, samples))
+  in_network = np.asarray(idx_vec) <= offset_idx
+  adj[np.asarray(i_vec)[in_network], np.asarray(j_vec)[in_network]] = 1
+  adj += adj.T
+  degree = adj.sum(axis=1)
+  py_transitivity = np.trace(adj @ adj @ adj) / np.sum(degree * (degree - 1))
+  py_density = np.sum(in_network) / (0.5 * samples * (samples - 1))
+  if not (np.isclose(offset_transitivity, py_transitivity, equal_nan=True) and
+          np.isclose(offset_density, py_density)):
+    raise RuntimeError("Network score mismatch at offset " + str(offset_idx))
@@ -123,3 +123,24 @@ for lineage_option_string in [" "," --count-unique-distances ", " --reciprocal-o
     S8 = scipy.sparse.load_npz("batch3/batch3_rank_1_fit.npz")
     sys.stderr.write("Comparing sparse matrices at rank 1 after second query calculated with options " + lineage_option_string + "\n")
     compare_sparse_matrices(S7,S8,rlist3,rlist4,lineage_option_string)
+
+# Check distances appended with --update-db against those calculated together
+from PopPUNK.utils import readPickle
+
+def dists_by_pair(names, X):
+    pair_dists = {}
+    row = 0
+    for i in range(len(names)):
+        for j in range(i + 1, len(names)):
+            pair_dists[tuple(sorted((names[i], names[j])))] = X[row, 0]
+            row += 1
+    return pair_dists
+
+sys.stderr.write("Comparing distances appended by --update-db to those calculated together\n")
+rlist_update, qlist_update, self_update, X_update = readPickle("batch3/batch3.dists", enforce_self = True)
+rlist_all, qlist_all, self_all, X_all = readPickle("batch123/batch123.dists", enforce_self = True)
+update_dists = dists_by_pair(rlist_update, X_update)
+all_dists = dists_by_pair(rlist_all, X_all)
+shared_pairs = [pair for pair in update_dists if pair in all_dists]
+run_regression(np.asarray([update_dists[pair] for pair in shared_pairs]),
+               np.asarray([all_dists[pair] for pair in shared_pairs]))